@@ -0,0 +1,106 @@
+from collections import defaultdict
+
+from twisted.internet import defer, task
+from zope.interface import implementer
+
+from database import Validations
+from interfaces import IVotes
+
+@implementer(IVotes)
+class VoteBuffer(object):
+    """
+    Write-behind wrapper around a `Votes` object. Votes are coalesced per
+    candidate in memory and written with a single `add_votes` transaction,
+    either every `interval` seconds or once `threshold` votes are pending.
+
+    The `Deferred` returned by `vote_for` fires once the batch holding the
+    vote has been committed, so callers still learn about unknown
+    candidates and database failures.
+    """
+
+    validate = Validations()
+
+    def __init__(self, votes, interval=0.05, threshold=500, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.votes = votes
+        self.interval = interval
+        self.threshold = threshold
+        self.clock = clock
+        self.table_name = votes.table_name
+        self.pending = defaultdict(int)
+        self.waiters = defaultdict(list)
+        self.pending_votes = 0
+        self.loop = task.LoopingCall(self.flush)
+        self.loop.clock = clock
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop the periodic flush and write out anything still pending.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        return self.flush()
+
+    def create_table(self):
+        return self.votes.create_table()
+
+    def vote_for(self, candidate_id):
+        self.validate.validate_candidate_id(candidate_id)
+        d = defer.Deferred()
+        self.pending[candidate_id] += 1
+        self.waiters[candidate_id].append(d)
+        self.pending_votes += 1
+        if self.pending_votes >= self.threshold:
+            self.flush()
+        return d
+
+    def add_votes(self, counts):
+        return self.votes.add_votes(counts)
+
+    def vote_total(self, candidate_id):
+        return self.votes.vote_total(candidate_id)
+
+    def all_vote_totals(self):
+        return self.votes.all_vote_totals()
+
+    def vote_totals_page(self, order='votes', limit=100, after=None):
+        return self.votes.vote_totals_page(order, limit, after)
+
+    def flush(self):
+        """
+        Write all pending votes in one transaction.
+
+        :return: `Deferred` that fires once every waiter has been notified.
+        """
+        if not self.pending_votes:
+            return defer.succeed(None)
+
+        counts, waiters = self.pending, self.waiters
+        self.pending = defaultdict(int)
+        self.waiters = defaultdict(list)
+        self.pending_votes = 0
+
+        d = defer.maybeDeferred(self.votes.add_votes, dict(counts))
+
+        @d.addCallback
+        def notify(missing):
+            missing = set(missing)
+            for candidate_id, deferreds in waiters.items():
+                for waiter in deferreds:
+                    if candidate_id in missing:
+                        waiter.errback(IndexError('Candidate id is not present'))
+                    else:
+                        waiter.callback(None)
+
+        @d.addErrback
+        def notify_failure(failure):
+            # database error, every vote in the batch failed
+            for deferreds in waiters.values():
+                for waiter in deferreds:
+                    waiter.errback(failure)
+
+        return d
@@ -0,0 +1,328 @@
+"""
+Drive the vote API with a configurable mix of requests and report
+throughput, latency percentiles and the depth of the database pool's
+queue. Run from the repository root, either in-process through the
+`KleinResourceTester` used by the tests (a real sqlite file in a temporary
+directory, no sockets):
+
+    python -m benchmarks.api --requests 5000 --concurrency 50 --output run.json
+
+or against a server that's already running:
+
+    python -m benchmarks.api --url http://127.0.0.1:8000
+
+`--baseline` compares the run with stored results and exits with status 1
+when throughput dropped or p99 latency grew by more than `--tolerance`.
+"""
+from __future__ import print_function
+from collections import defaultdict
+from io import BytesIO
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+import random
+import time
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from twisted.internet import defer, task
+from twisted.python.usage import Options, UsageError
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from database import PRAGMA_PROFILES, connection_pool
+
+OPERATIONS = ('vote', 'candidates', 'candidate')
+FORM = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['url', 'u', None, 'Benchmark a running server instead of an in-process application'],
+        ['requests', 'n', 5000, 'Requests to send', int],
+        ['concurrency', 'c', 50, 'Requests in flight at once', int],
+        ['candidates', None, 20, 'Candidates to vote for', int],
+        ['skew', None, 1.2, 'Zipf exponent of the votes, 0 is uniform', float],
+        ['mix', None, 'vote=70,candidates=25,candidate=5',
+            'Relative weights of POST /api/vote, GET /api/candidates and POST /api/candidate'],
+        ['sqlite-profile', None, 'throughput', 'SQLite pragma profile of the in-process database'],
+        ['seed', None, 0, 'Random seed of the workload', int],
+        ['output', 'o', None, 'Write the results to this JSON file'],
+        ['baseline', 'b', None, 'Compare with the results in this JSON file'],
+        ['tolerance', None, 0.10, 'Relative change that counts as a regression', float],
+    ]
+
+    def postOptions(self):
+        try:
+            weights = dict(
+                (name.strip(), float(weight)) for name, weight in
+                (item.split('=') for item in self['mix'].split(',')))
+        except ValueError:
+            raise UsageError('--mix takes name=weight pairs, eg. vote=70,candidates=30')
+        unknown = set(weights) - set(OPERATIONS)
+        if unknown:
+            raise UsageError('Unknown operations in --mix: %s' % (', '.join(sorted(unknown))))
+        self['weights'] = weights
+        if self['sqlite-profile'] not in PRAGMA_PROFILES:
+            raise UsageError('Unknown pragma profile: %s' % (self['sqlite-profile']))
+
+class InProcessTarget(object):
+    """
+    The application served through `KleinResourceTester` on a sqlite file,
+    so the pool's queue can be watched directly.
+    """
+
+    def __init__(self, pragmas):
+        from main import Application
+        from tests.test_vote_api import KleinResourceTester
+
+        self.tmpdir = mkdtemp()
+        self.dbpool = connection_pool(path.join(self.tmpdir, 'benchmark.sqlite'), pragmas)
+        self.app = Application(self.dbpool)
+        self.client = KleinResourceTester(self.app.router)
+        self.description = 'in-process, sqlite'
+
+    @defer.inlineCallbacks
+    def setup(self):
+        yield self.app.vote_api.candidates.create_table()
+        yield self.app.vote_api.votes.create_table()
+
+    def request(self, method, uri, params=None):
+        d = self.client.request(method, uri, headers=FORM if params else None, params=params)
+        d.addCallback(lambda response: (response.code, response.content))
+        return d
+
+    def queue_depth(self):
+        # work submitted to the pool that no thread has picked up yet
+        return self.dbpool.threadpool._team.statistics().backloggedWorkCount
+
+    def close(self):
+        self.dbpool.close()
+        rmtree(self.tmpdir)
+
+class HTTPTarget(object):
+    """
+    A running server, reached over persistent HTTP connections.
+    """
+
+    def __init__(self, reactor, url, concurrency):
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = concurrency
+        self.pool = pool
+        self.agent = Agent(reactor, pool=pool)
+        self.url = url.rstrip('/')
+        self.description = self.url
+
+    def setup(self):
+        return defer.succeed(None)
+
+    def request(self, method, uri, params=None):
+        headers, body = None, None
+        if params:
+            headers = Headers(dict((key, [value]) for key, value in FORM.items()))
+            body = FileBodyProducer(BytesIO(urlencode(params).encode('utf-8')))
+        d = self.agent.request(
+            method.encode('ascii'), (self.url + uri).encode('utf-8'), headers, body)
+
+        @d.addCallback
+        def read(response):
+            d = readBody(response)
+            d.addCallback(lambda body: (response.code, body.decode('utf-8')))
+            return d
+
+        return d
+
+    def queue_depth(self):
+        return None     # not visible from outside the server
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+def candidate_name(number):
+    """
+    Unique, valid candidate names: letters only, in base 26.
+    """
+    letters = ''
+    number += 1
+    while number:
+        number, digit = divmod(number - 1, 26)
+        letters = chr(ord('a') + digit) + letters
+    return 'Nominee %s' % (letters)
+
+def workload(options, candidate_ids):
+    """
+    :return: list of `(operation, method, uri, params)`, drawn up front so
+        generating requests doesn't count against the server.
+    """
+    rng = random.Random(options['seed'])
+    operations = [name for name in OPERATIONS if options['weights'].get(name)]
+    weights = [options['weights'][name] for name in operations]
+    vote_weights = [1.0 / (rank ** options['skew']) for rank in range(1, len(candidate_ids) + 1)]
+
+    requests = []
+    nominations = 0
+    for operation in rng.choices(operations, weights, k=options['requests']):
+        if operation == 'vote':
+            candidate_id = rng.choices(candidate_ids, vote_weights)[0]
+            requests.append((operation, 'POST', '/api/vote', {'id': candidate_id}))
+        elif operation == 'candidate':
+            name = candidate_name(options['seed'] * 1000000 + nominations)
+            nominations += 1
+            requests.append((operation, 'POST', '/api/candidate', {'candidate': name}))
+        else:
+            requests.append((operation, 'GET', '/api/candidates', None))
+    return requests
+
+@defer.inlineCallbacks
+def seed_candidates(target, count):
+    """
+    Make sure `count` candidates exist and return their ids.
+    """
+    for attempt in range(2):
+        code, body = yield target.request('GET', '/api/candidates')
+        ids = sorted(candidate['id'] for candidate in json.loads(body)['candidates'])
+        if len(ids) >= count:
+            defer.returnValue(ids[:count])
+        for i in range(len(ids), count):
+            name = candidate_name(i).replace('Nominee', 'Seeded')
+            yield target.request('POST', '/api/candidate', {'candidate': name})
+    raise RuntimeError('Could not create %d candidates' % (count))
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summary(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+@defer.inlineCallbacks
+def run_workload(reactor, target, requests, concurrency):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    queue = []
+
+    def sample():
+        depth = target.queue_depth()
+        if depth is not None:
+            queue.append(depth)
+
+    sampler = task.LoopingCall(sample)
+    sampler.clock = reactor
+    sampler.start(0.01)
+
+    work = iter(requests)
+
+    @defer.inlineCallbacks
+    def worker():
+        for operation, method, uri, params in work:
+            start = time.time()
+            try:
+                code, body = yield target.request(method, uri, params)
+            except Exception:
+                code = None
+            latencies[operation].append(time.time() - start)
+            if code not in (200, 201):
+                errors[operation] += 1
+
+    start = time.time()
+    yield defer.gatherResults([worker() for i in range(concurrency)])
+    elapsed = time.time() - start
+    sampler.stop()
+
+    every = [latency for values in latencies.values() for latency in values]
+    results = {
+        'total': summary(every, sum(errors.values()), elapsed),
+        'operations': dict(
+            (operation, summary(values, errors[operation], elapsed))
+            for operation, values in latencies.items()),
+        'pool': {
+            'max_queue': max(queue) if queue else None,
+            'mean_queue': sum(queue) / float(len(queue)) if queue else None,
+        },
+    }
+    defer.returnValue(results)
+
+def compare(results, baseline, tolerance):
+    """
+    :return: descriptions of every metric that regressed.
+    """
+    regressions = []
+    sections = [('total', results['total'], baseline.get('total', {}))]
+    for operation, current in sorted(results['operations'].items()):
+        sections.append((operation, current, baseline.get('operations', {}).get(operation, {})))
+
+    for name, current, previous in sections:
+        if previous.get('throughput') and \
+                current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append('%s throughput %.0f/s, was %.0f/s' % (
+                name, current['throughput'], previous['throughput']))
+        if previous.get('p99_ms') and current['p99_ms'] is not None and \
+                current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append('%s p99 %.1fms, was %.1fms' % (
+                name, current['p99_ms'], previous['p99_ms']))
+    return regressions
+
+def report(results):
+    print('%-11s %9s %7s %10s %8s %8s %8s' % (
+        'operation', 'requests', 'errors', 'req/sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+    rows = sorted(results['operations'].items()) + [('total', results['total'])]
+    for name, row in rows:
+        print('%-11s %9d %7d %10.0f %8.1f %8.1f %8.1f' % (
+            name, row['requests'], row['errors'], row['throughput'],
+            row['p50_ms'], row['p95_ms'], row['p99_ms']))
+    if results['pool']['max_queue'] is not None:
+        print('db pool queue: max %d, mean %.1f' % (
+            results['pool']['max_queue'], results['pool']['mean_queue']))
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    if options['url']:
+        target = HTTPTarget(reactor, options['url'], options['concurrency'])
+    else:
+        target = InProcessTarget(PRAGMA_PROFILES[options['sqlite-profile']])
+    try:
+        yield target.setup()
+        candidate_ids = yield seed_candidates(target, options['candidates'])
+        requests = workload(options, candidate_ids)
+        print('%d requests, concurrency %d against %s' % (
+            len(requests), options['concurrency'], target.description))
+        results = yield run_workload(reactor, target, requests, options['concurrency'])
+    finally:
+        yield target.close()
+
+    results['config'] = dict(
+        (key, options[key]) for key in (
+            'url', 'requests', 'concurrency', 'candidates', 'skew', 'mix',
+            'sqlite-profile', 'seed'))
+    report(results)
+    if options['output']:
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if options['baseline']:
+        with open(options['baseline']) as stored:
+            baseline = json.load(stored)
+        regressions = compare(results, baseline, options['tolerance'])
+        for regression in regressions:
+            print('REGRESSION: %s' % (regression))
+        if regressions:
+            raise SystemExit(1)
+        print('No regressions against %s' % (options['baseline']))
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    task.react(main, (options,))
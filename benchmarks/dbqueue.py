@@ -0,0 +1,81 @@
+"""
+Compare vote and read throughput through adbapi's `ConnectionPool` and
+through a `QueuedDatabase`, which batches everything queued on its single
+thread into one transaction. Run from the repository root:
+
+    python -m benchmarks.dbqueue --votes 5000 --concurrency 50
+"""
+from __future__ import print_function
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import time
+
+from twisted.internet import defer, task
+from twisted.python.usage import Options
+
+from database import Database, Candidates, Votes, PRAGMA_PROFILES, connection_pool
+from dbqueue import QueuedDatabase
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['votes', 'n', 5000, 'Votes and reads per database', int],
+        ['concurrency', 'c', 50, 'Requests in flight at once', int],
+        ['candidates', None, 10, 'Number of candidates', int],
+        ['profile', None, 'throughput', 'SQLite pragma profile'],
+    ]
+
+@defer.inlineCallbacks
+def per_second(operation, count, concurrency):
+    start = time.time()
+    cooperator = task.Cooperator()
+    work = (operation(i) for i in range(count))
+    yield defer.gatherResults([cooperator.coiterate(work) for i in range(concurrency)])
+    defer.returnValue(count / (time.time() - start))
+
+@defer.inlineCallbacks
+def run(db, options):
+    candidates = Candidates(db)
+    votes = Votes(db, candidates)
+    yield candidates.create_table()
+    yield votes.create_table()
+    count = options['candidates']
+    for i in range(count):
+        yield candidates.add_candidate('Candidate %s' % (chr(ord('a') + i % 26) * (i // 26 + 1)))
+
+    writes = yield per_second(
+        lambda i: votes.vote_for(i % count + 1), options['votes'], options['concurrency'])
+    reads = yield per_second(
+        lambda i: votes.vote_total(i % count + 1), options['votes'], options['concurrency'])
+    totals = yield votes.all_vote_totals()
+    assert sum(row[2] for row in totals) == options['votes']
+    defer.returnValue((writes, reads))
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    pragmas = PRAGMA_PROFILES[options['profile']]
+    tmpdir = mkdtemp()
+    try:
+        dbpool = connection_pool(path.join(tmpdir, 'pool.sqlite'), pragmas)
+        pool_results = yield run(Database(dbpool), options)
+        dbpool.close()
+
+        queued = QueuedDatabase(path.join(tmpdir, 'queued.sqlite'), pragmas)
+        queued_results = yield run(queued, options)
+        batches = queued.batches
+        queued.close()
+
+        print('%-16s %12s %12s' % ('', 'votes/sec', 'reads/sec'))
+        print('%-16s %12.0f %12.0f' % (('ConnectionPool',) + pool_results))
+        print('%-16s %12.0f %12.0f' % (('QueuedDatabase',) + queued_results))
+        print('%-16s %11.2fx %11.2fx' % (
+            'speedup', queued_results[0] / pool_results[0], queued_results[1] / pool_results[1]))
+        print('%d transactions for %d statements' % (batches, 2 * options['votes'] + options['candidates'] + 3))
+    finally:
+        rmtree(tmpdir)
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    task.react(main, (options,))
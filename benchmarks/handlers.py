@@ -0,0 +1,234 @@
+"""
+Profile the candidate and vote handlers through Klein's resource, served
+by a `Site` over an in-memory transport with the memory backend, so the
+numbers are request handling alone: HTTP parsing, routing, the handler,
+`Jsonify` and writing the response. Each route is compared with the
+former handlers, written with `inlineCallbacks` behind a `Jsonify` that
+wrapped every call in `maybeDeferred`. Run from the repository root:
+
+    python -m benchmarks.handlers --requests 20000 --top 15
+"""
+from __future__ import print_function
+from functools import wraps
+import cProfile
+import gc
+import pstats
+import time
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from klein import Klein
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+from twisted.python.usage import Options
+from twisted.web.server import Site
+
+from benchmarks.api import candidate_name
+from controllers import (
+    CREATED, DATABASE_ISSUE, DATABASE_ISSUES, INVALID_INPUT, MISSING_INPUT, SUCCESS,
+    TOO_MANY_REQUESTS, VoteApi)
+from memory import MemoryCandidates, MemoryStore, MemoryVotes
+from middleware import Jsonify
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['requests', 'n', 20000, 'Requests per route and version', int],
+        ['candidates', None, 100, 'Candidates voted for', int],
+        ['repeat', 'r', 5, 'Runs of each route and version, the fastest is reported', int],
+        ['top', None, 0, 'Print the N most expensive functions of the current handlers', int],
+    ]
+
+class LegacyJsonify(Jsonify):
+
+    def jsonify(self, f, route=None):
+        @wraps(f)
+        def deco(*args, **kwargs):
+            request = args[1]
+            result = defer.maybeDeferred(f, *args, **kwargs)
+            result.addCallback(self.stringify, request)
+            result.addErrback(self.stringify_failure, request)
+            return result
+        return deco
+
+class LegacyVoteApi(VoteApi):
+    """
+    The handlers as they were, on their own router.
+    """
+
+    router = Klein()
+    jsonify = LegacyJsonify(router)
+
+    @jsonify.route('/candidates', methods=['GET'])
+    def get_candidates(self, request):
+        if self.cache.warm and self.not_modified(request):
+            return None
+
+        d = self.cache.fetch(self.votes.all_vote_totals)
+
+        @d.addCallback
+        def conditional(body, req=request):
+            if self.not_modified(req):
+                return None
+            return body
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            req.setResponseCode(400)
+            return DATABASE_ISSUES
+
+        return d
+
+    @jsonify.route('/candidate', methods=['POST'])
+    @defer.inlineCallbacks
+    def add_candidate(self, request):
+        if self.throttled(request):
+            defer.returnValue(TOO_MANY_REQUESTS)
+
+        if b'candidate' not in request.args:
+            request.setResponseCode(412)
+            return MISSING_INPUT
+
+        name = request.args[b'candidate'][0]
+        try:
+            yield self.candidates.add_candidate(name.decode('utf-8'))
+        except Exception as error:
+            request.setResponseCode(400)
+            defer.returnValue(DATABASE_ISSUE)
+
+        request.setResponseCode(201)
+        defer.returnValue(CREATED)
+
+    @jsonify.route('/vote', methods=['POST'])
+    @defer.inlineCallbacks
+    def vote_for(self, request):
+        if self.throttled(request):
+            defer.returnValue(TOO_MANY_REQUESTS)
+
+        if b'id' not in request.args:
+            request.setResponseCode(412)
+            defer.returnValue(INVALID_INPUT)
+
+        try:
+            candidate_id = int(request.args[b'id'][0])
+            yield self.votes.vote_for(candidate_id)
+        except (IndexError, ValueError):
+            request.setResponseCode(412)
+            defer.returnValue(INVALID_INPUT)
+        except Exception as error:
+            request.setResponseCode(400)
+            defer.returnValue(DATABASE_ISSUE)
+
+        defer.returnValue(SUCCESS)
+
+def http_client(resource):
+    """
+    :return: a function that feeds a raw HTTP request to `resource` and
+        returns the raw response, all within the call.
+    """
+    site = Site(resource)
+    site.timeOut = None
+    site.log = lambda request: None
+    protocol = site.buildProtocol(IPv4Address('TCP', '127.0.0.1', 8000))
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+
+    def request(data):
+        transport.clear()
+        protocol.dataReceived(data)
+        return transport.value()
+    return request
+
+def raw_request(method, path, params=None):
+    body = urlencode(params or {}).encode('ascii')
+    return b'%s %s HTTP/1.1\r\nHost: localhost\r\n' \
+        b'Content-Type: application/x-www-form-urlencoded\r\n' \
+        b'Content-Length: %d\r\n\r\n%s' % (method, path, len(body), body)
+
+def build(api_class, candidates):
+    store = MemoryStore()
+    candidate_store = MemoryCandidates(store)
+    api = api_class(None, 30, candidate_store, MemoryVotes(store, candidate_store))
+    for i in range(1, candidates + 1):
+        candidate_store.add_candidate(candidate_name(i))
+    client = http_client(api.resource())
+    client(raw_request(b'GET', b'/candidates'))     # load the leaderboard cache
+    return client
+
+def workloads(options):
+    """
+    :return: `(route, [raw requests], expected status line)`
+    """
+    count, candidates = options['requests'], options['candidates']
+    return [
+        ('POST /vote', [
+            raw_request(b'POST', b'/vote', {'id': i % candidates + 1}) for i in range(count)],
+            b'HTTP/1.1 200'),
+        ('POST /candidate', [
+            raw_request(b'POST', b'/candidate', {'candidate': candidate_name(candidates + i + 1)})
+            for i in range(count)],
+            b'HTTP/1.1 201'),
+        ('GET /candidates', [raw_request(b'GET', b'/candidates')] * count, b'HTTP/1.1 200'),
+    ]
+
+def run(client, requests, expected):
+    for data in requests:
+        response = client(data)
+        assert response.startswith(expected), response[:200]
+
+def handler_time(stats):
+    """
+    :return: seconds spent in the `Jsonify` wrappers, the handlers and
+        encoding their responses, leaving out HTTP and routing.
+    """
+    return sum(
+        cumulative for (filename, line, function), (calls, primitive, total, cumulative, callers)
+        in stats.stats.items() if function == 'deco' and 'klein' not in filename)
+
+def measure(api_class, requests, expected, options):
+    """
+    :return: `(CPU seconds, handler seconds, function calls)` per request,
+        the fastest of `repeat` runs, and the last run's profile.
+    """
+    cpu = []
+    for i in range(options['repeat']):
+        client = build(api_class, options['candidates'])
+        gc.disable()    # as timeit does, collections land on either version
+        try:
+            start = time.process_time()
+            run(client, requests, expected)
+            cpu.append((time.process_time() - start) / len(requests))
+        finally:
+            gc.enable()
+
+    client = build(api_class, options['candidates'])
+    profile = cProfile.Profile()
+    profile.runcall(run, client, requests, expected)
+    stats = pstats.Stats(profile)
+    count = float(len(requests))
+    return (min(cpu), handler_time(stats) / count, stats.total_calls / count), stats
+
+def main(options):
+    apis = [('inlineCallbacks', LegacyVoteApi), ('flat', VoteApi)]
+    print('%-16s %-16s %12s %12s %14s' % (
+        'route', 'handlers', 'us/request', 'us/handler', 'calls/request'))
+    for route, requests, expected in workloads(options):
+        results = {}
+        for name, api_class in apis:
+            results[name], stats = measure(api_class, requests, expected, options)
+            cpu, handler, calls = results[name]
+            print('%-16s %-16s %12.1f %12.1f %14.0f' % (route, name, cpu * 1e6, handler * 1e6, calls))
+            if options['top'] and api_class is VoteApi:
+                stats.sort_stats('cumulative').print_stats(options['top'])
+        before, after = results['inlineCallbacks'], results['flat']
+        print('%-16s %-16s %11.0f%% %11.0f%%\n' % (
+            route, 'saved', (1 - after[0] / before[0]) * 100, (1 - after[1] / before[1]) * 100))
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    main(options)
@@ -0,0 +1,66 @@
+"""
+Compare vote throughput with the default and the "throughput" SQLite pragma
+profiles. Run from the repository root:
+
+    python -m benchmarks.pragmas --votes 5000 --concurrency 50
+"""
+from __future__ import print_function
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import time
+
+from twisted.internet import defer, task
+from twisted.python.usage import Options
+
+from database import Database, Candidates, Votes, PRAGMA_PROFILES, connection_pool
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['votes', 'n', 5000, 'Votes per profile', int],
+        ['concurrency', 'c', 50, 'Votes in flight at once', int],
+        ['candidates', None, 10, 'Number of candidates', int],
+    ]
+
+@defer.inlineCallbacks
+def votes_per_second(dbpath, pragmas, votes, concurrency, candidate_count):
+    dbpool = connection_pool(dbpath, pragmas)
+    db = Database(dbpool)
+    candidates = Candidates(db)
+    votes_model = Votes(db, candidates)
+    yield candidates.create_table()
+    yield votes_model.create_table()
+    for i in range(candidate_count):
+        yield candidates.add_candidate('Candidate %s' % (chr(ord('a') + i % 26) * (i // 26 + 1)))
+
+    def vote(i):
+        return votes_model.vote_for(i % candidate_count + 1)
+
+    start = time.time()
+    cooperator = task.Cooperator()
+    work = (vote(i) for i in range(votes))
+    yield defer.gatherResults([cooperator.coiterate(work) for i in range(concurrency)])
+    elapsed = time.time() - start
+    dbpool.close()
+    defer.returnValue(votes / elapsed)
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    tmpdir = mkdtemp()
+    try:
+        results = {}
+        for profile in ('default', 'throughput'):
+            dbpath = path.join(tmpdir, '%s.sqlite' % (profile))
+            results[profile] = yield votes_per_second(
+                dbpath, PRAGMA_PROFILES[profile], options['votes'],
+                options['concurrency'], options['candidates'])
+            print('%-10s %8.0f votes/sec' % (profile, results[profile]))
+        print('speedup    %8.2fx' % (results['throughput'] / results['default']))
+    finally:
+        rmtree(tmpdir)
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    task.react(main, (options,))
@@ -0,0 +1,94 @@
+"""
+Time encoding the leaderboard the way `TallyCache` used to (a list of dicts
+through `json.dumps`, then encoded to UTF-8) against every installed
+serializer, whole and in chunks, and the constant status responses. Peak
+memory is what the Python allocator saw while encoding. Run
+from the repository root:
+
+    python -m benchmarks.serialize --candidates 10000
+"""
+from __future__ import print_function
+import json
+import timeit
+import tracemalloc
+
+from twisted.python.usage import Options
+
+from benchmarks.api import candidate_name
+import serializers
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['candidates', 'n', 10000, 'Candidates in the leaderboard', int],
+        ['repeat', 'r', 5, 'Runs of each encoder, the best is reported', int],
+        ['chunk-size', None, serializers.CHUNK_SIZE, 'Candidates per chunk', int],
+    ]
+
+def legacy(entries):
+    candidates = []
+    for candidate_id, (name, votes) in entries.items():
+        candidates.append({'id': candidate_id, 'name': name, 'votes': votes})
+    return json.dumps({'candidates': candidates}).encode('utf-8')
+
+def whole(dumps):
+    def encode(entries):
+        return dumps({'candidates': [
+            {'id': candidate_id, 'name': name, 'votes': votes}
+            for candidate_id, (name, votes) in entries.items()]})
+    return encode
+
+def chunked(dumps, chunk_size):
+    def encode(entries):
+        candidates = (
+            {'id': candidate_id, 'name': name, 'votes': votes}
+            for candidate_id, (name, votes) in entries.items())
+        return b''.join(serializers.encode_list('candidates', candidates, chunk_size, dumps))
+    return encode
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def best(function, repeat, number=1):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+def main(options):
+    entries = dict(
+        (i, [candidate_name(i), (i * 7919) % 100000]) for i in range(1, options['candidates'] + 1))
+    expected = json.loads(legacy(entries).decode('utf-8'))
+
+    encoders = [('json.dumps + encode', legacy)]
+    for name in sorted(serializers.SERIALIZERS):
+        dumps = serializers.SERIALIZERS[name]
+        encoders.append((name, whole(dumps)))
+        encoders.append(('%s chunked' % (name), chunked(dumps, options['chunk-size'])))
+
+    print('Leaderboard of %d candidates, %d KiB' % (
+        len(entries), len(legacy(entries)) // 1024))
+    print('%-22s %10s %9s %10s' % ('encoder', 'ms', 'speedup', 'peak KiB'))
+    baseline = None
+    for name, encode in encoders:
+        assert json.loads(encode(entries).decode('utf-8')) == expected, name
+        elapsed = best(lambda: encode(entries), options['repeat'])
+        baseline = baseline or elapsed
+        peak = peak_memory(lambda: encode(entries))
+        print('%-22s %10.2f %8.2fx %10d' % (name, elapsed * 1000, baseline / elapsed, peak // 1024))
+
+    status = {'status': 'Success'}
+    constant = serializers.dumps(status)
+    number = 100000
+    print('\n{"status": "Success"} per response, %d responses' % (number))
+    print('%-22s %10.3f us' % ('json.dumps', best(lambda: json.dumps(status), 3, number) * 1e6))
+    print('%-22s %10.3f us' % (
+        'serializers.dumps', best(lambda: serializers.dumps(status), 3, number) * 1e6))
+    print('%-22s %10.3f us' % ('pre-encoded', best(lambda: constant, 3, number) * 1e6))
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    main(options)
@@ -0,0 +1,90 @@
+"""
+Compare vote throughput of the plain and the sharded votes table when most
+votes go to a handful of candidates. Run from the repository root:
+
+    python -m benchmarks.shards --votes 5000 --concurrency 50 --shards 8
+
+Votes follow a Zipf-like distribution, `--skew` 0 is uniform and larger
+values concentrate the votes on the first candidates.
+"""
+from __future__ import print_function
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import random
+import time
+
+from twisted.internet import defer, task
+from twisted.python.usage import Options
+
+from database import Database, Candidates, ShardedVotes, Votes, PRAGMA_PROFILES, connection_pool
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['votes', 'n', 5000, 'Votes per layout', int],
+        ['concurrency', 'c', 50, 'Votes in flight at once', int],
+        ['candidates', None, 10, 'Number of candidates', int],
+        ['shards', None, 8, 'Shards per candidate for the sharded layout', int],
+        ['skew', None, 1.5, 'Zipf exponent of the vote distribution', float],
+        ['sqlite-profile', None, 'throughput', 'SQLite pragma profile'],
+    ]
+
+def skewed_ids(votes, candidate_count, skew, seed=0):
+    """
+    :return: candidate ids where candidate `k` is drawn with weight `1/k^skew`.
+    """
+    weights = [1.0 / (k ** skew) for k in range(1, candidate_count + 1)]
+    rng = random.Random(seed)
+    return rng.choices(range(1, candidate_count + 1), weights, k=votes)
+
+@defer.inlineCallbacks
+def votes_per_second(dbpath, pragmas, votes_model, candidate_ids, concurrency, candidate_count):
+    dbpool = connection_pool(dbpath, pragmas)
+    db = Database(dbpool)
+    candidates = Candidates(db)
+    votes = votes_model(db, candidates)
+    yield candidates.create_table()
+    yield votes.create_table()
+    for i in range(candidate_count):
+        yield candidates.add_candidate('Candidate %s' % (chr(ord('a') + i % 26) * (i // 26 + 1)))
+
+    start = time.time()
+    cooperator = task.Cooperator()
+    work = (votes.vote_for(candidate_id) for candidate_id in candidate_ids)
+    yield defer.gatherResults([cooperator.coiterate(work) for i in range(concurrency)])
+    elapsed = time.time() - start
+
+    totals = yield votes.all_vote_totals()
+    dbpool.close()
+    assert sum(total or 0 for _, _, total in totals) == len(candidate_ids), 'Votes were lost'
+    defer.returnValue(len(candidate_ids) / elapsed)
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    candidate_ids = skewed_ids(options['votes'], options['candidates'], options['skew'])
+    top = max(set(candidate_ids), key=candidate_ids.count)
+    print('%d votes, %.0f%% for the leading candidate' % (
+        len(candidate_ids), 100.0 * candidate_ids.count(top) / len(candidate_ids)))
+
+    layouts = [
+        ('plain', Votes),
+        ('sharded', lambda db, candidates: ShardedVotes(db, candidates, options['shards'])),
+    ]
+    tmpdir = mkdtemp()
+    try:
+        results = {}
+        for name, votes_model in layouts:
+            results[name] = yield votes_per_second(
+                path.join(tmpdir, '%s.sqlite' % (name)),
+                PRAGMA_PROFILES[options['sqlite-profile']], votes_model, candidate_ids,
+                options['concurrency'], options['candidates'])
+            print('%-10s %8.0f votes/sec' % (name, results[name]))
+        print('speedup    %8.2fx' % (results['sharded'] / results['plain']))
+    finally:
+        rmtree(tmpdir)
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    task.react(main, (options,))
@@ -0,0 +1,196 @@
+"""
+Load test `manage.py --runserver --workers N` and report how throughput
+scales with the number of worker processes. Run from the repository root:
+
+    python -m benchmarks.workers --workers 1,2,4 --requests 20000 --concurrency 64
+
+Each run starts a server on a fresh database, drives it with a mix of
+`GET /api/candidates` and `POST /api/vote` from several client processes
+and afterwards checks that every acknowledged vote reached the shared
+database. Scaling is bounded by the cores available to the server and the
+clients together, run the clients on another machine for clean numbers.
+"""
+from __future__ import print_function
+from multiprocessing import Pool, cpu_count
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import os
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+from twisted.python.usage import Options
+
+from database import Candidates, Votes
+
+class BenchmarkOptions(Options):
+
+    optParameters = [
+        ['workers', 'w', '1,2,4', 'Comma separated worker counts to compare'],
+        ['requests', 'n', 20000, 'Requests per run', int],
+        ['concurrency', 'c', 64, 'Connections kept busy at once', int],
+        ['clients', None, max(1, cpu_count() // 2), 'Client processes generating the load', int],
+        ['write-ratio', None, 0.5, 'Share of requests that are votes', float],
+        ['candidates', None, 10, 'Number of candidates', int],
+        ['port', 'P', 8790, 'Port for the server under test', int],
+    ]
+
+def create_database(dbpath, candidate_count):
+    candidates = Candidates(None)
+    votes = Votes(None, candidates)
+    connection = sqlite3.connect(dbpath)
+    connection.execute(candidates.create_stmt.sql)
+    connection.execute(votes.create_stmt.sql)
+    connection.executemany(candidates.insert_stmt.sql, [
+        ('Candidate %s' % (chr(ord('a') + i % 26) * (i // 26 + 1)),) for i in range(candidate_count)])
+    connection.commit()
+    connection.close()
+
+def total_votes(dbpath):
+    connection = sqlite3.connect(dbpath)
+    total = connection.execute('select coalesce(sum(votes), 0) from votes').fetchone()[0]
+    connection.close()
+    return total
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start listening on port %d' % (port))
+
+def run_client(args):
+    """
+    Issue `requests` requests over `connections` keep-alive connections.
+
+    :return: `(votes accepted, errors, latencies)`
+    """
+    port, requests, connections, write_ratio, candidate_count, seed = args
+    lock = threading.Lock()
+    remaining = [requests]
+    results = {'votes': 0, 'errors': 0, 'latencies': []}
+
+    def connection_loop(index):
+        rng = random.Random(seed * 1000 + index)
+        conn = HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies, votes, errors = [], 0, 0
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+            vote = rng.random() < write_ratio
+            start = time.time()
+            try:
+                if vote:
+                    body = 'id=%d' % (rng.randint(1, candidate_count))
+                    conn.request('POST', '/api/vote', body, {
+                        'Content-Type': 'application/x-www-form-urlencoded'})
+                else:
+                    conn.request('GET', '/api/candidates')
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (socket.error, IOError):
+                conn.close()
+                conn = HTTPConnection('127.0.0.1', port, timeout=30)
+                ok = False
+            latencies.append(time.time() - start)
+            if not ok:
+                errors += 1
+            elif vote:
+                votes += 1
+        conn.close()
+        with lock:
+            results['votes'] += votes
+            results['errors'] += errors
+            results['latencies'].extend(latencies)
+
+    threads = [threading.Thread(target=connection_loop, args=(i,)) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results['votes'], results['errors'], results['latencies']
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(options, workers, tmpdir):
+    dbpath = path.join(tmpdir, 'workers-%d.sqlite' % (workers))
+    create_database(dbpath, options['candidates'])
+    devnull = open(os.devnull, 'w')     # the access log would fill a pipe
+    server = subprocess.Popen([
+        sys.executable, 'manage.py', '--runserver', '--db', dbpath,
+        '--port', str(options['port']), '--workers', str(workers),
+        '--sqlite-profile', 'throughput'],
+        stdout=devnull, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(options['port'])
+        clients = options['clients']
+        connections = max(1, options['concurrency'] // clients)
+        jobs = [(
+            options['port'], options['requests'] // clients, connections,
+            options['write-ratio'], options['candidates'], seed) for seed in range(clients)]
+
+        pool = Pool(clients)
+        start = time.time()
+        results = pool.map(run_client, jobs)
+        elapsed = time.time() - start
+        pool.close()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        devnull.close()
+
+    votes = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    latencies = [latency for result in results for latency in result[2]]
+    stored = total_votes(dbpath)
+    assert stored == votes, 'Acknowledged %d votes but %d were stored' % (votes, stored)
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'errors': errors,
+    }
+
+def main(options):
+    counts = [int(count) for count in options['workers'].split(',')]
+    print('%d requests, %d connections from %d client processes, %d cores' % (
+        options['requests'], options['concurrency'], options['clients'], cpu_count()))
+    print('%-8s %10s %9s %9s %7s %8s %11s' % (
+        'workers', 'req/sec', 'p50 ms', 'p99 ms', 'errors', 'speedup', 'efficiency'))
+
+    tmpdir = mkdtemp()
+    try:
+        baseline = None
+        for workers in counts:
+            result = run(options, workers, tmpdir)
+            baseline = baseline or result['rps'] / workers
+            speedup = result['rps'] / baseline
+            print('%-8d %10.0f %9.1f %9.1f %7d %7.2fx %10.0f%%' % (
+                workers, result['rps'], result['p50'], result['p99'], result['errors'],
+                speedup, 100 * speedup / workers))
+    finally:
+        rmtree(tmpdir)
+
+if __name__ == '__main__':
+    options = BenchmarkOptions()
+    options.parseOptions()
+    main(options)
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from hashlib import blake2b
+
+from twisted.internet import defer
+from zope.interface import implementer
+
+from interfaces import ITallyObserver
+from serializers import encode_list
+
+@implementer(ITallyObserver)
+class TallyCache(object):
+    """
+    In-process copy of the candidate leaderboard along with its serialized
+    JSON response.
+
+    The cache is filled from the database on a miss and from then on it's
+    kept current by the `nominated`/`voted` notifications sent by
+    `Candidates` and `Votes`, so polling reads don't touch the database
+    while it's warm. Vote notifications carry the committed total, which
+    makes them safe to apply in any order. `ttl` bounds how stale the copy
+    may get when another process writes to the same database.
+
+    The strong `etag` is a hash of the serialized response, so every
+    process serving the same tally, workers included, gives it the same
+    tag and a different tally never shares one.
+    """
+
+    def __init__(self, ttl=30, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.entries = None     # candidate id -> [name, votes]
+        self.body = None        # serialized response, rebuilt lazily
+        self.loaded_at = None
+        self.modified = clock.seconds()
+        self.digest = None      # hash of the last serialized response
+        self._loading = None
+        self._replay = []
+
+    @property
+    def warm(self):
+        if self.entries is None or self.loaded_at is None or not self.ttl:
+            return False
+        return self.clock.seconds() - self.loaded_at < self.ttl
+
+    @property
+    def etag(self):
+        if self.body is None and self.entries is not None:
+            self.serialize()
+        return '"%s"' % (self.digest)
+
+    def bump(self):
+        self.modified = self.clock.seconds()
+
+    def invalidate(self):
+        self.entries = None
+        self.body = None
+
+    def cached(self):
+        """
+        :return: The serialized leaderboard while the cache is warm, else
+            `None`.
+        """
+        if self.warm:
+            self.hits += 1
+            return self.serialize()
+        return None
+
+    def fetch(self, load):
+        """
+        Get the serialized leaderboard.
+
+        :param load: Callable returning a `Deferred` that fires with
+            `(id, name, votes)` rows, used on a cache miss.
+        :return: `Deferred` firing with the JSON response as `bytes`.
+        """
+        body = self.cached()
+        if body is not None:
+            return defer.succeed(body)
+
+        self.misses += 1
+        waiter = defer.Deferred()
+        if self._loading is not None:
+            # only one query is sent no matter how many reads miss at once
+            self._loading.append(waiter)
+            return waiter
+
+        self._loading = [waiter]
+        self._replay = []
+        d = defer.maybeDeferred(load)
+        d.addCallbacks(self._loaded, self._load_failed)
+        return waiter
+
+    def _loaded(self, rows):
+        waiters, self._loading = self._loading, None
+        entries = OrderedDict()
+        for candidate_id, name, votes in rows:
+            entries[candidate_id] = [name, votes or 0]
+        self.entries = entries
+        self.body = None
+        self.loaded_at = self.clock.seconds()
+
+        # apply changes that were committed while the query was running
+        replay, self._replay = self._replay, []
+        for event in replay:
+            event[0](*event[1:])
+
+        previous, body = self.digest, self.serialize()
+        if self.digest != previous:
+            # the database has changes this process wasn't told about
+            self.bump()
+        if not self.ttl:
+            self.invalidate()
+        for waiter in waiters:
+            waiter.callback(body)
+
+    def _load_failed(self, failure):
+        waiters, self._loading = self._loading, None
+        for waiter in waiters:
+            waiter.errback(failure)
+
+    def serialize(self):
+        if self.body is None:
+            candidates = (
+                {'id': candidate_id, 'name': name, 'votes': votes}
+                for candidate_id, (name, votes) in self.entries.items())
+            self.body = b''.join(encode_list('candidates', candidates))
+            self.digest = blake2b(self.body, digest_size=16).hexdigest()
+        return self.body
+
+    def nominated(self, candidate_id, name):
+        self.bump()
+        if self._loading is not None:
+            self._replay.append((self._add_entry, candidate_id, name))
+        self._add_entry(candidate_id, name)
+
+    def voted(self, candidate_id, count, total):
+        self.bump()
+        if self._loading is not None:
+            self._replay.append((self._set_total, candidate_id, total))
+        self._set_total(candidate_id, total)
+
+    def _add_entry(self, candidate_id, name):
+        if self.entries is not None and candidate_id not in self.entries:
+            self.entries[candidate_id] = [name, 0]
+            self.body = None
+
+    def _set_total(self, candidate_id, total):
+        if self.entries is None:
+            return
+        entry = self.entries.get(candidate_id)
+        if entry is None:
+            # a candidate this process hasn't seen, reload on the next read
+            self.loaded_at = None
+        elif total > entry[1]:
+            entry[1] = total
+            self.body = None
@@ -1,11 +1,95 @@
+from array import array
+from collections import defaultdict
+from numbers import Integral
+import base64
 import json
+import math
 
 from klein import Klein
 from twisted.internet import defer
+from twisted.python import log
+from twisted.web import http
 from werkzeug.exceptions import NotFound
 
+from cache import TallyCache
 from database import Candidates, Votes
-from middleware import Jsonify
+from ingest import MalformedRecord, read_records
+from middleware import Jsonify, encoded
+from ratelimit import client_key
+from search import NameIndex
+from stream import Broadcaster
+
+MAX_PAGE = 1000     # candidates per page
+DEFAULT_PAGE = 100
+MAX_MATCHES = 100   # search results
+MAX_POINTS = 1440   # slots in a vote history, a day of minutes
+MAX_BULK_COUNT = 10 ** 6    # votes in one bulk record
+MAX_BULK_VOTES = 10 ** 9    # votes for one candidate in one bulk request
+
+# constant responses, encoded once
+ALREADY_VOTED = encoded({'status': 'Already Voted'})
+CREATED = encoded({'status': 'Created'})
+BULK_DISABLED = encoded({'status': 'Bulk Votes Not Allowed'})
+DATABASE_ISSUE = encoded({'status': 'Database Issue'})
+DATABASE_ISSUES = encoded({'status': 'Database Issues'})
+INVALID_INPUT = encoded({'status': 'Invalid User Input'})
+MISSING_INPUT = encoded({'status': 'Missing Prerequisite Input'})
+NOT_AVAILABLE = encoded({'status': 'Resource Not Available'})
+SUCCESS = encoded({'status': 'Success'})
+TOO_MANY_REQUESTS = encoded({'status': 'Too Many Requests'})
+
+def encode_cursor(order, key):
+    """
+    An opaque cursor resuming a listing after the row with `key`.
+    """
+    data = json.dumps([order, key], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+def decode_cursor(cursor, order):
+    """
+    :return: the key of a cursor made by `encode_cursor` for `order`.
+    :raises ValueError: the cursor is malformed or belongs to another order.
+    """
+    try:
+        cursor_order, key = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if cursor_order != order:
+        raise ValueError('Cursor is for another order')
+    if order == 'name' and isinstance(key, str):
+        return key
+    if order == 'votes' and isinstance(key, list) and len(key) == 2 and \
+            all(isinstance(value, int) and not isinstance(value, bool) for value in key):
+        return tuple(key)
+    raise ValueError('Invalid cursor')
+
+def page_params(args):
+    """
+    Read `order`, `limit`, `after` and `top` from the query string.
+
+    :return: `(order, limit, after, top)`
+    :raises ValueError: on invalid or conflicting parameters.
+    """
+    def single(name):
+        values = args.get(name)
+        return values[0].decode('utf-8') if values else None
+
+    order = single(b'order') or 'votes'
+    if order not in ('votes', 'name'):
+        raise ValueError('Unknown order')
+    top = single(b'top')
+    limit = single(b'limit')
+    after = single(b'after')
+    if top is not None:
+        if limit is not None or after is not None or order != 'votes':
+            raise ValueError('top can\'t be combined with paging')
+        limit = top
+    limit = int(limit) if limit is not None else DEFAULT_PAGE
+    if not 0 < limit <= MAX_PAGE:
+        raise ValueError('Page size out of range')
+    if after is not None:
+        after = decode_cursor(after.encode('ascii'), order)
+    return order, limit, after, top is not None
 
 class VoteApi(object):
     """
@@ -16,9 +100,38 @@ class VoteApi(object):
     router = Klein()
     jsonify = Jsonify(router)
 
-    def __init__(self, database):
-        self.candidates = Candidates(database)
-        self.votes = Votes(database, self.candidates)
+    def __init__(self, database, cache_ttl=30, candidates=None, votes=None,
+            limiter=None, voters=None, client_cookie=None):
+        # sqlite tables unless another ICandidates/IVotes backend is given
+        self.candidates = candidates or Candidates(database)
+        self.votes = votes or Votes(database, self.candidates)
+
+        # leaderboard kept current by the write paths
+        self.cache = TallyCache(cache_ttl)
+        self.candidates.observers.append(self.cache)
+        self.votes.observers.append(self.cache)
+
+        # prefix search over candidate names
+        self.names = NameIndex(cache_ttl)
+        self.candidates.observers.append(self.names)
+
+        # live results streams
+        self.broadcaster = Broadcaster()
+
+        self.candidates.observers.append(self.broadcaster)
+        self.votes.observers.append(self.broadcaster)
+
+        # request timings, recorded by `Jsonify` once the application sets it
+        self.metrics = None
+
+        # abuse protection: a `RateLimiter` for the write endpoints and a
+        # `VoterFilter` allowing one vote per client
+        self.limiter = limiter
+        self.voters = voters
+        self.client_cookie = client_cookie
+
+        # a `VoteHistory` recording votes over time, set by the application
+        self.history = None
 
     def resource(self):
         return self.router.resource()
@@ -27,43 +140,256 @@ class VoteApi(object):
     def page_not_found(self, request, failure):
         request.setResponseCode(404)
         request.setHeader('Content-Type', 'application/json')
-        response = {'status': 'Resource Not Available'}
-        return json.dumps(response)
+        return NOT_AVAILABLE
 
     @jsonify.route('/candidates', methods=['GET'])
     def get_candidates(self, request):
         """
-        Get a list of candidates.
+        Get a list of candidates. Supports conditional requests through
+        the `ETag`/`If-None-Match` and `Last-Modified`/`If-Modified-Since`
+        headers; an unchanged tally is answered with `304 Not Modified`.
+
+        With any of `order` (`votes` or `name`), `limit`, `after` or `top`
+        in the query string, a page is read from the database instead, see
+        `get_candidates_page`.
 
         :return: `{candidates: []}`
         """
-        d = self.votes.all_vote_totals()
+        if any(name in request.args for name in (b'order', b'limit', b'after', b'top')):
+            return self.get_candidates_page(request)
+
+        if self.cache.warm and self.not_modified(request):
+            return None     # client is current, skip the database entirely
+
+        body = self.cache.cached()
+        if body is not None:
+            return body     # no Deferred when the cache is warm
+
+        d = self.cache.fetch(self.votes.all_vote_totals)
+
+        @d.addCallback
+        def conditional(body, req=request):
+            if self.not_modified(req):
+                return None
+            return body
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # database error, a good spot to log
+            req.setResponseCode(400)
+            return DATABASE_ISSUES
+
+        return d
+
+    def get_candidates_page(self, request):
+        """
+        One page of candidates, `limit` (default 100, at most 1000) at a
+        time. `after` takes the `next` cursor of the previous page, which is
+        null on the last one. `top=N` gets the N leaders and no cursor.
+
+        :return: `{candidates: [], next: cursor}`
+        """
+        try:
+            order, limit, after, top = page_params(request.args)
+        except ValueError:
+            request.setResponseCode(412)
+            return INVALID_INPUT
+
+        d = defer.maybeDeferred(self.votes.vote_totals_page, order, limit, after)
+
+        @d.addCallback
+        def page(rows):
+            candidates = [
+                {'id': candidate_id, 'name': name, 'votes': votes or 0}
+                for candidate_id, name, votes in rows]
+            if top:
+                return {'candidates': candidates}
+            cursor = None
+            if len(rows) == limit:
+                last = candidates[-1]
+                key = last['name'] if order == 'name' else [last['votes'], last['id']]
+                cursor = encode_cursor(order, key)
+            return {'candidates': candidates, 'next': cursor}
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # database error, a good spot to log
+            req.setResponseCode(400)
+            return DATABASE_ISSUES
+
+        return d
+
+    @jsonify.route('/candidates/search', methods=['GET'])
+    def search_candidates(self, request):
+        """
+        Find candidates whose name starts with `q`, ignoring case, in name
+        order. Served from the in-memory `NameIndex` while it's warm, from
+        the database's name index otherwise.
+
+        :param q: Name prefix.
+        :param limit: Maximum number of matches, 10 by default.
+        :return: `{candidates: [{id, name}]}`
+        """
+        try:
+            prefix = request.args[b'q'][0].decode('utf-8')
+            limit = int(request.args.get(b'limit', [10])[0])
+        except (KeyError, IndexError, ValueError):
+            prefix, limit = None, 0
+        if not prefix or not 0 < limit <= MAX_MATCHES:
+            request.setResponseCode(412)
+            return INVALID_INPUT
+
+        if self.names.warm:
+            return self.matches(self.names.search(prefix, limit))
+
+        self.names.refresh(self.candidates.all_candidates)
+        d = defer.maybeDeferred(self.candidates.search, prefix, limit)
+        d.addCallback(self.matches)
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # database error, a good spot to log
+            req.setResponseCode(400)
+            return DATABASE_ISSUES
+
+        return d
+
+    def matches(self, records):
+        return {'candidates': [
+            {'id': candidate_id, 'name': name} for candidate_id, name in records]}
+
+    @jsonify.route('/candidates/<int:candidate_id>/history', methods=['GET'])
+    def candidate_history(self, request, candidate_id):
+        """
+        Votes for a candidate over time, in `step` second slots. Long
+        ranges are read from the hourly or daily rollups.
+
+        :param from: Unix time of the first slot, an hour ago by default.
+        :param to: Unix time the last slot ends by, now by default.
+        :param step: Seconds per slot, a multiple of 60 (the default).
+        :return: `{id, from, step, votes: []}`
+        """
+        if self.history is None:
+            request.setResponseCode(404)
+            return NOT_AVAILABLE
+        try:
+            end = int(request.args.get(b'to', [self.history.clock.seconds()])[0])
+            start = int(request.args.get(b'from', [end - 3600])[0])
+            step = int(request.args.get(b'step', [60])[0])
+        except ValueError:
+            start, end, step = 0, 0, 0
+        if not (0 <= start < end and step > 0 and step % 60 == 0) or \
+                -(-(end - start) // step) > MAX_POINTS:
+            request.setResponseCode(412)
+            return INVALID_INPUT
+
+        try:
+            d = self.history.history(candidate_id, start, end, step)
+        except ValueError:
+            # older than the finer tables keep
+            request.setResponseCode(412)
+            return INVALID_INPUT
+
         @d.addCallback
-        def db_to_json(results):
-            """
-            Encapsulate the db results to JSON.
-            """
-            candidates = []
-            for record in results:
-                record_id, name, votes = record
-                if votes is None:
-                    votes = 0
-                candidates.append({
-                    'id': record_id,
-                    'name': name,
-                    'votes': votes})
-            return {'candidates': candidates}
+        def slots(result):
+            first, votes = result
+            return {'id': candidate_id, 'from': first, 'step': step, 'votes': votes}
 
         @d.addErrback
         def database_failure(failure, req=request):
             # database error, a good spot to log
             req.setResponseCode(400)
-            return {'status': 'Database Issues'}
+            return DATABASE_ISSUES
 
         return d
 
+    @router.route('/candidates/stream', methods=['GET'])
+    def stream_candidates(self, request):
+        """
+        Stream the tally as server-sent events. The first event holds every
+        candidate, later events only the candidates that changed.
+
+        :return: `text/event-stream` of `{candidates: []}` events, `503`
+            when the first snapshot can't be loaded.
+        """
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.setHeader('X-Accel-Buffering', 'no')    # don't buffer in nginx
+
+        subscriber = self.broadcaster.subscribe(request)
+        d = self.cache.fetch(self.votes.all_vote_totals)
+
+        @d.addCallback
+        def snapshot(body):
+            subscriber.start(b'data: ' + body + b'\n\n')
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # nothing is written before the snapshot, the status can change
+            log.err(failure, 'Loading the tally for a results stream failed')
+            self.broadcaster.unsubscribe(subscriber)
+            req.setResponseCode(503)
+            req.setHeader('Content-Type', 'application/json')
+            req.write(DATABASE_ISSUES)
+            subscriber.done.callback(None)
+
+        return subscriber.done
+
+    def not_modified(self, request):
+        """
+        Set the cache validators of the current tally on the response.
+
+        :return: True when the client's copy is current, in which case the
+            response code is set to 304.
+        """
+        etag = self.cache.etag
+        modified = self.cache.modified
+        # Last-Modified has whole seconds: the second after the change once
+        # it's over, so a later change is always newer, the second of the
+        # change until then, which is never current
+        last_modified = math.ceil(modified)
+        if last_modified > self.cache.clock.seconds():
+            last_modified = math.floor(modified)
+        request.setHeader('ETag', etag)
+        request.setHeader('Last-Modified', http.datetimeToString(last_modified))
+
+        if_none_match = request.getHeader('If-None-Match')
+        if_modified_since = request.getHeader(b'If-Modified-Since')
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            current = etag in tags or '*' in tags
+        elif if_modified_since is not None:
+            try:
+                current = http.stringToDatetime(if_modified_since) >= modified
+            except (ValueError, IndexError):
+                current = False
+        else:
+            current = False
+
+        if current:
+            request.setResponseCode(http.NOT_MODIFIED)
+        return current
+
+    def throttled(self, request):
+        """
+        Take a token from the client's bucket.
+
+        :return: True when the client is over its rate, in which case the
+            response code is set to 429 along with `Retry-After`.
+        """
+        if self.limiter is None:
+            return False
+        delay = self.limiter.delay(client_key(request, self.client_cookie))
+        if not delay:
+            return False
+        request.setResponseCode(429)
+        request.setHeader('Retry-After', str(int(math.ceil(delay))))
+        if self.metrics is not None:
+            self.metrics.rejected.inc(reason='rate limited')
+        return True
+
     @jsonify.route('/candidate', methods=['POST'])
-    @defer.inlineCallbacks
     def add_candidate(self, request):
         """
         Add a candidate to the system.
@@ -72,47 +398,280 @@ class VoteApi(object):
         :type candidate: str
         :return: `{"status": "message"}`
         """
+        if self.throttled(request):
+            return TOO_MANY_REQUESTS
+
         if b'candidate' not in request.args:
             request.setResponseCode(412)
-            return {'status': 'Missing Prerequisite Input'}
+            return MISSING_INPUT
 
         name = request.args[b'candidate'][0]
         try:
-            yield self.candidates.add_candidate(name.decode('utf-8'))
-        except Exception as error:
+            d = defer.maybeDeferred(self.candidates.add_candidate, name.decode('utf-8'))
+        except UnicodeDecodeError:
+            d = defer.fail()
+
+        def created(candidate_id, req=request):
+            # successfully created a record in the db
+            req.setResponseCode(201)
+            return CREATED
+
+        def database_failure(failure, req=request):
             # database error, a good spot to log
-            request.setResponseCode(400)
-            defer.returnValue({'status': 'Database Issue'})
+            req.setResponseCode(400)
+            return DATABASE_ISSUE
 
-        # successfully created a record in the db
-        request.setResponseCode(201)
-        defer.returnValue({'status': 'Created'})
+        return d.addCallbacks(created, database_failure)
 
     @jsonify.route('/vote', methods=['POST'])
-    @defer.inlineCallbacks
     def vote_for(self, request):
         """
-        Vote for a candidate
+        Vote for a candidate. Clients over their rate get `429`, clients
+        that already voted `409` when one vote per client is enforced.
 
         :param id: Candidate id
         :type id: int
         :return: `{"status": "message"}`
         """
+        if self.throttled(request):
+            return TOO_MANY_REQUESTS
+
         if b'id' not in request.args:
             request.setResponseCode(412)
-            defer.returnValue({'status': 'Invalid User Input'})
+            return INVALID_INPUT
+
+        voter = None
+        if self.voters is not None:
+            voter = client_key(request, self.client_cookie)
+            if not self.voters.begin(voter):
+                request.setResponseCode(409)
+                if self.metrics is not None:
+                    self.metrics.rejected.inc(reason='already voted')
+                return ALREADY_VOTED
 
         try:
-            candidate_id = int(request.args[b'id'][0])
-            yield self.votes.vote_for(candidate_id)
-        except (IndexError, ValueError):
-            # either the id param isn't an int (ValueError)
-            # or the id isn't in the db (IndexError)
+            d = defer.maybeDeferred(self.votes.vote_for, int(request.args[b'id'][0]))
+        except ValueError:
+            d = defer.fail()    # the id param isn't an int
+
+        def counted(total):
+            if voter is not None:
+                self.voters.end(voter, True)
+            return SUCCESS
+
+        def not_counted(failure, req=request):
+            if voter is not None:
+                self.voters.end(voter, False)
+            if failure.check(IndexError, ValueError):
+                # either the id param isn't an int (ValueError)
+                # or the id isn't in the db (IndexError)
+                req.setResponseCode(412)
+                return INVALID_INPUT
+            # database error, a good spot to log
+            req.setResponseCode(400)
+            return DATABASE_ISSUE
+
+        return d.addCallbacks(counted, not_counted)
+
+    @jsonify.route('/votes/bulk', methods=['POST'])
+    def bulk_vote(self, request):
+        """
+        Add votes in bulk. The body is a JSON array or newline-delimited
+        JSON of `{"id": candidate_id, "count": votes}` records (`count`
+        defaults to 1, at most `MAX_BULK_COUNT`, and records taking a
+        candidate past `MAX_BULK_VOTES` are rejected). Every vote is
+        applied in one transaction. Each record costs a token of the
+        client's rate, the first before the body is read, and bulk votes
+        are refused with `403` when one vote per client is enforced.
+
+        :return: `{"status": "message", "accepted": records, "votes": total,
+            "rejected": [{"record": index, "status": "message"}]}`
+        """
+        if self.voters is not None:
+            request.setResponseCode(403)
+            if self.metrics is not None:
+                self.metrics.rejected.inc(reason='bulk votes')
+            return BULK_DISABLED
+
+        # clients over their rate are turned away before the body is read
+        if self.throttled(request):
+            return TOO_MANY_REQUESTS
+
+        counts = defaultdict(int)
+        record_ids = array('q')     # candidate id of each record, -1 if rejected
+        rejected = []
+
+        request.content.seek(0)
+        for index, record in enumerate(read_records(request.content)):
+            status = None
+            if isinstance(record, MalformedRecord):
+                status = record.reason
+            elif not isinstance(record, dict):
+                status = 'Invalid Record'
+            else:
+                candidate_id = record.get('id')
+                count = record.get('count', 1)
+                for value in (candidate_id, count):
+                    if not isinstance(value, Integral) or isinstance(value, bool):
+                        status = 'Invalid Record'
+                if status is None and not (0 <= candidate_id < 2 ** 63 and 1 <= count <= MAX_BULK_COUNT):
+                    status = 'Invalid Record'
+                if status is None and counts[candidate_id] + count > MAX_BULK_VOTES:
+                    status = 'Too Many Votes'
+
+            if status is not None:
+                record_ids.append(-1)
+                rejected.append({'record': index, 'status': status})
+            else:
+                record_ids.append(candidate_id)
+                counts[candidate_id] += count
+
+        if self.limiter is not None and len(record_ids) > 1:
+            # the first record was paid for up front
+            self.limiter.charge(client_key(request, self.client_cookie), len(record_ids) - 1)
+
+        if not record_ids:
+            request.setResponseCode(412)
+            return INVALID_INPUT
+
+        if counts:
+            d = defer.maybeDeferred(self.votes.add_votes, counts)
+        else:
+            d = defer.succeed([])   # nothing valid, skip the database
+
+        @d.addCallback
+        def report(missing, req=request):
+            missing = set(missing)
+            if missing:
+                for index, candidate_id in enumerate(record_ids):
+                    if candidate_id in missing:
+                        rejected.append({'record': index, 'status': 'Candidate Not Found'})
+                rejected.sort(key=lambda rejection: rejection['record'])
+
+            total = sum(count for candidate_id, count in counts.items()
+                if candidate_id not in missing)
+            return {
+                'status': 'Success',
+                'accepted': len(record_ids) - len(rejected),
+                'votes': total,
+                'rejected': rejected}
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # database error, a good spot to log
+            req.setResponseCode(400)
+            return DATABASE_ISSUE
+
+        return d
+
+class PollApi(object):
+    """
+    API for elections held side by side. Every poll is served by its own
+    `VoteApi`, with its own tables, cache and streams, under
+    `/<poll id>/`. Polls are looked up once and kept in a dict from then
+    on.
+    """
+
+    router = Klein()
+    jsonify = Jsonify(router)
+
+    def __init__(self, polls, cache_ttl=30, configure=None):
+        self.polls = polls
+        self.cache_ttl = cache_ttl
+        self.configure = configure  # called with every poll's new `VoteApi`
+        self.apis = {}              # poll id -> VoteApi
+        self.resources = {}         # poll id -> resource of its VoteApi
+
+        # request timings, recorded by `Jsonify` once the application sets it
+        self.metrics = None
+
+    def resource(self):
+        return self.router.resource()
+
+    @router.handle_errors(NotFound)
+    def page_not_found(self, request, failure):
+        request.setResponseCode(404)
+        request.setHeader('Content-Type', 'application/json')
+        return NOT_AVAILABLE
+
+    @jsonify.route('/', methods=['GET'], strict_slashes=False)
+    def get_polls(self, request):
+        """
+        :return: `{polls: [{id, name}]}`
+        """
+        d = defer.maybeDeferred(self.polls.all_polls)
+
+        @d.addCallback
+        def polls(rows):
+            return {'polls': [{'id': poll_id, 'name': name} for poll_id, name in rows]}
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # database error, a good spot to log
+            req.setResponseCode(400)
+            return DATABASE_ISSUES
+
+        return d
+
+    @jsonify.route('/', methods=['POST'], strict_slashes=False)
+    def add_poll(self, request):
+        """
+        Start a poll.
+
+        :param name: Name of the poll.
+        :type name: str
+        :return: `{"status": "message", "id": poll_id}`
+        """
+        if b'name' not in request.args:
             request.setResponseCode(412)
-            defer.returnValue({'status': 'Invalid User Input'})
-        except Exception as error:
+            return MISSING_INPUT
+
+        d = defer.maybeDeferred(self.polls.add_poll, request.args[b'name'][0].decode('utf-8'))
+
+        @d.addCallback
+        def created(poll_id, req=request):
+            req.setResponseCode(201)
+            return {'status': 'Created', 'id': poll_id}
+
+        @d.addErrback
+        def database_failure(failure, req=request):
+            # invalid or duplicate name, or a database error
+            req.setResponseCode(400)
+            return DATABASE_ISSUE
+
+        return d
+
+    @router.route('/<int:poll_id>', branch=True)
+    def poll(self, request, poll_id):
+        resource = self.resources.get(poll_id)
+        if resource is not None:
+            return resource
+
+        d = defer.maybeDeferred(self.polls.open_poll, poll_id)
+
+        @d.addCallback
+        def found(tables):
+            if poll_id not in self.resources:
+                # the first lookup to finish wins when several were waiting
+                api = self.vote_api(*tables)
+                self.apis[poll_id] = api
+                self.resources[poll_id] = api.resource()
+            return self.resources[poll_id]
+
+        @d.addErrback
+        def not_found(failure, req=request):
+            req.setHeader('Content-Type', 'application/json')
+            if failure.check(IndexError):
+                req.setResponseCode(404)
+                return NOT_AVAILABLE
             # database error, a good spot to log
-            request.setResponseCode(400)
-            defer.returnValue({'status': 'Database Issue'})
+            req.setResponseCode(400)
+            return DATABASE_ISSUES
+
+        return d
 
-        defer.returnValue({'status': 'Success'})
+    def vote_api(self, candidates, votes):
+        api = VoteApi(self.polls.db, self.cache_ttl, candidates, votes)
+        if self.configure is not None:
+            self.configure(api)
+        return api
@@ -1,9 +1,122 @@
 from __future__ import unicode_literals
+from collections import OrderedDict
 from numbers import Integral
+import random
 import re
+from timeit import default_timer as perf_counter
+from twisted.enterprise.adbapi import ConnectionPool
 from twisted.internet import defer
 from zope.interface import implementer
-from interfaces import ICandidates, IVotes
+from interfaces import ICandidates, IPolls, IVotes
+
+MAX_VARIABLES = 500     # bound parameters per statement, well below sqlite's limit
+MAX_INTEGER = 2 ** 63 - 1   # largest sqlite integer, the start of a descending keyset scan
+PREFIX_END = '\U0010ffff'   # sorts after any character a name may hold, closes a prefix range
+
+# connection settings applied through ConnectionPool's cp_openfun
+PRAGMA_PROFILES = {
+    'default': OrderedDict(),
+    'throughput': OrderedDict([
+        ('journal_mode', 'WAL'),        # readers don't block the writer
+        ('synchronous', 'NORMAL'),      # in WAL mode only checkpoints fsync
+        ('mmap_size', 268435456),
+        ('cache_size', -65536),         # negative values are KiB
+        ('busy_timeout', 5000),
+        ('temp_store', 'MEMORY'),
+    ]),
+}
+PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout', 'temp_store')
+
+def pragma_settings(profile='default', **overrides):
+    """
+    Combine a named profile with individual pragma overrides, ignoring
+    overrides set to `None`.
+    """
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError('Unknown pragma profile: %s' % (profile))
+    pragmas = OrderedDict(PRAGMA_PROFILES[profile])
+    for name, value in overrides.items():
+        if name not in PRAGMAS:
+            raise ValueError('Unsupported pragma: %s' % (name))
+        if value is not None:
+            pragmas[name] = value
+    for name, value in pragmas.items():
+        # pragma values can't be bound parameters, only accept plain words
+        if not re.match(r'^-?\w+$', str(value)):
+            raise ValueError('Invalid value for pragma %s: %r' % (name, value))
+    return pragmas
+
+def pragma_initializer(pragmas):
+    """
+    :return: A `cp_openfun` applying the pragmas to every new connection.
+    """
+    def apply_pragmas(connection):
+        cursor = connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('pragma %s=%s' % (name, value))
+        cursor.close()
+    return apply_pragmas
+
+def connection_pool(dbpath, pragmas=None, readonly=False, **kwargs):
+    """
+    Open a sqlite `ConnectionPool`, tuned with the given pragmas. The
+    connections of a `readonly` pool refuse to write.
+    """
+    if readonly:
+        pragmas = OrderedDict(pragmas or ())
+        pragmas['query_only'] = 1
+    if pragmas:
+        kwargs['cp_openfun'] = pragma_initializer(pragmas)
+    return ConnectionPool('sqlite3', dbpath, check_same_thread=False, **kwargs)
+
+def sharded_table(cursor, table_name):
+    """
+    :return: whether a votes table has the sharded layout, `None` when
+        there's no such table.
+    """
+    cursor.execute('pragma table_info(%s)' % (table_name))
+    columns = [column[1] for column in cursor.fetchall()]
+    if not columns:
+        return None
+    return 'shard' in columns
+
+def placeholders(count):
+    return ', '.join('?' * count)
+
+class Statement(object):
+    """
+    A SQL statement that changes the database. Values are never formatted
+    into the SQL, they're passed as bound parameters (``?``) so the text of
+    every statement stays constant and sqlite can reuse its compiled form.
+    """
+
+    readonly = False
+
+    def __init__(self, sql):
+        self.sql = sql
+        # short label for metrics, eg. "insert candidates"
+        verb = sql.split(None, 1)[0].lower() if sql.strip() else ''
+        table = re.search(r'\b(?:into|from|table|update)\s+(?:if not exists\s+)?(\w+)', sql, re.I)
+        self.name = '%s %s' % (verb, table.group(1)) if table else verb
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.sql == other.sql
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self.sql))
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.sql)
+
+class Query(Statement):
+    """
+    A SQL statement that only reads.
+    """
+
+    readonly = True
 
 class Validations(object):
     def validate_candidate_id(self, candidate_id):
@@ -16,97 +129,594 @@ class Validations(object):
         name_length = len(name)
         assert name_length > 0 and name_length <= 25, 'Candidate length must be between 1-25'
 
+    def validate_poll_name(self, name):
+        assert name.strip() and name.isprintable(), 'Poll names must be printable text'
+        assert len(name) <= 50, 'Poll length must be between 1-50'
+
+class Indexed(object):
+    """
+    Tables with secondary indexes listed in `index_stmts`, created with
+    ``if not exists`` so they can be added to an existing database.
+    """
+
+    index_stmts = ()
+
+    def create_indexes(self):
+        return self.db.interaction(self._create_indexes)
+
+    def _create_indexes(self, cursor):
+        for statement in self.index_stmts:
+            cursor.execute(statement.sql)
+
 class Database(object):
-    def __init__(self, dbpool):
+    """
+    Runs statements on a `ConnectionPool`. When a separate `readpool` is
+    given, queries run there while every write and interaction goes to
+    `dbpool`, which should then hold a single connection since sqlite
+    only allows one writer at a time.
+
+    With `metrics`, the time every statement waits for a pool thread and
+    the time it takes to run are recorded.
+    """
+
+    def __init__(self, dbpool, readpool=None, metrics=None):
         self.dbpool = dbpool
+        self.readpool = readpool if readpool is not None else dbpool
+        self.metrics = metrics
+
+    def execute(self, statement, params=()):
+        """
+        Run a `Query` (returns the rows) or a `Statement` (returns the last
+        row id) with its bound parameters.
+        """
+        if self.metrics is not None:
+            if statement.readonly:
+                return self._timed(self.readpool, statement.name, self._query, statement.sql, params)
+            return self._timed(self.dbpool, statement.name, self._execute, statement.sql, params)
+        if statement.readonly:
+            return self.readpool.runQuery(statement.sql, params)
+        return self.dbpool.runInteraction(self._execute, statement.sql, params)
+
+    def interaction(self, func, *args, **kwargs):
+        """
+        Run ``func(cursor, *args, **kwargs)`` inside a single transaction.
+        """
+        if self.metrics is not None:
+            return self._timed(self.dbpool, func.__name__.lstrip('_'), func, *args, **kwargs)
+        return self.dbpool.runInteraction(func, *args, **kwargs)
+
+    def _execute(self, cursor, sql_stmt, params):
+        cursor.execute(sql_stmt, params)
+        return cursor.lastrowid
 
-    def execute(self, sql_stmt):
-        sql_stmt = self.sanitize(sql_stmt)
-        if sql_stmt.lower().find('select') == 0:
-            return self.dbpool.runQuery(sql_stmt)
-        return self.dbpool.runInteraction(self._execute, sql_stmt)
+    def _query(self, cursor, sql_stmt, params):
+        cursor.execute(sql_stmt, params)
+        return cursor.fetchall()
 
-    def _execute(self, cursor, sql_stmt):
-        cursor.execute(sql_stmt)
+    def _timed(self, pool, name, func, *args, **kwargs):
+        metrics = self.metrics
+        pool_name = 'writer' if pool is self.dbpool else 'reader'
+        submitted = perf_counter()
+        started = []
 
-    def sanitize(self, sql_stmt):
-        replace = re.compile(r'(\\|#)')
-        return replace.sub('', sql_stmt)
+        def timed(cursor, *args, **kwargs):
+            # runs in the pool thread
+            started.append(perf_counter())
+            metrics.pool_wait.observe(started[0] - submitted, pool=pool_name)
+            return func(cursor, *args, **kwargs)
+
+        def done(result):
+            if started:
+                metrics.queries.observe(perf_counter() - started[0], statement=name)
+            return result
+
+        d = pool.runInteraction(timed, *args, **kwargs)
+        d.addBoth(done)
+        return d
 
 @implementer(ICandidates)
-class Candidates(object):
+class Candidates(Indexed):
 
     table_name = 'candidates'
     validate = Validations()
 
-    def __init__(self, db):
+    def __init__(self, db, table_name=None):
         self.db = db
+        self.observers = []
+        if table_name is not None:
+            self.table_name = table_name    # a poll's own table
 
-    def create_table(self):
-        stmt = "create table %s (" \
+        self.create_stmt = Statement("create table %s (" \
             "id integer primary key, " \
-            "name text unique not null)" % (self.table_name)
-        return self.db.execute(stmt)
+            "name text unique not null)" % (self.table_name))
+        self.insert_stmt = Statement('insert into %s (name) values (?)' % (self.table_name))
+        self.by_id_query = Query('select id, name from %s where id=?' % (self.table_name))
+        self.all_query = Query('select id, name from %s' % (self.table_name))
+
+        # case-insensitive prefix search, a range scan over this index
+        self.index_stmts = [Statement("create index if not exists %s_by_name " \
+            "on %s (name collate nocase)" % (self.table_name, self.table_name))]
+        self.search_query = Query("select id, name from %s " \
+            "where name >= ? collate nocase and name < ? collate nocase " \
+            "order by name collate nocase limit ?" % (self.table_name))
+
+    def create_table(self):
+        return self.db.execute(self.create_stmt)
 
     def add_candidate(self, candidate_name):
         self.validate.validate_candidate_name(candidate_name)
-        stmt = "insert into %s (name) values ('%s')" % (self.table_name, candidate_name)
-        return self.db.execute(stmt)
+        d = self.db.execute(self.insert_stmt, (candidate_name,))
+        d.addCallback(self._nominated, candidate_name)
+        return d
+
+    def _nominated(self, candidate_id, candidate_name):
+        for observer in self.observers:
+            observer.nominated(candidate_id, candidate_name)
+        return candidate_id
+
+    def import_candidates(self, records, batch_size=1000):
+        """
+        Insert many candidates in a single transaction.
+
+        :param records: Iterable of `(line_number, name)`, consumed lazily
+            in batches of `batch_size`.
+        :return: `Deferred` firing with a dict holding the number of
+            `inserted` names along with the `duplicates` and `rejected`
+            `(line_number, name, reason)` records.
+        """
+        return self.db.interaction(self._import_candidates, records, batch_size)
+
+    def _import_candidates(self, cursor, records, batch_size):
+        result = {'inserted': 0, 'duplicates': [], 'rejected': []}
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                self._import_batch(cursor, batch, result)
+                batch = []
+        if batch:
+            self._import_batch(cursor, batch, result)
+        return result
+
+    def _import_batch(self, cursor, batch, result):
+        valid = {}
+        for line_number, name in batch:
+            if name is None:
+                result['rejected'].append((line_number, name, 'Invalid record'))
+                continue
+            try:
+                self.validate.validate_candidate_name(name)
+            except AssertionError as error:
+                result['rejected'].append((line_number, name, str(error)))
+                continue
+            if name in valid:
+                result['duplicates'].append((line_number, name, 'Duplicate in file'))
+                continue
+            valid[name] = line_number
+
+        # names inserted by earlier batches are visible within the transaction
+        names = list(valid)
+        for i in range(0, len(names), MAX_VARIABLES):
+            chunk = names[i:i + MAX_VARIABLES]
+            query_stmt = 'select name from %s where name in (%s)' % (
+                self.table_name, placeholders(len(chunk)))
+            cursor.execute(query_stmt, chunk)
+            for (name,) in cursor.fetchall():
+                result['duplicates'].append((valid.pop(name), name, 'Already exists'))
+
+        cursor.executemany(self.insert_stmt.sql, [(name,) for name in valid])
+        result['inserted'] += len(valid)
+
+    def search(self, prefix, limit=10):
+        """
+        :return: `Deferred` firing with up to `limit` `(id, name)` rows whose
+            name starts with `prefix`, ignoring the case of ASCII letters.
+        """
+        return self.db.execute(self.search_query, (prefix, prefix + PREFIX_END, limit))
+
+    def all_candidates(self):
+        return self.db.execute(self.all_query)
 
-    @defer.inlineCallbacks
     def get_candidate_by_id(self, candidate_id):
+        """
+        :return: `Deferred` firing with the `(id, name)` record, failing
+            with `AssertionError` on an invalid id and `IndexError` when
+            there's no such candidate.
+        """
+        d = defer.maybeDeferred(self._candidate_query, candidate_id)
+        d.addCallback(self._found)
+        return d
+
+    def _candidate_query(self, candidate_id):
         self.validate.validate_candidate_id(candidate_id)
-        query_stmt = 'select id, name from %s where id=%d' % (self.table_name, candidate_id)
-        query = yield self.db.execute(query_stmt)
+        return self.db.execute(self.by_id_query, (candidate_id,))
+
+    def _found(self, query):
         if len(query) == 0:
             raise IndexError('No candidate found')
-        defer.returnValue(query[0])
+        return query[0]
 
 @implementer(IVotes)
-class Votes(object):
+class Votes(Indexed):
 
     table_name = 'votes'
     validate = Validations()
+    sharded = False
 
-    def __init__(self, db, candidates):
+    def __init__(self, db, candidates, table_name=None):
         self.db = db
         self.candidates = candidates
+        self.observers = []
+        if table_name is not None:
+            self.table_name = table_name    # a poll's own table
 
-    def create_table(self):
-        stmt = "create table %s (" \
+        self.create_stmt = Statement("create table %s (" \
             "candidate int primary key, " \
             "votes int not null, " \
             "foreign key(candidate) references %s(id))" % (
-                self.table_name, self.candidates.table_name)
-        return self.db.execute(stmt)
+                self.table_name, candidates.table_name))
+        self.upsert_stmt = Statement("insert into %s (candidate, votes) " \
+            "select id, 1 from %s where id=? " \
+            "on conflict(candidate) do update set votes=votes+1 " \
+            "returning votes" % (self.table_name, candidates.table_name))
+        self.add_stmt = Statement("insert into %s (candidate, votes) values (?, ?) " \
+            "on conflict(candidate) do update set votes=votes+excluded.votes" % (self.table_name))
+        self.totals_sql = 'select candidate, votes from %s where candidate in (%%s)' % (self.table_name)
+        self.total_query = Query("select c.id, c.name, v.votes " \
+            "from %s as v join %s as c on v.candidate=c.id " \
+            "where c.id=?" % (self.table_name, candidates.table_name))
+        self.all_totals_query = Query("select c.id, c.name, v.votes " \
+            "from %s as c left outer join %s as v on v.candidate=c.id" % (
+                candidates.table_name, self.table_name))
+
+        # keyset pages: the leaderboard walks the votes index backwards,
+        # candidates without votes have no row there and follow by id
+        self.index_stmts = [Statement("create index if not exists %s_by_votes " \
+            "on %s (votes, candidate)" % (self.table_name, self.table_name))]
+        self.votes_page_query = Query("select c.id, c.name, v.votes " \
+            "from %s as v join %s as c on c.id=v.candidate " \
+            "where (v.votes, v.candidate) < (?, ?) " \
+            "order by v.votes desc, v.candidate desc limit ?" % (
+                self.table_name, candidates.table_name))
+        self.unvoted_page_query = Query("select c.id, c.name, 0 from %s as c " \
+            "where c.id < ? and not exists (select 1 from %s where candidate=c.id) " \
+            "order by c.id desc limit ?" % (candidates.table_name, self.table_name))
+        self.name_page_query = Query("select c.id, c.name, " \
+            "coalesce((select votes from %s where candidate=c.id), 0) " \
+            "from %s as c where c.name > ? order by c.name limit ?" % (
+                self.table_name, candidates.table_name))
+
+    def create_table(self):
+        return self.db.execute(self.create_stmt)
 
-    @defer.inlineCallbacks
     def vote_for(self, candidate_id):
-        query = yield self.vote_total(candidate_id)     # query for the candidate
+        """
+        Add a vote in one statement. The insert only selects existing
+        candidates and an existing row is incremented by the database, so
+        concurrent votes are never lost.
 
-        # verify candidate exists or insert
-        if len(query) == 0:
-            query_candidates = yield self.candidates.get_candidate_by_id(candidate_id)
-            if len(query_candidates) == 0:
-                raise IndexError('Candidate id is not present')     # candidate doesn't exist
+        :return: `Deferred` firing with the candidate's new vote total.
+        """
+        self.validate.validate_candidate_id(candidate_id)
+        d = self.db.interaction(self._upsert_vote, candidate_id)
+        d.addCallback(self._voted, candidate_id, 1)
+        return d
 
-            # insert candidate id into votes table
-            insert_stmt = "insert into %s (candidate, votes) values (%d, 1)" % (self.table_name, candidate_id)
-            yield self.db.execute(insert_stmt)
-            defer.returnValue(None)     # exit function
+    def _upsert_vote(self, cursor, candidate_id):
+        cursor.execute(self.upsert_stmt.sql, (candidate_id,))
+        record = cursor.fetchone()
+        if record is None:
+            raise IndexError('Candidate id is not present')     # candidate doesn't exist
+        return record[0]
 
-        # add a vote to existing record
-        votes = query[0][2] + 1
-        update_stmt = "update %s set votes=%d where candidate=%d" % (self.table_name, votes, candidate_id)
-        yield self.db.execute(update_stmt)
+    def _voted(self, total, candidate_id, count):
+        for observer in self.observers:
+            observer.voted(candidate_id, count, total)
+        return total
+
+    def add_votes(self, counts):
+        """
+        Apply many vote increments in a single transaction.
+
+        :param counts: Mapping of candidate id to the number of new votes.
+        :return: `Deferred` firing with the candidate ids that don't exist.
+        """
+        for candidate_id in counts:
+            self.validate.validate_candidate_id(candidate_id)
+        d = self.db.interaction(self._add_votes, dict(counts))
+
+        @d.addCallback
+        def notify(result):
+            missing, totals = result
+            for candidate_id, total in totals:
+                self._voted(total, candidate_id, counts[candidate_id])
+            return missing
+
+        return d
+
+    def _add_votes(self, cursor, counts):
+        existing = set()
+        candidate_ids = list(counts)
+        for i in range(0, len(candidate_ids), MAX_VARIABLES):
+            chunk = candidate_ids[i:i + MAX_VARIABLES]
+            query_stmt = 'select id from %s where id in (%s)' % (
+                self.candidates.table_name, placeholders(len(chunk)))
+            cursor.execute(query_stmt, chunk)
+            existing.update(row[0] for row in cursor.fetchall())
+
+        cursor.executemany(self.add_stmt.sql, [
+            self._add_params(candidate_id, counts[candidate_id]) for candidate_id in candidate_ids
+            if candidate_id in existing])
+
+        missing = [candidate_id for candidate_id in candidate_ids if candidate_id not in existing]
+
+        # new totals, read back inside the same transaction
+        totals = []
+        voted_ids = list(existing)
+        for i in range(0, len(voted_ids), MAX_VARIABLES):
+            chunk = voted_ids[i:i + MAX_VARIABLES]
+            query_stmt = self.totals_sql % (placeholders(len(chunk)))
+            cursor.execute(query_stmt, chunk)
+            totals.extend(cursor.fetchall())
+        return missing, totals
+
+    def _add_params(self, candidate_id, count):
+        return (candidate_id, count)
 
     def vote_total(self, candidate_id):
-        stmt = "select c.id, c.name, v.votes " \
-            "from %s as v join %s as c on v.candidate=c.id "\
-            "where c.id=%d" % (self.table_name, self.candidates.table_name, candidate_id)
-        return self.db.execute(stmt)
+        return self.db.execute(self.total_query, (candidate_id,))
 
     def all_vote_totals(self):
-        stmt = "select c.id, c.name, v.votes " \
-            "from %s as c left outer join %s as v on v.candidate=c.id" % (self.candidates.table_name, self.table_name)
-        return self.db.execute(stmt)
+        return self.db.execute(self.all_totals_query)
+
+    def vote_totals_page(self, order='votes', limit=100, after=None):
+        """
+        :param order: `votes`, most votes first and newer candidates first
+            among ties, or `name`.
+        :param after: key of the last row of the previous page, a name or a
+            `(votes, id)` pair.
+        :return: `Deferred` firing with up to `limit` `(id, name, votes)` rows.
+        """
+        if order == 'name':
+            return self.db.execute(self.name_page_query, (after or '', limit))
+        votes, candidate_id = after or (MAX_INTEGER, MAX_INTEGER)
+        d = self.db.execute(self.votes_page_query, (votes, candidate_id, limit))
+        d.addCallback(self._unvoted_page, votes, candidate_id, limit)
+        return d
+
+    def _unvoted_page(self, rows, votes, candidate_id, limit):
+        if len(rows) >= limit:
+            return rows
+        start = candidate_id if votes == 0 else MAX_INTEGER
+        d = self.db.execute(self.unvoted_page_query, (start, limit - len(rows)))
+        d.addCallback(lambda unvoted: list(rows) + list(unvoted))
+        return d
+
+    def migrate_table(self):
+        """
+        Rebuild the votes table in this class's layout, keeping every
+        candidate's total. Works from either the plain or a sharded layout.
+        """
+        return self.db.interaction(self._migrate_table)
+
+    def check_layout(self):
+        """
+        Make sure an existing votes table is in this class's layout.
+        """
+        return self.db.interaction(self._check_layout)
+
+    def _check_layout(self, cursor):
+        sharded = sharded_table(cursor, self.table_name)
+        if sharded is not None and sharded != self.sharded:
+            raise ValueError('The "%s" table %s, convert it with --migrate-shards' % (
+                self.table_name, 'is sharded' if sharded else 'has one row per candidate'))
+
+    def _migrate_table(self, cursor):
+        sharded = sharded_table(cursor, self.table_name)
+        old_table = self.table_name + '_old'
+        cursor.execute('alter table %s rename to %s' % (self.table_name, old_table))
+        cursor.execute(self.create_stmt.sql)
+        cursor.execute(self._copy_sql(old_table, sharded))
+        cursor.execute('drop table %s' % (old_table))
+        self._create_indexes(cursor)
+
+    def _copy_sql(self, old_table, sharded):
+        return 'insert into %s (candidate, votes) ' \
+            'select candidate, sum(votes) from %s group by candidate' % (
+                self.table_name, old_table)
+
+@implementer(IVotes)
+class ShardedVotes(Votes):
+    """
+    Votes spread over `shards` rows per candidate, `(candidate, shard,
+    votes)`, so concurrent writers to a popular candidate update different
+    rows. Each write picks a random shard and totals are summed across
+    them.
+    """
+
+    sharded = True
+
+    def __init__(self, db, candidates, shards=8, table_name=None):
+        super(ShardedVotes, self).__init__(db, candidates, table_name)
+        self.shards = shards
+
+        self.create_stmt = Statement("create table %s (" \
+            "candidate int not null, " \
+            "shard int not null, " \
+            "votes int not null, " \
+            "primary key (candidate, shard), " \
+            "foreign key(candidate) references %s(id))" % (
+                self.table_name, candidates.table_name))
+        self.upsert_stmt = Statement("insert into %s (candidate, shard, votes) " \
+            "select id, ?, 1 from %s where id=? " \
+            "on conflict(candidate, shard) do update set votes=votes+1 " \
+            "returning votes" % (self.table_name, candidates.table_name))
+        self.sum_query = Query("select sum(votes) from %s where candidate=?" % (self.table_name))
+        self.add_stmt = Statement("insert into %s (candidate, shard, votes) values (?, ?, ?) " \
+            "on conflict(candidate, shard) do update set votes=votes+excluded.votes" % (
+                self.table_name))
+        self.totals_sql = 'select candidate, sum(votes) from %s ' \
+            'where candidate in (%%s) group by candidate' % (self.table_name)
+        self.total_query = Query("select c.id, c.name, sum(v.votes) " \
+            "from %s as v join %s as c on v.candidate=c.id " \
+            "where c.id=? group by c.id" % (self.table_name, candidates.table_name))
+        self.all_totals_query = Query("select c.id, c.name, sum(v.votes) " \
+            "from %s as c left outer join %s as v on v.candidate=c.id " \
+            "group by c.id" % (candidates.table_name, self.table_name))
+
+        # totals are sums, no index orders them; one query pages every candidate
+        self.index_stmts = ()
+        self.votes_page_query = Query("select c.id, c.name, coalesce(sum(v.votes), 0) as total " \
+            "from %s as c left outer join %s as v on v.candidate=c.id " \
+            "group by c.id having (total, c.id) < (?, ?) " \
+            "order by total desc, c.id desc limit ?" % (candidates.table_name, self.table_name))
+        self.name_page_query = Query("select c.id, c.name, " \
+            "coalesce((select sum(votes) from %s where candidate=c.id), 0) " \
+            "from %s as c where c.name > ? order by c.name limit ?" % (
+                self.table_name, candidates.table_name))
+
+    def shard(self):
+        return random.randrange(self.shards)
+
+    def _unvoted_page(self, rows, votes, candidate_id, limit):
+        return rows     # already included by `votes_page_query`
+
+    def _upsert_vote(self, cursor, candidate_id):
+        cursor.execute(self.upsert_stmt.sql, (self.shard(), candidate_id))
+        if cursor.fetchone() is None:
+            raise IndexError('Candidate id is not present')     # candidate doesn't exist
+        cursor.execute(self.sum_query.sql, (candidate_id,))
+        return cursor.fetchone()[0]
+
+    def _add_params(self, candidate_id, count):
+        return (candidate_id, self.shard(), count)
+
+    def _copy_sql(self, old_table, sharded):
+        if sharded:
+            # reshard, folding the old shards onto the new ones
+            return 'insert into %s (candidate, shard, votes) ' \
+                'select candidate, shard %% %d, sum(votes) from %s ' \
+                'group by candidate, shard %% %d' % (
+                    self.table_name, self.shards, old_table, self.shards)
+        return 'insert into %s (candidate, shard, votes) ' \
+            'select candidate, 0, votes from %s' % (self.table_name, old_table)
+
+@implementer(IPolls)
+class Polls(Indexed):
+    """
+    Elections held side by side. Every poll has its own candidates and
+    votes tables, `candidates_<id>` and `votes_<id>`, so a busy poll's
+    rows, indexes and caches never get in the way of another poll's. The
+    vote layout a poll was created with is kept in its row, the shard
+    count or 0 for one row per candidate.
+    """
+
+    table_name = 'polls'
+    validate = Validations()
+
+    def __init__(self, db, shards=0):
+        self.db = db
+        self.shards = shards    # vote layout of polls created from now on
+
+        self.create_stmt = Statement("create table if not exists %s (" \
+            "id integer primary key, " \
+            "name text unique not null, " \
+            "shards int)" % (self.table_name))
+        self.insert_stmt = Statement('insert into %s (name, shards) values (?, ?)' % (self.table_name))
+        self.layout_stmt = Statement('update %s set shards=? where id=?' % (self.table_name))
+        self.by_id_query = Query('select id, name from %s where id=?' % (self.table_name))
+        self.all_query = Query('select id, name from %s order by id' % (self.table_name))
+        self.shards_query = Query('select shards from %s where id=?' % (self.table_name))
+
+    def create_table(self):
+        return self.db.interaction(self._create_table)
+
+    def _create_table(self, cursor):
+        cursor.execute(self.create_stmt.sql)
+        cursor.execute('pragma table_info(%s)' % (self.table_name))
+        if not any(column[1] == 'shards' for column in cursor.fetchall()):
+            # polls from before layouts were kept get theirs on first use
+            cursor.execute('alter table %s add column shards int' % (self.table_name))
+
+    def tables(self, poll_id, shards=None):
+        """
+        :param shards: the poll's vote layout, polls created from now on
+            when `None`.
+        :return: `(candidates, votes)` of a poll.
+        """
+        if shards is None:
+            shards = self.shards
+        candidates = Candidates(self.db, '%s_%d' % (Candidates.table_name, poll_id))
+        votes_table = '%s_%d' % (Votes.table_name, poll_id)
+        if shards:
+            return candidates, ShardedVotes(self.db, candidates, shards, votes_table)
+        return candidates, Votes(self.db, candidates, votes_table)
+
+    def add_poll(self, name):
+        """
+        Register a poll and create its tables in one transaction.
+
+        :return: `Deferred` firing with the new poll's id.
+        """
+        self.validate.validate_poll_name(name)
+        return self.db.interaction(self._add_poll, name)
+
+    def _add_poll(self, cursor, name):
+        self._create_table(cursor)  # databases from before polls
+        cursor.execute(self.insert_stmt.sql, (name, self.shards))
+        poll_id = cursor.lastrowid
+        for model in self.tables(poll_id):
+            cursor.execute(model.create_stmt.sql)
+            model._create_indexes(cursor)
+        return poll_id
+
+    def open_poll(self, poll_id):
+        """
+        :return: `Deferred` firing with `(candidates, votes)` of a poll in
+            the layout it was created with.
+        :raises IndexError: there's no such poll.
+        """
+        self.validate.validate_candidate_id(poll_id)
+        return self.db.interaction(self._open_poll, poll_id)
+
+    def _open_poll(self, cursor, poll_id):
+        self._create_table(cursor)
+        cursor.execute(self.shards_query.sql, (poll_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise IndexError('No poll found')
+        shards = row[0]
+        if shards is None:
+            # created before layouts were kept, go by the votes table
+            candidates, votes = self.tables(poll_id, 0)
+            shards = 0
+            if sharded_table(cursor, votes.table_name):
+                cursor.execute('select coalesce(max(shard), 0) + 1 from %s' % (votes.table_name))
+                shards = max(self.shards, cursor.fetchone()[0])
+            cursor.execute(self.layout_stmt.sql, (shards, poll_id))
+        return self.tables(poll_id, shards)
+
+    def migrate_poll(self, poll_id, shards):
+        """
+        Rebuild a poll's votes table with `shards` counter rows per
+        candidate (0 for one row) and record the new layout.
+        """
+        self.validate.validate_candidate_id(poll_id)
+        return self.db.interaction(self._migrate_poll, poll_id, shards)
+
+    def _migrate_poll(self, cursor, poll_id, shards):
+        self._open_poll(cursor, poll_id)    # the poll exists
+        candidates, votes = self.tables(poll_id, shards)
+        votes._migrate_table(cursor)
+        cursor.execute(self.layout_stmt.sql, (shards, poll_id))
+
+    @defer.inlineCallbacks
+    def get_poll_by_id(self, poll_id):
+        self.validate.validate_candidate_id(poll_id)
+        query = yield self.db.execute(self.by_id_query, (poll_id,))
+        if len(query) == 0:
+            raise IndexError('No poll found')
+        defer.returnValue(query[0])
+
+    def all_polls(self):
+        return self.db.execute(self.all_query)
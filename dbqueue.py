@@ -0,0 +1,172 @@
+from timeit import default_timer as perf_counter
+import sqlite3
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from database import pragma_initializer
+
+MAX_BATCH = 256     # statements per transaction
+
+class QueuedDatabase(object):
+    """
+    Runs statements on one sqlite connection owned by a dedicated thread,
+    a drop-in replacement for `Database` without adbapi's thread pool.
+
+    The thread takes whatever has queued up, up to `max_batch` requests,
+    and runs them in a single transaction, each inside its own savepoint so
+    a failing statement or interaction is rolled back on its own. After the
+    commit one reactor call fires every `Deferred` of the batch, so under
+    load there's one fsync and one thread handoff per batch rather than
+    per statement. Results are only reported once they're durable.
+
+    Queries run in the same queue, in order with the writes, unless a
+    `readpool` is given, as with `Database`.
+    """
+
+    def __init__(self, dbpath, pragmas=None, readpool=None, metrics=None,
+            max_batch=MAX_BATCH, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.dbpath = dbpath
+        self.pragmas = pragmas
+        self.readpool = readpool
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.reactor = reactor
+        self.requests = queue.Queue()
+        self.closed = False
+        self.batches = 0    # committed transactions, for tests and benchmarks
+
+        ready = threading.Event()
+        errors = []
+        self.thread = threading.Thread(
+            target=self._run, args=(ready, errors), name='QueuedDatabase')
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        self.shutdown_id = reactor.addSystemEventTrigger('during', 'shutdown', self._close)
+
+    @property
+    def backlog(self):
+        return self.requests.qsize()
+
+    def execute(self, statement, params=()):
+        """
+        Run a `Query` (returns the rows) or a `Statement` (returns the last
+        row id) with its bound parameters.
+        """
+        if statement.readonly:
+            if self.readpool is not None:
+                return self.readpool.runQuery(statement.sql, params)
+            return self._submit(statement.name, self._query, (statement.sql, params), {})
+        return self._submit(statement.name, self._execute, (statement.sql, params), {})
+
+    def interaction(self, func, *args, **kwargs):
+        """
+        Run ``func(cursor, *args, **kwargs)``, all or nothing.
+        """
+        return self._submit(func.__name__.lstrip('_'), func, args, kwargs)
+
+    def _execute(self, cursor, sql_stmt, params):
+        cursor.execute(sql_stmt, params)
+        return cursor.lastrowid
+
+    def _query(self, cursor, sql_stmt, params):
+        cursor.execute(sql_stmt, params)
+        return cursor.fetchall()
+
+    def _submit(self, name, func, args, kwargs):
+        if self.closed:
+            return defer.fail(RuntimeError('The database is closed'))
+        d = defer.Deferred()
+        self.requests.put((name, func, args, kwargs, d, perf_counter()))
+        return d
+
+    def close(self):
+        """
+        Run what's queued, then close the connection and stop the thread.
+        """
+        if self.shutdown_id is not None:
+            self.reactor.removeSystemEventTrigger(self.shutdown_id)
+        self._close()
+
+    def _close(self):
+        self.shutdown_id = None
+        if self.closed:
+            return
+        self.closed = True
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self, ready, errors):
+        try:
+            connection = sqlite3.connect(self.dbpath, isolation_level=None)
+            if self.pragmas:
+                pragma_initializer(self.pragmas)(connection)
+        except Exception as error:
+            errors.append(error)
+            ready.set()
+            return
+        ready.set()
+
+        cursor = connection.cursor()
+        stopping = False
+        while not stopping:
+            batch = [self.requests.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if batch:
+                self._run_batch(connection, cursor, batch)
+        connection.close()
+
+    def _run_batch(self, connection, cursor, batch):
+        # runs in the database thread
+        metrics = self.metrics
+        results = []
+        try:
+            cursor.execute('begin immediate')   # wait for other writers here, not mid-batch
+            for name, func, args, kwargs, d, submitted in batch:
+                started = perf_counter()
+                if metrics is not None:
+                    metrics.pool_wait.observe(started - submitted, pool='writer')
+                cursor.execute('savepoint request')
+                try:
+                    result = func(cursor, *args, **kwargs)
+                except Exception:
+                    result = failure.Failure()
+                    cursor.execute('rollback to request')
+                cursor.execute('release request')
+                if metrics is not None:
+                    metrics.queries.observe(perf_counter() - started, statement=name)
+                results.append((d, result))
+            connection.commit()
+            self.batches += 1
+        except Exception:
+            # the transaction itself failed, nothing in it was kept
+            batch_failure = failure.Failure()
+            if connection.in_transaction:
+                connection.rollback()
+            results = [(request[4], batch_failure) for request in batch]
+        self.reactor.callFromThread(self._deliver, results)
+
+    def _deliver(self, results):
+        for d, result in results:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
@@ -0,0 +1,225 @@
+from collections import defaultdict
+
+from twisted.internet import defer, task
+from twisted.python import log
+from zope.interface import implementer
+
+from database import Query, Statement
+from interfaces import ITallyObserver
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+def floor(timestamp, resolution):
+    return int(timestamp) // resolution * resolution
+
+@implementer(ITallyObserver)
+class VoteHistory(object):
+    """
+    Votes per candidate over time. `voted` notifications are counted per
+    minute in memory and written every `flush_interval` seconds as one
+    upsert per `(candidate, minute)`, however many votes it holds.
+
+    Every `rollup_interval` seconds the recent minutes are summed into the
+    hourly table and the recent hours into the daily table. Minutes are
+    kept for `minute_retention` seconds and hours for `hour_retention`,
+    days are kept for good, so the tables stay small however long the
+    election runs. The rollups recompute whole buckets, which makes them
+    safe to run from several processes sharing the database.
+    """
+
+    minute_retention = 2 * DAY
+    hour_retention = 90 * DAY
+
+    def __init__(self, votes, flush_interval=5, rollup_interval=60, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.db = votes.db
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self.pending = defaultdict(int)     # (candidate, minute) -> votes
+        self.rolled_up = None   # time of the last rollup
+        self.stopping = False
+
+        # coarsest first, with the table holding each resolution
+        self.tables = []
+        for resolution, suffix in ((DAY, 'day'), (HOUR, 'hour'), (MINUTE, 'minute')):
+            self.tables.append((resolution, '%s_%s' % (votes.table_name, suffix)))
+        day_table, hour_table, minute_table = [table for resolution, table in self.tables]
+
+        self.create_stmts = []
+        for resolution, table in self.tables:
+            self.create_stmts.append(Statement("create table if not exists %s (" \
+                "candidate int not null, " \
+                "bucket int not null, " \
+                "votes int not null, " \
+                "primary key (candidate, bucket)) without rowid" % (table)))
+            # rollups and retention read whole buckets across candidates
+            self.create_stmts.append(Statement("create index if not exists %s_by_bucket " \
+                "on %s (bucket)" % (table, table)))
+        self.add_stmt = Statement("insert into %s (candidate, bucket, votes) values (?, ?, ?) " \
+            "on conflict(candidate, bucket) do update set votes=votes+excluded.votes" % (minute_table))
+        self.rollup_stmts = []
+        for resolution, table, source in ((HOUR, hour_table, minute_table), (DAY, day_table, hour_table)):
+            self.rollup_stmts.append(Statement("insert into %s (candidate, bucket, votes) " \
+                "select candidate, bucket / %d * %d, sum(votes) from %s where bucket >= ? " \
+                "group by 1, 2 " \
+                "on conflict(candidate, bucket) do update set votes=excluded.votes" % (
+                    table, resolution, resolution, source)))
+        self.expire_stmts = [
+            Statement('delete from %s where bucket < ?' % (minute_table)),
+            Statement('delete from %s where bucket < ?' % (hour_table))]
+        self.history_queries = dict(
+            (resolution, Query("select (bucket - ?) / ?, sum(votes) from %s " \
+                "where candidate=? and bucket >= ? and bucket < ? " \
+                "group by 1 order by 1" % (table)))
+            for resolution, table in self.tables)
+
+        self.flush_loop = task.LoopingCall(self._scheduled, self.flush)
+        self.flush_loop.clock = clock
+        self.rollup_loop = task.LoopingCall(self._scheduled, self.rollup)
+        self.rollup_loop.clock = clock
+
+    def start(self):
+        """
+        Create the history tables if needed, then start the flush and
+        rollup loops.
+        """
+        d = self.db.interaction(self._create_tables)
+
+        @d.addCallback
+        def started(ignored):
+            if self.flush_interval:
+                self.flush_loop.start(self.flush_interval, now=False)
+            if self.rollup_interval:
+                self.rollup_loop.start(self.rollup_interval, now=True)
+
+        return d
+
+    def _create_tables(self, cursor):
+        for statement in self.create_stmts:
+            cursor.execute(statement.sql)
+
+    def stop(self):
+        """
+        Stop the loops and write out the counted votes. Votes reported
+        after this, by a buffer's or journal's last flush, are written
+        straight away.
+        """
+        self.stopping = True
+        for loop in (self.flush_loop, self.rollup_loop):
+            if loop.running:
+                loop.stop()
+        return self.flush()
+
+    def _scheduled(self, function):
+        # a failure is logged and the loop keeps going
+        return function().addErrback(log.err)
+
+    def nominated(self, candidate_id, name):
+        pass
+
+    def voted(self, candidate_id, count, total):
+        self.pending[candidate_id, floor(self.clock.seconds(), MINUTE)] += count
+        if self.stopping:
+            self.flush().addErrback(log.err)
+
+    def flush(self):
+        """
+        Add the counted votes to the minute table in one transaction.
+        """
+        if not self.pending:
+            return defer.succeed(None)
+        counts, self.pending = self.pending, defaultdict(int)
+        d = self.db.interaction(self._add_minutes, counts)
+
+        @d.addErrback
+        def restore(failure):
+            # counted again with the next flush
+            for key, count in counts.items():
+                self.pending[key] += count
+            return failure
+
+        return d
+
+    def _add_minutes(self, cursor, counts):
+        cursor.executemany(self.add_stmt.sql, [
+            (candidate_id, minute, count) for (candidate_id, minute), count in counts.items()])
+
+    def rollup(self):
+        """
+        Recompute the hours and days touched since the last rollup and drop
+        the minutes and hours past their retention.
+        """
+        now = self.clock.seconds()
+        d = self.db.interaction(self._rollup, now, self.rolled_up)
+
+        @d.addCallback
+        def done(ignored):
+            self.rolled_up = now
+
+        return d
+
+    def cutoffs(self, now):
+        """
+        :return: `(minute cutoff, hour cutoff)`, the start of the oldest hour
+            whose minutes are kept and of the oldest day whose hours are.
+        """
+        return floor(now - self.minute_retention, HOUR), floor(now - self.hour_retention, DAY)
+
+    def _rollup(self, cursor, now, rolled_up):
+        minute_cutoff, hour_cutoff = self.cutoffs(now)
+        if rolled_up is None:
+            # after a restart, everything that's still complete
+            hours_since, days_since = minute_cutoff, hour_cutoff
+        else:
+            # minutes counted before the last rollup may have been written since
+            hours_since = max(floor(rolled_up - HOUR, HOUR), minute_cutoff)
+            days_since = max(floor(rolled_up - HOUR, DAY), hour_cutoff)
+        hours_stmt, days_stmt = self.rollup_stmts
+        cursor.execute(hours_stmt.sql, (hours_since,))
+        cursor.execute(days_stmt.sql, (days_since,))
+        for statement, cutoff in zip(self.expire_stmts, (minute_cutoff, hour_cutoff)):
+            cursor.execute(statement.sql, (cutoff,))
+
+    def resolution(self, start, step):
+        """
+        :return: the coarsest resolution that divides `step` and is still
+            kept at `start`, `None` when there's none.
+        """
+        minute_cutoff, hour_cutoff = self.cutoffs(self.clock.seconds())
+        kept_since = {DAY: 0, HOUR: hour_cutoff, MINUTE: minute_cutoff}
+        for resolution, table in self.tables:
+            if step % resolution == 0 and start >= kept_since[resolution]:
+                return resolution
+        return None
+
+    def history(self, candidate_id, start, end, step):
+        """
+        Votes for a candidate in `step` second slots from `start` until
+        `end`, read from the coarsest table that fits. Slots begin at
+        `start` rounded down to that table's resolution. The minute table
+        trails by up to `flush_interval` seconds, the hourly and daily
+        tables by up to `rollup_interval`.
+
+        :return: `Deferred` firing with `(first slot, votes per slot)`.
+        :raises ValueError: `step` isn't a multiple of a minute or the
+            range goes back further than the minutes or hours are kept.
+        """
+        resolution = self.resolution(start, step)
+        if resolution is None:
+            raise ValueError('No history kept at that resolution')
+        start = floor(start, resolution)
+        slots = [0] * -(-(end - start) // step)
+        d = self.db.execute(
+            self.history_queries[resolution], (start, step, candidate_id, start, end))
+
+        @d.addCallback
+        def fill(rows):
+            for slot, votes in rows:
+                slots[slot] = votes
+            return start, slots
+
+        return d
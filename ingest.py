@@ -0,0 +1,150 @@
+import codecs
+import json
+
+TRUNCATED_TAIL = 16     # longer than any JSON literal or string escape
+NUMBER_CHARS = '0123456789+-.eE'
+
+class MalformedRecord(object):
+    """
+    Placeholder yielded for a record that isn't valid JSON.
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+
+def read_records(stream, chunk_size=65536, line_numbers=False):
+    """
+    Incrementally decode a JSON array or newline-delimited JSON from a
+    file-like object, one record at a time. Only the current chunk of
+    the body is held in memory.
+
+    :param line_numbers: yield `(line_number, record)`, the line each
+        record starts on, blank lines included.
+    :return: generator of decoded records, or `MalformedRecord` for records
+        that can't be decoded. A malformed JSON array stops the generator
+        since the rest of it can't be located reliably. Bytes that aren't
+        UTF-8 are replaced with U+FFFD, outside of a string that makes the
+        record invalid JSON.
+    """
+    reader = codecs.getincrementaldecoder('utf-8')('replace')
+    buf = ''
+    while not buf.strip():
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        buf += reader.decode(chunk)
+
+    if buf.lstrip().startswith('['):
+        start = buf.index('[') + 1
+        records = _read_array(_Buffer(stream, reader, buf, chunk_size, start))
+    else:
+        records = _read_lines(_Buffer(stream, reader, buf, chunk_size))
+    for line_number, record in records:
+        yield (line_number, record) if line_numbers else record
+
+class _Buffer(object):
+    """
+    Decoded text of the body with a read position and the line it's on,
+    refilled in chunks.
+    """
+
+    def __init__(self, stream, reader, text, chunk_size, pos=0):
+        self.stream = stream
+        self.reader = reader
+        self.text = text
+        self.pos = 0
+        self.line = 1
+        self.chunk_size = chunk_size
+        self.eof = False
+        self.moveto(pos)
+
+    def moveto(self, pos):
+        self.line += self.text.count('\n', self.pos, pos)
+        self.pos = pos
+
+    def fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        self.eof = not chunk
+        self.text = self.text[self.pos:] + self.reader.decode(chunk, final=self.eof)
+        self.pos = 0
+
+    def skip_whitespace(self):
+        while True:
+            text, pos = self.text, self.pos
+            while pos < len(text) and text[pos] in ' \t\r\n':
+                pos += 1
+            self.moveto(pos)
+            if pos < len(text) or self.eof:
+                return
+            self.fill()
+
+def _read_lines(buf):
+    while True:
+        newline = buf.text.find('\n', buf.pos)
+        if newline == -1 and not buf.eof:
+            buf.fill()
+            continue
+        if newline == -1:
+            newline = len(buf.text)
+
+        line, line_number = buf.text[buf.pos:newline].strip(), buf.line
+        buf.moveto(newline + 1)
+        if line:
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, MalformedRecord('Invalid JSON')
+        if buf.eof and buf.pos >= len(buf.text):
+            return
+
+def _truncated(error, text):
+    """
+    :return: whether a decoding error could be a record cut off at the end
+        of `text` rather than a malformed one, which would otherwise keep
+        the rest of the body in memory waiting for a record that never
+        decodes. An unterminated string is reported where it starts, a
+        cut off literal or escape a few characters before the end.
+    """
+    if error.msg.startswith('Unterminated string'):
+        return True
+    return error.pos >= len(text) - TRUNCATED_TAIL
+
+def _read_array(buf):
+    decoder = json.JSONDecoder()
+    first = True            # '[]' is a valid, empty body
+    expect_value = True
+    while True:
+        buf.skip_whitespace()
+        if buf.pos >= len(buf.text):
+            yield buf.line, MalformedRecord('Unterminated array')
+            return
+
+        char = buf.text[buf.pos]
+        if char == ']' and (first or not expect_value):
+            return
+        if char == ',' and not expect_value:
+            buf.moveto(buf.pos + 1)
+            expect_value = True
+            continue
+        if not expect_value:
+            yield buf.line, MalformedRecord('Expected a comma between records')
+            return
+
+        try:
+            record, end = decoder.raw_decode(buf.text, buf.pos)
+        except ValueError as error:
+            if buf.eof or not _truncated(error, buf.text):
+                yield buf.line, MalformedRecord('Invalid JSON')
+                return
+            buf.fill()      # the record may continue in the next chunk
+            continue
+
+        if not buf.eof and isinstance(record, (int, float)) and \
+                not buf.text[end:].strip(NUMBER_CHARS):
+            buf.fill()      # a bare number may be cut off at the chunk boundary
+            continue
+
+        line_number = buf.line
+        buf.moveto(end)
+        first = expect_value = False
+        yield line_number, record
@@ -11,11 +11,28 @@ class ICandidates(Interface):
         Insert a candidate into the candidates table.
         """
 
+    def import_candidates(records, batch_size):
+        """
+        Insert many `(line_number, name)` candidate records at once, reporting
+        duplicates and rejected names.
+        """
+
     def get_candidate_by_id(candidate_id):
         """
         Retrieve a single candidate record via the candidate id number.
         """
 
+    def search(prefix, limit):
+        """
+        Get up to `limit` (id, name) records whose name starts with `prefix`,
+        ignoring the case of ASCII letters.
+        """
+
+    def all_candidates():
+        """
+        Get every (id, name) record.
+        """
+
 class IVotes(Interface):
     def create_table():
         """
@@ -27,6 +44,12 @@ class IVotes(Interface):
         Add a single vote for a candidate.
         """
 
+    def add_votes(counts):
+        """
+        Add many votes at once from a mapping of candidate id to vote count.
+        Returns the candidate ids that could not be found.
+        """
+
     def vote_total(candidate_id):
         """
         Get a record for a candidate, which will return id, candidate name, and number of votes.
@@ -36,3 +59,59 @@ class IVotes(Interface):
         """
         Get all the candidate records.
         """
+
+    def vote_totals_page(order, limit, after):
+        """
+        Get `limit` candidate records ordered by `votes` (descending, newest
+        candidate first among ties) or `name`, following the record keyed by
+        `after`: a `(votes, id)` pair or a name.
+        """
+
+class IPolls(Interface):
+    def create_table():
+        """
+        Create the polls table.
+        """
+
+    def add_poll(name):
+        """
+        Register a poll along with its own candidates and votes tables.
+        """
+
+    def get_poll_by_id(poll_id):
+        """
+        Retrieve a single poll record via the poll id number.
+        """
+
+    def all_polls():
+        """
+        Get all the poll records.
+        """
+
+    def tables(poll_id, shards=None):
+        """
+        Get the ICandidates and IVotes of a poll in a given vote layout.
+        """
+
+    def open_poll(poll_id):
+        """
+        Get the ICandidates and IVotes of a poll in the layout it was
+        created with.
+        """
+
+    def migrate_poll(poll_id, shards):
+        """
+        Convert a poll's votes to another layout.
+        """
+
+class ITallyObserver(Interface):
+    def nominated(candidate_id, name):
+        """
+        A candidate was added.
+        """
+
+    def voted(candidate_id, count, total):
+        """
+        `count` votes were committed for a candidate, whose vote total is
+        now `total`.
+        """
@@ -0,0 +1,288 @@
+from collections import defaultdict
+import os
+import re
+import struct
+
+from twisted.internet import defer, task
+from twisted.python import log
+from zope.interface import implementer
+
+from database import Statement, Validations
+from interfaces import IVotes
+
+RECORD = struct.Struct('<qd')  # candidate id, unix timestamp
+
+@implementer(IVotes)
+class VoteJournal(object):
+    """
+    Durable write-behind wrapper around a sqlite `Votes` object. Each vote
+    is appended to a binary journal segment (`<path>.<seq>`) as a fixed
+    width record and acknowledged once the segment has been fsync'd, which
+    happens for the whole group of pending votes every `fsync_interval`
+    seconds.
+
+    Every `compact_interval` seconds the segment is closed and folded into
+    the votes table with one `add_votes` transaction that also records the
+    segment's sequence number, so a segment is never applied twice. On
+    `start` any segment left behind by a crash is replayed the same way.
+    """
+
+    validate = Validations()
+    state_table = 'vote_journal'
+
+    def __init__(self, votes, path, fsync_interval=0.05, compact_interval=1, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.votes = votes
+        self.db = votes.db
+        self.table_name = votes.table_name
+        self.path = path
+        self.clock = clock
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+
+        self.known = set()          # candidate ids confirmed to exist
+        self.seq = None             # sequence of the open segment
+        self.segment = None
+        self.buffer = bytearray()   # records waiting for the next fsync
+        self.waiters = []
+        self.counts = defaultdict(int)  # votes in the open segment
+        self.unapplied = []         # closed segments, (seq, counts) in order
+        self.applying = None
+        self.failed = None          # why `start` couldn't open a segment
+
+        self.state_stmt = Statement("create table if not exists %s (" \
+            "id int primary key check (id = 0), " \
+            "applied int not null)" % (self.state_table))
+        self.mark_stmt = Statement("insert into %s (id, applied) values (0, ?) " \
+            "on conflict(id) do update set applied=excluded.applied" % (self.state_table))
+
+        self.sync_loop = task.LoopingCall(self.sync)
+        self.sync_loop.clock = clock
+        self.compact_loop = task.LoopingCall(self._scheduled_compact)
+        self.compact_loop.clock = clock
+
+    def segment_path(self, seq):
+        return '%s.%08d' % (self.path, seq)
+
+    def segments(self):
+        """
+        :return: sorted sequence numbers of the segments on disk.
+        """
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        pattern = re.compile(r'^%s\.(\d+)$' % (re.escape(prefix)))
+        matches = (pattern.match(filename) for filename in os.listdir(directory))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def read_segment(self, seq):
+        """
+        :return: vote counts per candidate in a segment. A torn record at
+            the end, from a crash during a write, is ignored.
+        """
+        with open(self.segment_path(seq), 'rb') as segment:
+            data = segment.read()
+        counts = defaultdict(int)
+        end = len(data) - len(data) % RECORD.size
+        for candidate_id, timestamp in RECORD.iter_unpack(data[:end]):
+            counts[candidate_id] += 1
+        return counts
+
+    def start(self):
+        """
+        Replay segments left by a previous run, then open a new segment and
+        start the fsync and compaction loops.
+
+        :return: `Deferred` that fires once the replay is in the table.
+            When no segment could be opened, the votes waiting for one
+            and every later vote fail.
+        """
+        d = self.db.interaction(self._load_state)
+        d.addCallback(self._recover)
+
+        @d.addErrback
+        def not_started(failure):
+            if self.segment is None:
+                self.failed = failure.value
+                self.buffer = bytearray()
+                self.counts = defaultdict(int)
+                waiters, self.waiters = self.waiters, []
+                for waiter in waiters:
+                    waiter.errback(failure)
+            return failure
+
+        return d
+
+    def _load_state(self, cursor):
+        cursor.execute(self.state_stmt.sql)
+        cursor.execute('select applied from %s' % (self.state_table))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _recover(self, applied):
+        seqs = self.segments()
+        for seq in seqs:
+            if seq <= applied:
+                os.remove(self.segment_path(seq))   # folded in before the crash
+            else:
+                self.unapplied.append((seq, self.read_segment(seq)))
+
+        self.seq = max(seqs + [applied]) + 1
+        self.segment = open(self.segment_path(self.seq), 'ab')
+        if self.fsync_interval:
+            self.sync_loop.start(self.fsync_interval, now=False)
+        if self.compact_interval:
+            self.compact_loop.start(self.compact_interval, now=False)
+        return self.apply()
+
+    def stop(self):
+        """
+        Stop the loops and fold everything journaled into the table.
+        """
+        for loop in (self.sync_loop, self.compact_loop):
+            if loop.running:
+                loop.stop()
+        if self.segment is None:
+            return defer.succeed(None)
+        d = self.compact()
+
+        @d.addBoth
+        def close(result):
+            self.segment.close()
+            self.segment = None
+            return result
+
+        return d
+
+    def create_table(self):
+        return self.votes.create_table()
+
+    def vote_for(self, candidate_id):
+        self.validate.validate_candidate_id(candidate_id)
+        if candidate_id in self.known:
+            return self._append(candidate_id)
+
+        # only journal votes that can be applied, unknown ids are checked once
+        d = self.votes.candidates.get_candidate_by_id(candidate_id)
+
+        @d.addCallback
+        def found(candidate):
+            self.known.add(candidate_id)
+            return self._append(candidate_id)
+
+        @d.addErrback
+        def not_found(failure):
+            failure.trap(IndexError)
+            raise IndexError('Candidate id is not present')
+
+        return d
+
+    def _append(self, candidate_id):
+        if self.failed is not None:
+            return defer.fail(self.failed)
+        d = defer.Deferred()
+        self.buffer += RECORD.pack(candidate_id, self.clock.seconds())
+        self.counts[candidate_id] += 1
+        self.waiters.append(d)
+        return d
+
+    def add_votes(self, counts):
+        return self.votes.add_votes(counts)
+
+    def vote_total(self, candidate_id):
+        return self.votes.vote_total(candidate_id)
+
+    def all_vote_totals(self):
+        return self.votes.all_vote_totals()
+
+    def vote_totals_page(self, order='votes', limit=100, after=None):
+        return self.votes.vote_totals_page(order, limit, after)
+
+    def sync(self):
+        """
+        Group commit: write and fsync every pending record, then
+        acknowledge the votes they hold.
+        """
+        if not self.buffer or self.segment is None:
+            return
+        data, waiters = bytes(self.buffer), self.waiters
+        self.buffer = bytearray()
+        self.waiters = []
+
+        offset = self.segment.tell()
+        try:
+            self.segment.write(data)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+        except (IOError, OSError) as error:
+            # these votes were never journaled, drop any partial write so
+            # later records stay aligned and don't fold them in either
+            try:
+                self.segment.truncate(offset)
+            except (IOError, OSError):
+                pass
+            for candidate_id, timestamp in RECORD.iter_unpack(data):
+                self.counts[candidate_id] -= 1
+                if not self.counts[candidate_id]:
+                    del self.counts[candidate_id]
+            for waiter in waiters:
+                waiter.errback(error)
+            return
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def compact(self):
+        """
+        Close the open segment and fold every closed segment into the
+        votes table.
+
+        :return: `Deferred` that fires once the segments are applied.
+        """
+        if self.segment is None:
+            return self.apply()     # not started yet
+        self.sync()
+        if self.counts:
+            self.segment.close()
+            self.unapplied.append((self.seq, self.counts))
+            self.seq += 1
+            self.segment = open(self.segment_path(self.seq), 'ab')
+            self.counts = defaultdict(int)
+        return self.apply()
+
+    def _scheduled_compact(self):
+        d = self.compact()
+        d.addErrback(log.err)   # the segment stays queued for the next run
+        return d
+
+    def apply(self):
+        """
+        Apply the closed segments one at a time, in order.
+        """
+        if self.applying is not None:
+            return self.applying
+        if not self.unapplied:
+            return defer.succeed(None)
+
+        seq, counts = self.unapplied[0]
+        d = self.applying = self.db.interaction(self._fold, seq, dict(counts))
+
+        @d.addCallback
+        def applied(result):
+            missing, totals = result
+            self.unapplied.pop(0)
+            os.remove(self.segment_path(seq))
+            for candidate_id, total in totals:
+                self.votes._voted(total, candidate_id, counts[candidate_id])
+
+        @d.addBoth
+        def done(result):
+            self.applying = None
+            if result is None:
+                return self.apply()
+            return result   # database error, the segment is retried later
+
+        return d
+
+    def _fold(self, cursor, seq, counts):
+        result = self.votes._add_votes(cursor, counts) if counts else ([], [])
+        cursor.execute(self.mark_stmt.sql, (seq,))
+        return result
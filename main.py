@@ -1,21 +1,181 @@
+import ipaddress
 import json
+import signal
+import sys
 
 from klein import Klein
+from twisted.python import log
 
-from controllers import VoteApi
-from database import Database
+from batching import VoteBuffer
+from controllers import INVALID_INPUT, NOT_AVAILABLE, PollApi, VoteApi
+from database import Candidates, Database, Polls, ShardedVotes
+from history import VoteHistory
+from journal import VoteJournal
+from memory import MemoryCandidates, MemoryVotes
+from metrics import Metrics
+from middleware import encoded
+from profiling import Profiler
+from ratelimit import RateLimiter, VoterFilter
+from stream import TallyPoller
+
+SIGNAL_PROFILE_SECONDS = 30
+
+def is_loopback(request):
+    host = getattr(request.getClientAddress(), 'host', None)
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
 
 class Application(object):
 
     router = Klein()
 
-    def __init__(self, dbpool):
-        self.database = Database(dbpool)
-        self.vote_api = VoteApi(self.database)
+    def __init__(self, dbpool, flush_interval=None, flush_threshold=500, cache_ttl=30,
+            readpool=None, store=None, journal_path=None, fsync_interval=0.05,
+            compact_interval=1, shards=0, poll_interval=None, rate_limit=None, rate_burst=None,
+            max_clients=100000, voter_capacity=None, client_cookie=None, history_interval=None,
+            rollup_interval=60, database=None, profile_dir=None, profile_endpoint=False):
+        if journal_path and (store is not None or flush_interval):
+            raise ValueError('The vote journal only works with sqlite and without a vote buffer')
+        self.store = store
+        self.metrics = Metrics()
+        if store is not None:
+            # in-memory backend, there's no sqlite database at all
+            self.database = None
+            candidates = MemoryCandidates(store)
+            votes = MemoryVotes(store, candidates)
+            self.vote_api = VoteApi(None, cache_ttl, candidates, votes)
+        else:
+            if database is not None:
+                # a `QueuedDatabase`, statements batched on its own thread
+                self.database = database
+                database.metrics = self.metrics
+                self.metrics.watch_queue(database)
+                readpool = database.readpool
+            else:
+                self.database = Database(dbpool, readpool, self.metrics)
+                self.metrics.watch_pool('writer', dbpool)
+            if readpool is not None:
+                self.metrics.watch_pool('reader', readpool)
+            candidates = Candidates(self.database)
+            votes = ShardedVotes(self.database, candidates, shards) if shards else None
+            self.vote_api = VoteApi(self.database, cache_ttl, candidates, votes)
+        self.vote_api.metrics = self.metrics
+        self.metrics.watch_cache(self.vote_api.cache)
+
+        if rate_limit:
+            self.vote_api.limiter = RateLimiter(rate_limit, rate_burst, max_clients)
+        if voter_capacity:
+            self.vote_api.voters = VoterFilter(voter_capacity)
+        self.vote_api.client_cookie = client_cookie
+        self.voter_capacity = voter_capacity
+
+        self.vote_history = None
+        if history_interval and store is None:
+            # votes per minute, rolled up into hours and days
+            self.vote_history = VoteHistory(self.vote_api.votes, history_interval, rollup_interval)
+            self.vote_api.votes.observers.append(self.vote_history)
+            self.vote_api.history = self.vote_history
+
+        self.poll_api = None
+        if store is None:
+            # further elections, each in its own tables
+            self.poll_api = PollApi(Polls(self.database, shards), cache_ttl, self.configure_poll)
+            self.poll_api.metrics = self.metrics
+
+        self.vote_buffer = None
+        if flush_interval:
+            # write-behind: coalesce votes and write them in batches
+            self.vote_buffer = VoteBuffer(
+                self.vote_api.votes, flush_interval, flush_threshold)
+            self.vote_api.votes = self.vote_buffer
+
+        self.vote_journal = None
+        if journal_path:
+            # durable write-behind: append votes to a journal, fold it in later
+            self.vote_journal = VoteJournal(
+                self.vote_api.votes, journal_path, fsync_interval, compact_interval)
+            self.vote_api.votes = self.vote_journal
+
+        # cProfile on demand, off unless there's somewhere to write to. The
+        # endpoint trusts the peer address, which every request shares
+        # behind a local proxy, so it has to be asked for
+        self.profiler = Profiler(profile_dir) if profile_dir else None
+        self.profile_endpoint = profile_endpoint
+
+        self.poller = None
+        if poll_interval:
+            # other processes write votes too, follow them through the database
+            broadcaster = self.vote_api.broadcaster
+            self.poller = TallyPoller(
+                lambda: self.vote_api.votes.all_vote_totals(), [broadcaster],
+                poll_interval, active=lambda: bool(broadcaster.subscribers))
+
+    def configure_poll(self, vote_api):
+        """
+        Give a poll's `VoteApi` the metrics and limits of the application.
+        Clients share one rate across polls and may vote once in each.
+        """
+        vote_api.metrics = self.metrics
+        vote_api.limiter = self.vote_api.limiter
+        vote_api.client_cookie = self.vote_api.client_cookie
+        if self.voter_capacity:
+            vote_api.voters = VoterFilter(self.voter_capacity)
+
+    def start(self, reactor):
+        """
+        Start background services and make sure they're stopped cleanly
+        before the reactor shuts down.
+        """
+        if self.vote_buffer is not None:
+            self.vote_buffer.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.vote_buffer.stop)
+        if self.vote_journal is not None:
+            self.vote_journal.start().addErrback(log.err)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.vote_journal.stop)
+        if self.vote_history is not None:
+            # after the buffer and journal, their last votes are written on arrival
+            self.vote_history.start().addErrback(log.err)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.vote_history.stop)
+        if self.poller is not None:
+            self.poller.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.poller.stop)
+        if self.profiler is not None and hasattr(signal, 'SIGUSR2'):
+            # kill -USR2 <pid> profiles for a while, a second signal stops early
+            signal.signal(signal.SIGUSR2, lambda signum, frame: reactor.callFromThread(self.toggle_profiling))
+        # registered after the buffer so its last flush is persisted
+        if self.store is not None:
+            self.store.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.store.stop)
+
+    def profiling_allowed(self, request):
+        return self.profiler is not None and self.profile_endpoint and is_loopback(request)
+
+    def toggle_profiling(self):
+        if self.profiler.active:
+            self.profiler.stop()
+        else:
+            self.profiler.start(seconds=SIGNAL_PROFILE_SECONDS)
 
     def run(self, *args, **kwargs):
+        from twisted.internet import reactor
+        self.start(reactor)
         self.router.run(*args, **kwargs)
 
+    def serve(self, sock, logfile=None):
+        """
+        Run on a socket that's already bound and listening, as each worker
+        process does.
+        """
+        from twisted.internet import reactor
+        from twisted.web.server import Site
+        log.startLogging(logfile or sys.stdout)
+        self.start(reactor)
+        reactor.adoptStreamPort(sock.fileno(), sock.family, Site(self.router.resource()))
+        sock.close()    # the reactor listens on its own copy
+        reactor.run()
+
     @router.route('/')
     def welcome(self, request):
         message = 'Welcome to the Vote App'
@@ -26,6 +186,70 @@ class Application(object):
         request.setHeader('Content-Type', 'text/html')
         return '<h1>%s</h1>' % (message)
 
+    @router.route('/metrics', methods=['GET'])
+    def prometheus(self, request):
+        """
+        Request, database, pool and cache metrics in the Prometheus text
+        format.
+        """
+        request.setHeader('Content-Type', self.metrics.content_type)
+        return self.metrics.render()
+
+    @router.route('/admin/profile', methods=['POST'])
+    def start_profiling(self, request):
+        """
+        Profile the server for `seconds` (30 by default) or until
+        `requests` API requests have finished. Only answered on the
+        loopback interface, when the endpoint is enabled and there's a
+        profile directory.
+
+        :return: `{status, path}` where the stats will be written.
+        """
+        request.setHeader('Content-Type', 'application/json')
+        if not self.profiling_allowed(request):
+            request.setResponseCode(404)
+            return NOT_AVAILABLE
+        try:
+            seconds = request.args.get(b'seconds', [None])[0]
+            requests = request.args.get(b'requests', [None])[0]
+            seconds = float(seconds) if seconds is not None else None
+            requests = int(requests) if requests is not None else None
+            if seconds is None and requests is None:
+                seconds = SIGNAL_PROFILE_SECONDS
+            path = self.profiler.start(seconds, requests)
+        except ValueError:
+            request.setResponseCode(412)
+            return INVALID_INPUT
+        except RuntimeError:
+            request.setResponseCode(409)
+            return encoded({'status': 'Already Profiling', 'path': self.profiler.path})
+        request.setResponseCode(202)
+        return encoded({'status': 'Profiling', 'path': path})
+
+    @router.route('/admin/profile', methods=['DELETE'])
+    def stop_profiling(self, request):
+        """
+        Stop profiling early and write out the stats.
+        """
+        request.setHeader('Content-Type', 'application/json')
+        if not self.profiling_allowed(request) or not self.profiler.active:
+            request.setResponseCode(404)
+            return NOT_AVAILABLE
+        return encoded({'status': 'Profile Written', 'path': self.profiler.stop()})
+
+    @router.route('/api/polls', branch=True)
+    def poll_rsrc(self, request):
+        if self.poll_api is None:
+            # the memory backend holds a single election
+            request.setResponseCode(404)
+            request.setHeader('Content-Type', 'application/json')
+            return NOT_AVAILABLE
+        if self.profiler is not None:
+            self.profiler.request(request)
+        return self.poll_api.resource()
+
     @router.route('/api', branch=True)
     def vote_rsrc(self, request):
+        if self.profiler is not None:
+            self.profiler.request(request)
         return self.vote_api.resource()
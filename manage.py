@@ -1,36 +1,177 @@
+import csv
+import io
 from os import path, remove
+import signal
+import sqlite3
 import sys
+import time
 
-from twisted.enterprise.adbapi import ConnectionPool
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
 from twisted.internet import defer, task
 
-from database import Database, Candidates, Votes
+from database import (
+    Database, Candidates, Polls, ShardedVotes, Votes, PRAGMA_PROFILES, connection_pool,
+    pragma_settings)
+from dbqueue import QueuedDatabase
+from ingest import MalformedRecord, read_records
 from main import Application
+from memory import MemoryCandidates, MemoryStore
+import serializers
+from workers import Supervisor, install_reactor, listening_socket
 
 class CLI(Options):
 
     optParameters = [
+        ['backend', 'B', 'sqlite', 'Storage backend: sqlite or memory'],
         ['db', 'D', 'votes.sqlite', 'Path to the sqlite database.'],
+        ['memory-path', None, None, 'Log and snapshot path prefix for the memory backend (none keeps nothing)'],
+        ['snapshot-interval', None, 300, 'Seconds between memory backend snapshots', float],
         ['host', 'H', '127.0.0.1', 'Hostname'],
         ['port', 'P', 8000, 'Port number'],
         ['logpath', 'L', None, 'File path to log'],
+        ['flush-interval', None, None, 'Buffer votes and write them every N seconds', float],
+        ['flush-threshold', None, 500, 'Pending votes that force an early flush', int],
+        ['journal', 'J', None, 'Append votes to a journal at this path prefix and fold it into sqlite'],
+        ['fsync-interval', None, 0.05, 'Seconds between journal group commits', float],
+        ['compact-interval', None, 1, 'Seconds between folding the journal into the votes table', float],
+        ['history-interval', None, 5, 'Seconds between writing votes per minute for history (0 disables it)', float],
+        ['rollup-interval', None, 60, 'Seconds between rolling vote history up into hours and days', float],
+        ['import-candidates', 'I', None, 'Import candidates from a CSV or NDJSON file'],
+        ['batch-size', None, 1000, 'Rows validated and inserted per batch when importing', int],
+        ['cache-ttl', None, 30, 'Seconds before the cached leaderboard is reloaded (0 disables it)', float],
+        ['sqlite-profile', None, 'default', 'SQLite pragma profile: %s' % (', '.join(sorted(PRAGMA_PROFILES)))],
+        ['journal-mode', None, None, 'SQLite journal_mode pragma, eg. WAL'],
+        ['synchronous', None, None, 'SQLite synchronous pragma, eg. NORMAL'],
+        ['mmap-size', None, None, 'SQLite mmap_size pragma in bytes', int],
+        ['cache-size', None, None, 'SQLite cache_size pragma, pages or -KiB', int],
+        ['busy-timeout', None, None, 'SQLite busy_timeout pragma in milliseconds', int],
+        ['temp-store', None, None, 'SQLite temp_store pragma, eg. MEMORY'],
+        ['shards', None, 0, 'Spread each candidate\'s votes over N counter rows (0 keeps one row)', int],
+        ['workers', 'w', 0, 'Serve from N forked processes sharing the listening socket', int],
+        ['poll-interval', None, 1, 'Seconds between tally polls for live streams with --workers', float],
+        ['rate-limit', None, None, 'Write requests per second allowed per client', float],
+        ['rate-burst', None, None, 'Write requests a client may make at once (defaults to --rate-limit)', int],
+        ['max-clients', None, 100000, 'Clients tracked by the rate limiter, least recently seen are forgotten', int],
+        ['one-vote', None, None, 'Allow one vote per client, sized for N voters (turns off bulk votes)', int],
+        ['client-cookie', None, None, 'Identify clients by this cookie instead of their address'],
+        ['serializer', None, None, 'JSON encoder: orjson, ujson or json (defaults to the fastest installed)'],
+        ['readers', None, 0, 'Connections in a separate reader pool (0 shares one pool)', int],
+        ['read-pool-min', None, None, 'Minimum reader connections (defaults to --readers)', int],
+        ['write-pool-min', None, None, 'Minimum writer connections (1 with readers, else 3)', int],
+        ['write-pool-max', None, None, 'Maximum writer connections (1 with readers, else 5)', int],
     ]
 
+    def postOptions(self):
+        if self['backend'] not in ('sqlite', 'memory'):
+            raise UsageError('Unknown backend: %s' % (self['backend']))
+        if self['backend'] == 'memory' and self['create']:
+            raise UsageError('The memory backend has no tables to create')
+        if self['backend'] == 'memory' and self['import-candidates'] and not self['memory-path']:
+            raise UsageError('Importing into the memory backend requires --memory-path')
+        if self['shards'] < 0:
+            raise UsageError('--shards can\'t be negative')
+        if self['backend'] == 'memory' and self['create-indexes']:
+            raise UsageError('The memory backend has no indexes')
+        if self['backend'] == 'memory' and (self['shards'] or self['migrate-shards']):
+            raise UsageError('The memory backend has no sharded counters')
+        if self['workers'] < 0:
+            raise UsageError('--workers can\'t be negative')
+        if self['workers'] and (self['backend'] == 'memory' or self['journal']):
+            # both keep votes in per-process state
+            raise UsageError('--workers needs the sqlite backend and no --journal')
+        if self['workers']:
+            self['cache-ttl'] = 0   # every worker reads the shared database
+        if self['journal'] and (self['backend'] == 'memory' or self['flush-interval']):
+            raise UsageError('--journal only works with the sqlite backend and without --flush-interval')
+        if self['serializer'] is not None and self['serializer'] not in serializers.SERIALIZERS:
+            raise UsageError('JSON serializer %s is not available' % (self['serializer']))
+        if self['rate-limit'] is not None and self['rate-limit'] <= 0:
+            raise UsageError('--rate-limit must be positive')
+        if self['max-clients'] < 1 or (self['one-vote'] is not None and self['one-vote'] < 1):
+            raise UsageError('--max-clients and --one-vote must be positive')
+        if self['profile-endpoint'] and not self['logpath']:
+            raise UsageError('--profile-endpoint writes profiles next to --logpath')
+        if self['db-thread'] and self['backend'] == 'memory':
+            raise UsageError('--db-thread needs the sqlite backend')
+        if self['history-interval'] < 0 or self['rollup-interval'] <= 0:
+            raise UsageError('--history-interval can\'t be negative and --rollup-interval must be positive')
+        if self['journal'] and not (self['fsync-interval'] > 0 and self['compact-interval'] > 0):
+            raise UsageError('Journal intervals must be positive')
+
+        try:
+            self['pragmas'] = pragma_settings(
+                self['sqlite-profile'],
+                journal_mode=self['journal-mode'],
+                synchronous=self['synchronous'],
+                mmap_size=self['mmap-size'],
+                cache_size=self['cache-size'],
+                busy_timeout=self['busy-timeout'],
+                temp_store=self['temp-store'])
+        except ValueError as error:
+            raise UsageError(str(error))
+        if self['workers'] and 'busy_timeout' not in self['pragmas']:
+            # workers write from separate processes, wait for the lock
+            self['pragmas']['busy_timeout'] = 5000
+
+        # sqlite has a single writer, give it a dedicated connection when
+        # reads get their own pool
+        default_min, default_max = (1, 1) if self['readers'] else (3, 5)
+        self['pool'] = {
+            'cp_min': self['write-pool-min'] or default_min,
+            'cp_max': self['write-pool-max'] or default_max}
+        self['readpool'] = None
+        if self['readers']:
+            self['readpool'] = {
+                'cp_min': self['read-pool-min'] or self['readers'],
+                'cp_max': self['readers']}
+        for pool in (self['pool'], self['readpool']):
+            if pool and not 0 < pool['cp_min'] <= pool['cp_max']:
+                raise UsageError('Pool sizes must satisfy 0 < min <= max')
+
     optFlags = [
         ['runserver', 'R', 'Run the Klein application'],
         ['create', 'C', 'Create/Recreate the database'],
+        ['migrate-shards', None, 'Convert the votes tables, every poll\'s too, to the layout chosen by --shards'],
+        ['create-indexes', None, 'Add the indexes used by paged listings to an existing database'],
+        ['db-thread', None, 'Run statements on one dedicated thread, batching them into shared transactions'],
+        ['profile-endpoint', None, 'Serve POST/DELETE /admin/profile to localhost, never behind a local proxy'],
     ]
 
 @defer.inlineCallbacks
 def create_tables(reactor, *models):
     for model in models:
         yield model.create_table()
+        yield model.create_indexes()
         print('[x] Created the "%s" table' % (model.table_name))
 
-def create_database(dbpath):
-    dbpool = ConnectionPool('sqlite3', dbpath, check_same_thread=False)
+@defer.inlineCallbacks
+def index_tables(reactor, *models):
+    for model in models:
+        yield model.create_indexes()
+        print('[x] Indexed the "%s" table' % (model.table_name))
+
+def votes_model(db, candidates, shards=0):
+    if shards:
+        return ShardedVotes(db, candidates, shards)
+    return Votes(db, candidates)
+
+def check_layout(dbpath, shards):
+    """
+    Refuse to serve from a votes table in another layout than `--shards`,
+    where every vote would fail.
+    """
+    if not path.exists(dbpath):
+        return
+    connection = sqlite3.connect(dbpath)
+    try:
+        votes_model(None, Candidates(None), shards)._check_layout(connection.cursor())
+    except ValueError as error:
+        print('[!] %s' % (error))
+        sys.exit(1)
+    finally:
+        connection.close()
 
+def create_database(dbpath, pragmas=None, shards=0):
     if path.exists(dbpath):
         answer = input('%s already exists. Delete? [yes/no]: ' % (dbpath))
         if answer.lower() in ['yes','y']:
@@ -40,39 +181,247 @@ def create_database(dbpath):
             sys.exit()      # don't delete
 
     # Create tables then exit
-    dbpool = ConnectionPool('sqlite3', dbpath, check_same_thread=False)
+    dbpool = connection_pool(dbpath, pragmas)
     db = Database(dbpool)
     candidates = Candidates(db)
-    votes = Votes(db, candidates)
-    task.react(create_tables, (candidates, votes))
+    votes = votes_model(db, candidates, shards)
+    task.react(create_tables, (candidates, votes, Polls(db, shards)))
     sys.exit()
 
-def runserver(dbpath, host, port, logpath):
-    dbpool = ConnectionPool('sqlite3', dbpath, check_same_thread=False)
-    app = Application(dbpool)
-    print('Database: %s' % (dbpath))
+@defer.inlineCallbacks
+def migrate_table(reactor, votes, shards, polls):
+    layout = '%d shards' % (shards) if shards else 'one row per candidate'
+    yield votes.migrate_table()
+    print('[x] Migrated the "%s" table to %s' % (votes.table_name, layout))
+
+    yield polls.create_table()
+    for poll_id, name in (yield polls.all_polls()):
+        yield polls.migrate_poll(poll_id, shards)
+        print('[x] Migrated the votes of poll "%s" to %s' % (name, layout))
+
+def migrate_shards(dbpath, shards, pragmas=None):
+    dbpool = connection_pool(dbpath, pragmas)
+    db = Database(dbpool)
+    task.react(migrate_table, (votes_model(db, Candidates(db), shards), shards, Polls(db, shards)))
+
+@defer.inlineCallbacks
+def index_polls(reactor, polls, *models):
+    yield index_tables(reactor, *models)
+    yield polls.create_table()
+    for poll_id, name in (yield polls.all_polls()):
+        tables = yield polls.open_poll(poll_id)
+        yield index_tables(reactor, *tables)
+
+def create_indexes(dbpath, shards, pragmas=None):
+    dbpool = connection_pool(dbpath, pragmas)
+    db = Database(dbpool)
+    candidates = Candidates(db)
+    task.react(index_polls, (Polls(db, shards), candidates, votes_model(db, candidates, shards)))
+
+def read_candidate_names(filepath):
+    """
+    Stream `(line_number, name)` records from a CSV file (first column, an
+    optional `name` header is skipped) or from NDJSON holding either
+    strings or `{"name": ...}` objects.
+    """
+    if filepath.lower().endswith('.csv'):
+        with io.open(filepath, newline='', encoding='utf-8') as csvfile:
+            for line_number, row in enumerate(csv.reader(csvfile), 1):
+                if not row or (line_number == 1 and row[0].strip().lower() == 'name'):
+                    continue
+                yield line_number, row[0].strip()
+        return
+
+    with open(filepath, 'rb') as jsonfile:
+        for line_number, record in read_records(jsonfile, line_numbers=True):
+            if isinstance(record, dict):
+                record = record.get('name')
+            if isinstance(record, MalformedRecord) or not isinstance(record, str):
+                yield line_number, None     # rejected as an invalid record
+            else:
+                yield line_number, record.strip()
+
+@defer.inlineCallbacks
+def import_candidates(reactor, candidates, filepath, batch_size):
+    start = time.time()
+    result = yield candidates.import_candidates(read_candidate_names(filepath), batch_size)
+    elapsed = max(time.time() - start, 1e-6)
+
+    for line_number, name, reason in result['rejected']:
+        print('[!] Rejected line %d "%s": %s' % (line_number, name or '', reason))
+    for line_number, name, reason in result['duplicates']:
+        print('[-] Duplicate line %d "%s": %s' % (line_number, name, reason))
+
+    rows = result['inserted'] + len(result['duplicates']) + len(result['rejected'])
+    print('[x] Imported %d candidates, %d duplicates, %d rejected' % (
+        result['inserted'], len(result['duplicates']), len(result['rejected'])))
+    print('[x] %d rows in %.2fs (%.0f rows/sec)' % (rows, elapsed, rows / elapsed))
+
+def import_candidates_file(dbpath, filepath, batch_size, pragmas=None):
+    dbpool = connection_pool(dbpath, pragmas)
+    candidates = Candidates(Database(dbpool))
+    task.react(import_candidates, (candidates, filepath, batch_size))
+
+def import_candidates_memory(memory_path, filepath, batch_size):
+    store = MemoryStore(memory_path)
+
+    def run(reactor):
+        d = import_candidates(reactor, MemoryCandidates(store), filepath, batch_size)
+        d.addCallback(lambda ignored: store.stop())     # snapshot the import
+        return d
+    task.react(run)
+
+def runserver(dbpath, host, port, logpath, flush_interval=None, flush_threshold=500, cache_ttl=30,
+        pragmas=None, pool=None, readpool=None, backend='sqlite', memory_path=None,
+        snapshot_interval=300, journal=None, fsync_interval=0.05, compact_interval=1, shards=0,
+        workers=0, poll_interval=1, rate_limit=None, rate_burst=None, max_clients=100000,
+        one_vote=None, client_cookie=None, serializer=None, history_interval=5, rollup_interval=60,
+        db_thread=False, profile_endpoint=False):
+    limits = dict(
+        rate_limit=rate_limit, rate_burst=rate_burst, max_clients=max_clients,
+        voter_capacity=one_vote, client_cookie=client_cookie)
+
+    def application():
+        # pools hold threads and the reactor, create them in the process serving
+        if backend == 'memory':
+            store = MemoryStore(memory_path, snapshot_interval=snapshot_interval)
+            return Application(
+                None, flush_interval, flush_threshold, cache_ttl, store=store,
+                profile_dir=profile_dir, profile_endpoint=profile_endpoint, **limits)
+        readers = connection_pool(dbpath, pragmas, readonly=True, **readpool) if readpool else None
+        if db_thread:
+            dbpool, database = None, QueuedDatabase(dbpath, pragmas, readers)
+        else:
+            dbpool, database = connection_pool(dbpath, pragmas, **(pool or {})), None
+        return Application(
+            dbpool, flush_interval, flush_threshold, cache_ttl, readers,
+            journal_path=journal, fsync_interval=fsync_interval,
+            compact_interval=compact_interval, shards=shards,
+            poll_interval=poll_interval if workers else None,
+            history_interval=history_interval, rollup_interval=rollup_interval,
+            database=database, profile_dir=profile_dir, profile_endpoint=profile_endpoint,
+            **limits)
+
+    if backend == 'memory':
+        print('Backend: memory')
+        if memory_path:
+            print('Memory Path: %s (snapshot every %ss)' % (memory_path, snapshot_interval))
+        else:
+            print('Warning: without --memory-path votes are lost when the server stops')
+    else:
+        print('Database: %s' % (dbpath))
+        check_layout(dbpath, shards)
+        if shards:
+            print('Vote Shards: %d' % (shards))
+        if db_thread:
+            print('Writer: one database thread, statements batched per transaction')
+        else:
+            print('Writer Pool: %(cp_min)d-%(cp_max)d connections' % (pool or {'cp_min': 3, 'cp_max': 5}))
+        if readpool:
+            print('Reader Pool: %(cp_min)d-%(cp_max)d connections' % (readpool))
+            if (pragmas or {}).get('journal_mode', '').upper() != 'WAL':
+                print('Warning: without journal_mode=WAL readers and the writer block each other')
+        if pragmas:
+            print('Pragmas: %s' % (', '.join('%s=%s' % item for item in pragmas.items())))
+    if journal:
+        print('Vote Journal: %s (fsync every %ss, compact every %ss)' % (
+            journal, fsync_interval, compact_interval))
+    if history_interval and backend != 'memory':
+        print('Vote History: written every %ss, rolled up every %ss' % (history_interval, rollup_interval))
+    if flush_interval:
+        print('Vote Flush: every %ss or %d votes' % (flush_interval, flush_threshold))
+
+    if rate_limit:
+        print('Rate Limit: %s writes/sec per client, bursts of %d' % (
+            rate_limit, rate_burst or max(1, rate_limit)))
+    if one_vote:
+        print('One Vote Per Client: up to %d voters' % (one_vote))
+    if (rate_limit or one_vote) and workers:
+        print('Warning: every worker limits clients on its own')
+
+    if serializer:
+        serializers.use(serializer)
+        print('JSON Serializer: %s' % (serializer))
 
     if logpath:
         logfile = open(logpath, 'a')
         print('Log File: %s' % (logpath))
+        # profiles go next to the log
+        profile_dir = path.dirname(path.abspath(logpath))
+        print('Profiling: kill -USR2%s, written to %s' % (
+            ' or POST /admin/profile from localhost' if profile_endpoint else '', profile_dir))
     else:
         logfile = None
+        profile_dir = None
+
+    print('Host: %s\nPort: %d' % (host, port))
+    if not workers:
+        print('')
+        application().run(host, port, logfile)
+        return
 
-    print('Host: %s\nPort: %d\n' % (host, port))
-    app.run(host, port, logfile)
+    print('Workers: %d (leaderboard cache off, streams poll every %ss)\n' % (workers, poll_interval))
+    sock = listening_socket(host, port)
+
+    def worker(index):
+        install_reactor()
+        application().serve(sock, logfile)
+
+    forward = (signal.SIGUSR2,) if profile_dir else ()
+    Supervisor(worker, workers, forward_signals=forward).run()
 
 
 if __name__=='__main__':
     cli = CLI()
-    cli.parseOptions()
+    try:
+        cli.parseOptions()
+    except UsageError as error:
+        print('%s\n%s' % (cli, error))
+        sys.exit(1)
 
     if cli['create']:
-        create_database(cli['db'])
+        create_database(cli['db'], cli['pragmas'], cli['shards'])
+
+    if cli['migrate-shards']:
+        migrate_shards(cli['db'], cli['shards'], cli['pragmas'])
+
+    if cli['create-indexes']:
+        create_indexes(cli['db'], cli['shards'], cli['pragmas'])
+
+    if cli['import-candidates'] and cli['backend'] == 'memory':
+        import_candidates_memory(cli['memory-path'], cli['import-candidates'], cli['batch-size'])
+    elif cli['import-candidates']:
+        import_candidates_file(cli['db'], cli['import-candidates'], cli['batch-size'], cli['pragmas'])
 
     if cli['runserver']:
         runserver(
             dbpath=cli['db'],
             host=cli['host'],
             port=int(cli['port']),
-            logpath=cli['logpath'])
+            logpath=cli['logpath'],
+            flush_interval=cli['flush-interval'],
+            flush_threshold=cli['flush-threshold'],
+            cache_ttl=cli['cache-ttl'],
+            pragmas=cli['pragmas'],
+            pool=cli['pool'],
+            readpool=cli['readpool'],
+            backend=cli['backend'],
+            memory_path=cli['memory-path'],
+            snapshot_interval=cli['snapshot-interval'],
+            journal=cli['journal'],
+            fsync_interval=cli['fsync-interval'],
+            compact_interval=cli['compact-interval'],
+            shards=cli['shards'],
+            workers=cli['workers'],
+            poll_interval=cli['poll-interval'],
+            rate_limit=cli['rate-limit'],
+            rate_burst=cli['rate-burst'],
+            max_clients=cli['max-clients'],
+            one_vote=cli['one-vote'],
+            client_cookie=cli['client-cookie'],
+            serializer=cli['serializer'],
+            history_interval=cli['history-interval'],
+            rollup_interval=cli['rollup-interval'],
+            db_thread=cli['db-thread'],
+            profile_endpoint=cli['profile-endpoint'])
 
@@ -0,0 +1,280 @@
+from __future__ import unicode_literals
+from array import array
+import heapq
+import io
+import json
+import os
+
+from twisted.internet import defer, task
+from zope.interface import implementer
+
+from database import MAX_INTEGER, Validations
+from interfaces import ICandidates, IVotes
+from search import fold
+
+class MemoryStore(object):
+    """
+    Candidates and vote counters held in process memory. Candidate ids
+    start at 1 like sqlite's row ids and index straight into `names` and
+    the `counters` array.
+
+    With a `path`, every change is appended to a log (`<path>.log`) that
+    is flushed every `sync_interval` seconds, and a snapshot of the whole
+    state (`<path>.snapshot`) is written every `snapshot_interval`
+    seconds, after which the log starts over. Both files carry a
+    generation number so a log that was already folded into a snapshot is
+    never replayed twice.
+    """
+
+    def __init__(self, path=None, sync_interval=1, snapshot_interval=300, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.path = path
+        self.names = []
+        self.ids = {}
+        self.counters = array('q')
+        self.generation = 0
+        self.log = None
+        self.sync_loop = task.LoopingCall(self.sync)
+        self.sync_loop.clock = clock
+        self.snapshot_loop = task.LoopingCall(self.snapshot)
+        self.snapshot_loop.clock = clock
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+        if path is not None:
+            self.load()
+
+    def start(self):
+        if self.path is None:
+            return
+        if self.sync_interval:
+            self.sync_loop.start(self.sync_interval, now=False)
+        if self.snapshot_interval:
+            self.snapshot_loop.start(self.snapshot_interval, now=False)
+
+    def stop(self):
+        for loop in (self.sync_loop, self.snapshot_loop):
+            if loop.running:
+                loop.stop()
+        if self.log is not None:
+            self.snapshot()
+            self.log.close()
+            self.log = None
+
+    def add(self, name):
+        if name in self.ids:
+            raise ValueError('Candidate already exists')
+        self.names.append(name)
+        self.counters.append(0)
+        candidate_id = self.ids[name] = len(self.names)
+        self._append('c\t%s\n' % (name))
+        return candidate_id
+
+    def exists(self, candidate_id):
+        return 0 < candidate_id <= len(self.names)
+
+    def increment(self, candidate_id, count):
+        index = candidate_id - 1
+        self.counters[index] += count
+        self._append('v\t%d\t%d\n' % (candidate_id, count))
+        return self.counters[index]
+
+    def _append(self, line):
+        if self.log is not None:
+            self.log.write(line)
+
+    def sync(self):
+        if self.log is not None:
+            self.log.flush()
+
+    def snapshot(self):
+        """
+        Write the full state atomically and start a new, empty log.
+        """
+        if self.path is None:
+            return
+        self.generation += 1
+        snapshot_path = self.path + '.snapshot'
+        with io.open(snapshot_path + '.tmp', 'w', encoding='utf-8') as snapshot:
+            json.dump({
+                'generation': self.generation,
+                'names': self.names,
+                'votes': self.counters.tolist()}, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(snapshot_path + '.tmp', snapshot_path)
+        self._open_log()
+
+    def load(self):
+        snapshot_path = self.path + '.snapshot'
+        if os.path.exists(snapshot_path):
+            with io.open(snapshot_path, encoding='utf-8') as snapshot:
+                state = json.load(snapshot)
+            self.generation = state['generation']
+            self.names = state['names']
+            self.ids = dict((name, i + 1) for i, name in enumerate(self.names))
+            self.counters = array('q', state['votes'])
+
+        log_path = self.path + '.log'
+        if os.path.exists(log_path) and self._replay(log_path):
+            # fold the replayed log (and any torn tail) into a new snapshot
+            self.snapshot()
+        else:
+            self._open_log()
+
+    def _replay(self, log_path):
+        with io.open(log_path, encoding='utf-8') as log:
+            header = log.readline()
+            if not header.startswith('g\t') or int(header.split('\t')[1]) < self.generation:
+                return False    # already part of the snapshot
+            for line in log:
+                if not line.endswith('\n'):
+                    break   # torn write at the end of the log
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'c':
+                    self.names.append(fields[1])
+                    self.counters.append(0)
+                    self.ids[fields[1]] = len(self.names)
+                elif fields[0] == 'v':
+                    self.counters[int(fields[1]) - 1] += int(fields[2])
+        return True
+
+    def _open_log(self):
+        if self.log is not None:
+            self.log.close()
+        self.log = io.open(self.path + '.log', 'w', encoding='utf-8')
+        self.log.write('g\t%d\n' % (self.generation))
+
+@implementer(ICandidates)
+class MemoryCandidates(object):
+
+    table_name = 'candidates'
+    validate = Validations()
+
+    def __init__(self, store):
+        self.store = store
+        self.observers = []
+
+    def create_table(self):
+        return defer.succeed(None)
+
+    def add_candidate(self, candidate_name):
+        self.validate.validate_candidate_name(candidate_name)
+        try:
+            candidate_id = self.store.add(candidate_name)
+        except ValueError:
+            return defer.fail()
+        for observer in self.observers:
+            observer.nominated(candidate_id, candidate_name)
+        return defer.succeed(candidate_id)
+
+    def import_candidates(self, records, batch_size=1000):
+        result = {'inserted': 0, 'duplicates': [], 'rejected': []}
+        for line_number, name in records:
+            if name is None:
+                result['rejected'].append((line_number, name, 'Invalid record'))
+                continue
+            try:
+                self.validate.validate_candidate_name(name)
+            except AssertionError as error:
+                result['rejected'].append((line_number, name, str(error)))
+                continue
+            if name in self.store.ids:
+                result['duplicates'].append((line_number, name, 'Already exists'))
+                continue
+            self.store.add(name)
+            result['inserted'] += 1
+        return defer.succeed(result)
+
+    def search(self, prefix, limit=10):
+        # only used until the `NameIndex` is loaded, a scan will do
+        key = fold(prefix)
+        return defer.succeed(heapq.nsmallest(limit, (
+            (i + 1, name) for i, name in enumerate(self.store.names)
+            if fold(name).startswith(key)), key=lambda record: fold(record[1])))
+
+    def all_candidates(self):
+        return defer.succeed([(i + 1, name) for i, name in enumerate(self.store.names)])
+
+    def get_candidate_by_id(self, candidate_id):
+        try:
+            self.validate.validate_candidate_id(candidate_id)
+        except AssertionError:
+            return defer.fail()
+        if not self.store.exists(candidate_id):
+            return defer.fail(IndexError('No candidate found'))
+        return defer.succeed((candidate_id, self.store.names[candidate_id - 1]))
+
+@implementer(IVotes)
+class MemoryVotes(object):
+
+    table_name = 'votes'
+    validate = Validations()
+
+    def __init__(self, store, candidates):
+        self.store = store
+        self.candidates = candidates
+        self.observers = []
+
+    def create_table(self):
+        return defer.succeed(None)
+
+    def vote_for(self, candidate_id):
+        self.validate.validate_candidate_id(candidate_id)
+        if not self.store.exists(candidate_id):
+            return defer.fail(IndexError('Candidate id is not present'))
+        total = self.store.increment(candidate_id, 1)
+        self._voted(total, candidate_id, 1)
+        return defer.succeed(total)
+
+    def _voted(self, total, candidate_id, count):
+        for observer in self.observers:
+            observer.voted(candidate_id, count, total)
+
+    def add_votes(self, counts):
+        # check every candidate first, like the transaction nothing is
+        # applied when any total would overflow
+        missing, found = [], []
+        for candidate_id, count in counts.items():
+            self.validate.validate_candidate_id(candidate_id)
+            if not self.store.exists(candidate_id):
+                missing.append(candidate_id)
+            elif self.store.counters[candidate_id - 1] + count > MAX_INTEGER:
+                return defer.fail(OverflowError('Vote total out of range'))
+            else:
+                found.append((candidate_id, count))
+        for candidate_id, count in found:
+            total = self.store.increment(candidate_id, count)
+            self._voted(total, candidate_id, count)
+        return defer.succeed(missing)
+
+    def vote_total(self, candidate_id):
+        # like the votes table, candidates without votes have no record
+        if not self.store.exists(candidate_id) or not self.store.counters[candidate_id - 1]:
+            return defer.succeed([])
+        return defer.succeed([(
+            candidate_id,
+            self.store.names[candidate_id - 1],
+            self.store.counters[candidate_id - 1])])
+
+    def all_vote_totals(self):
+        names, counters = self.store.names, self.store.counters
+        return defer.succeed([
+            (i + 1, names[i], counters[i] or None) for i in range(len(names))])
+
+    def vote_totals_page(self, order='votes', limit=100, after=None):
+        # no index, a bounded heap keeps a page at O(n log limit)
+        names, counters = self.store.names, self.store.counters
+        if order == 'name':
+            after = after or ''
+            page = heapq.nsmallest(limit, (
+                (name, i + 1) for i, name in enumerate(names) if name > after))
+            return defer.succeed([
+                (candidate_id, name, counters[candidate_id - 1]) for name, candidate_id in page])
+        keys = ((counters[i], i + 1) for i in range(len(names)))
+        if after is not None:
+            after = tuple(after)
+            keys = (key for key in keys if key < after)
+        page = heapq.nlargest(limit, keys)
+        return defer.succeed([
+            (candidate_id, names[candidate_id - 1], votes) for votes, candidate_id in page])
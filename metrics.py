@@ -0,0 +1,205 @@
+from bisect import bisect_left
+import threading
+
+# seconds, from a cached read up to a request stuck behind the pool
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, escape(value)) for name, value in pairs))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    """
+    A named metric with a fixed set of label names. Values are kept per
+    combination of label values; `function`, when given, is called at
+    scrape time instead so values that already exist elsewhere cost
+    nothing to record.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()   # some values are recorded from pool threads
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        """
+        :return: list of `(name, labels, value)` in exposition order.
+        """
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        with self.lock:
+            values = sorted(self.values.items())
+        return [
+            (self.name, format_labels(self.labelnames, key), value)
+            for key, value in values]
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation.replace('\n', ' ')),
+            '# TYPE %s %s' % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            if value is not None:
+                lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)    # first bucket with value <= le
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((
+                    self.name + '_bucket',
+                    format_labels(self.labelnames, key, [('le', format_value(float(bound)))]),
+                    cumulative))
+            labels = format_labels(self.labelnames, key)
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text format, as bytes.
+        """
+        return ('\n'.join(metric.render() for metric in self.metrics) + '\n').encode('utf-8')
+
+class Metrics(object):
+    """
+    The application's metrics. Request and database timings are recorded
+    as they happen; cache and pool figures are read when scraped.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.registry = Registry()
+        self.requests = self.registry.add(Histogram(
+            'vote_http_request_duration_seconds',
+            'Time spent handling API requests, JSON encoding included',
+            ['route', 'method', 'code']))
+        self.in_flight = self.registry.add(Gauge(
+            'vote_http_requests_in_flight', 'API requests being handled'))
+        self.rejected = self.registry.add(Counter(
+            'vote_requests_rejected_total', 'Requests turned away before any database work',
+            ['reason']))
+        self.serialize = self.registry.add(Histogram(
+            'vote_json_encode_seconds', 'Time spent encoding JSON responses', ['route']))
+        self.queries = self.registry.add(Histogram(
+            'vote_db_statement_duration_seconds',
+            'Time from a pool thread starting a statement until its result is back, commit included',
+            ['statement']))
+        self.pool_wait = self.registry.add(Histogram(
+            'vote_db_pool_wait_seconds', 'Time statements wait for a pool thread', ['pool']))
+
+    def watch_pool(self, name, pool):
+        """
+        Report the work queued for `pool`'s threads.
+        """
+        statistics = lambda: pool.threadpool._team.statistics()
+        self.registry.add(Gauge(
+            'vote_db_pool_%s_backlog' % (name), 'Statements waiting for a %s pool thread' % (name),
+            function=lambda: statistics().backloggedWorkCount))
+        self.registry.add(Gauge(
+            'vote_db_pool_%s_busy' % (name), 'Busy %s pool threads' % (name),
+            function=lambda: statistics().busyWorkerCount))
+
+    def watch_queue(self, database):
+        """
+        Report the requests waiting for a `QueuedDatabase`'s thread.
+        """
+        self.registry.add(Gauge(
+            'vote_db_queue_backlog', 'Statements waiting for the database thread',
+            function=lambda: database.backlog))
+
+    def watch_cache(self, cache):
+        """
+        Report a `TallyCache`'s hits and misses.
+        """
+        self.registry.add(Counter(
+            'vote_cache_hits_total', 'Leaderboard reads served from the cache',
+            function=lambda: cache.hits))
+        self.registry.add(Counter(
+            'vote_cache_misses_total', 'Leaderboard reads that loaded from the database',
+            function=lambda: cache.misses))
+        self.registry.add(Gauge(
+            'vote_cache_hit_ratio', 'Share of leaderboard reads served from the cache',
+            function=lambda: cache.hits / float(cache.hits + cache.misses)
+                if cache.hits + cache.misses else None))
+
+    def render(self):
+        return self.registry.render()
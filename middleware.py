@@ -1,36 +1,91 @@
 from functools import wraps
-import json
+from timeit import default_timer as perf_counter
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
+
+import serializers
+
+def encoded(value):
+    """
+    Serialize a constant response once, `Jsonify` passes `bytes` through.
+    """
+    return serializers.dumps(value)
+
+INTERNAL_ISSUES = encoded({'status': 'Internal Issues'})
 
 class Jsonify(object):
 
-    def __init__(self, router):
+    def __init__(self, router, dumps=None):
         self.router = router
+        self.dumps = dumps     # None follows `serializers.use`
 
-    def jsonify(self, f):
+    def jsonify(self, f, route=None):
         @wraps(f)
         def deco(*args, **kwargs):
-            request = args[1]
-            result = defer.maybeDeferred(f, *args, **kwargs)
-            result.addCallback(self.stringify, request)
-            result.addErrback(self.stringify_failure, request)
-            return result
+            metrics = getattr(args[0], 'metrics', None)
+            if metrics is not None:
+                return self.measured(metrics, route or f.__name__, f, *args, **kwargs)
+            return self.respond(self.stringify, f, args, kwargs)
         return deco
 
+    def respond(self, stringify, f, args, kwargs):
+        """
+        Call a handler and encode its response. A handler that returns a
+        value rather than a `Deferred` is answered without creating one.
+        """
+        request = args[1]
+        try:
+            result = f(*args, **kwargs)
+            if not isinstance(result, defer.Deferred):
+                return stringify(result, request)
+        except Exception:
+            return self.stringify_failure(Failure(), request)
+        result.addCallback(stringify, request)
+        result.addErrback(self.stringify_failure, request)
+        return result
+
+    def measured(self, metrics, route, f, *args, **kwargs):
+        """
+        `jsonify` that also records the request's latency, the time spent
+        encoding the response and the number of requests in flight.
+        """
+        request = args[1]
+        start = perf_counter()
+        metrics.in_flight.inc()
+
+        def stringify(value, request):
+            encoding = perf_counter()
+            result = self.stringify(value, request)
+            metrics.serialize.observe(perf_counter() - encoding, route=route)
+            return result
+
+        def done(result):
+            metrics.in_flight.dec()
+            metrics.requests.observe(
+                perf_counter() - start, route=route,
+                method=request.method.decode('ascii'), code=request.code)
+            return result
+
+        result = self.respond(stringify, f, args, kwargs)
+        if isinstance(result, defer.Deferred):
+            return result.addBoth(done)
+        return done(result)
+
     def stringify(self, value, request):
         request.setHeader('Content-Type', 'application/json')
-        if value != None:
-            result = json.dumps(value)
-            return result
+        if isinstance(value, bytes):
+            return value    # already serialized
+        if value is not None:
+            return (self.dumps or serializers.dumps)(value)
 
     def stringify_failure(self, failure, request):
         request.setResponseCode(500)
         request.setHeader('Content-Type', 'application/json')
-        return json.dumps({'status': 'Internal Issues'})
+        return INTERNAL_ISSUES
 
     def route(self, url, *args, **kwargs):
         def deco(f):
-            f = self.jsonify(f)
+            f = self.jsonify(f, url)
             self.router.route(url, *args, **kwargs)(f)
         return deco
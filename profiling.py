@@ -0,0 +1,102 @@
+import cProfile
+import os
+import pstats
+import time
+
+from twisted.python import log
+
+MAX_SECONDS = 600
+MAX_REQUESTS = 1000000
+
+class Profiler(object):
+    """
+    Runs cProfile on the reactor thread of a server that's already up,
+    for a number of seconds or API requests, whichever comes first, and
+    writes the stats to `directory` as `profile-<pid>-<time>[-<n>].pstats`
+    along with a text summary (`.txt`) of the most expensive functions.
+
+    Nothing is hooked into the reactor or the request path until
+    profiling starts, and all of it is removed when it stops.
+    """
+
+    def __init__(self, directory, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.directory = directory
+        self.clock = clock
+        self.profile = None
+        self.path = None
+        self.remaining = None   # requests left to profile
+        self.timeout = None
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def start(self, seconds=None, requests=None):
+        """
+        Start profiling until `seconds` have passed or `requests` API
+        requests have finished. Must be called from the reactor thread.
+
+        :return: the path the stats will be written to.
+        :raises RuntimeError: profiling is already running.
+        :raises ValueError: neither or an out of range limit.
+        """
+        if self.active:
+            raise RuntimeError('Already profiling')
+        if seconds is None and requests is None:
+            raise ValueError('Profile for a number of seconds or requests')
+        if seconds is not None and not 0 < seconds <= MAX_SECONDS:
+            raise ValueError('Seconds must be between 1-%d' % (MAX_SECONDS))
+        if requests is not None and not 0 < requests <= MAX_REQUESTS:
+            raise ValueError('Requests must be between 1-%d' % (MAX_REQUESTS))
+
+        name = os.path.join(self.directory, 'profile-%d-%s' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.path, suffix = name + '.pstats', 1
+        while os.path.exists(self.path):
+            # several profiles within a second
+            suffix += 1
+            self.path = '%s-%d.pstats' % (name, suffix)
+        self.remaining = requests
+        if seconds is not None:
+            self.timeout = self.clock.callLater(seconds, self.stop)
+        log.msg('Profiling for %s seconds / %s requests into %s' % (seconds, requests, self.path))
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self.path
+
+    def request(self, request):
+        """
+        Count `request` once it's finished, while profiling by requests.
+        """
+        if self.remaining is not None:
+            request.notifyFinish().addBoth(self._finished)
+
+    def _finished(self, result):
+        if self.remaining is None:
+            return     # stopped by the timeout in the meantime
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop profiling and write out the stats.
+
+        :return: the path of the stats file, `None` when not profiling.
+        """
+        if not self.active:
+            return None
+        profile, self.profile = self.profile, None
+        profile.disable()
+        if self.timeout is not None and self.timeout.active():
+            self.timeout.cancel()
+        self.timeout = self.remaining = None
+
+        profile.dump_stats(self.path)
+        with open(self.path[:-len('.pstats')] + '.txt', 'w') as summary:
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('cumulative').print_stats(50)
+        log.msg('Profile written to %s' % (self.path))
+        return self.path
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from hashlib import blake2b
+import math
+import struct
+
+HASHES = struct.Struct('<QQ')
+
+def client_key(request, cookie=None):
+    """
+    Identify the client behind `request`: the value of the `cookie` cookie
+    when one is configured and sent, the peer's address otherwise.
+
+    :return: bytes
+    """
+    if cookie is not None:
+        value = request.getCookie(cookie)
+        if value:
+            return b'c:' + value
+    host = getattr(request.getClientAddress(), 'host', None) or ''
+    return b'a:' + host.encode('ascii', 'replace')
+
+class RateLimiter(object):
+    """
+    Token buckets per client: each client may make `burst` requests at
+    once and `rate` requests per second after that. A request whose cost
+    is only known once it's read takes a token up front and is `charge`d
+    the rest afterwards, which may put the bucket in debt.
+
+    Only the `max_clients` most recently seen clients keep a bucket. When a
+    new client pushes out the least recently seen one, that client starts
+    over with a full bucket next time, which costs nothing but a burst as
+    long as `max_clients` is well above the number of clients active
+    within `burst / rate` seconds.
+    """
+
+    def __init__(self, rate, burst=None, max_clients=100000, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.max_clients = max_clients
+        self.clock = clock
+        self.buckets = OrderedDict()    # key -> [tokens, updated at], oldest first
+
+    def delay(self, key):
+        """
+        Take a token from `key`'s bucket.
+
+        :return: 0 when the request may go ahead, else the seconds until a
+            token is available.
+        """
+        bucket = self.bucket(key)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    def charge(self, key, cost):
+        """
+        Take `cost` more tokens from `key`'s bucket, however many are left.
+        """
+        self.bucket(key)[0] -= cost
+
+    def bucket(self, key):
+        """
+        :return: `key`'s `[tokens, updated at]`, refilled up to now.
+        """
+        now = self.clock.seconds()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+class BloomFilter(object):
+    """
+    Set membership in a fixed amount of memory. `add` and `in` may report
+    a key that was never added with a probability of about `error_rate`
+    once `capacity` keys are in, and never miss one that was.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # double hashing, k positions from two 64 bit hashes
+        first, second = HASHES.unpack(blake2b(key, digest_size=16).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+    def add(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+class VoterFilter(object):
+    """
+    Let every voter vote once. Voters are remembered in a `BloomFilter` once
+    their vote is counted, `pending` holds the votes still on their way to
+    the database so a voter can't slip a second vote in meanwhile.
+
+    Nothing is forgotten on restart or shared between worker processes, and
+    about `error_rate` of new voters are turned away as already seen once
+    `capacity` voters have voted.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.voters = BloomFilter(capacity, error_rate)
+        self.pending = set()
+
+    def begin(self, key):
+        """
+        :return: False when `key` has voted or is voting already.
+        """
+        if key in self.pending or key in self.voters:
+            return False
+        self.pending.add(key)
+        return True
+
+    def end(self, key, counted):
+        self.pending.discard(key)
+        if counted:
+            self.voters.add(key)
@@ -0,0 +1,94 @@
+from bisect import bisect_left, insort
+
+from twisted.internet import defer
+from twisted.python import log
+from zope.interface import implementer
+
+from interfaces import ITallyObserver
+
+ASCII_LOWER = dict((ord(c), ord(c) + 32) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+def fold(name):
+    """
+    Lower case ASCII letters only, as sqlite's `nocase` collation does, so
+    the index and the database agree on matches and their order.
+    """
+    return name.translate(ASCII_LOWER)
+
+@implementer(ITallyObserver)
+class NameIndex(object):
+    """
+    Candidate names kept sorted in memory so a prefix search is a binary
+    search followed by reading the next `limit` entries.
+
+    Like `TallyCache`, the index is loaded in full and then kept current by
+    `nominated` notifications; `ttl` bounds how long it's trusted when
+    another process may add candidates. While it's cold, searches go to the
+    database and a reload starts in the background.
+    """
+
+    def __init__(self, ttl=30, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.ttl = ttl
+        self.clock = clock
+        self.keys = []      # sorted (folded name, id)
+        self.names = {}     # id -> name
+        self.loaded_at = None
+        self._loading = None    # nominations seen while loading
+
+    @property
+    def warm(self):
+        if self.loaded_at is None or not self.ttl:
+            return False
+        return self.clock.seconds() - self.loaded_at < self.ttl
+
+    def search(self, prefix, limit=10):
+        """
+        :return: up to `limit` `(id, name)` whose name starts with `prefix`,
+            ignoring the case of ASCII letters, in name order.
+        """
+        key = fold(prefix)
+        keys = self.keys
+        results = []
+        for i in range(bisect_left(keys, (key,)), len(keys)):
+            name_key, candidate_id = keys[i]
+            if len(results) == limit or not name_key.startswith(key):
+                break
+            results.append((candidate_id, self.names[candidate_id]))
+        return results
+
+    def refresh(self, load):
+        """
+        Reload the index in the background unless that's already happening.
+
+        :param load: Callable returning a `Deferred` that fires with rows
+            starting with `(id, name)`.
+        """
+        if self._loading is not None or not self.ttl:
+            return
+        self._loading = []
+        d = defer.maybeDeferred(load)
+        d.addCallbacks(self._loaded, self._load_failed)
+
+    def _loaded(self, rows):
+        nominations, self._loading = self._loading, None
+        names = dict((row[0], row[1]) for row in rows)
+        names.update(nominations)
+        self.names = names
+        self.keys = sorted((fold(name), candidate_id) for candidate_id, name in names.items())
+        self.loaded_at = self.clock.seconds()
+
+    def _load_failed(self, failure):
+        self._loading = None
+        log.err(failure, 'Loading the candidate name index failed')
+
+    def nominated(self, candidate_id, name):
+        if self._loading is not None:
+            self._loading.append((candidate_id, name))
+        if self.loaded_at is not None and candidate_id not in self.names:
+            self.names[candidate_id] = name
+            insort(self.keys, (fold(name), candidate_id))
+
+    def voted(self, candidate_id, count, total):
+        pass
@@ -0,0 +1,75 @@
+"""
+JSON encoders producing UTF-8 `bytes`, the fastest one installed is used
+unless another is asked for.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+CHUNK_SIZE = 1000   # list items encoded per call by `encode_list`
+
+def orjson_dumps(value):
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+def ujson_dumps(value):
+    return ujson.dumps(value, ensure_ascii=False).encode('utf-8')
+
+def json_dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+SERIALIZERS = {'json': json_dumps}
+if ujson is not None:
+    SERIALIZERS['ujson'] = ujson_dumps
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson_dumps
+
+def get_serializer(name=None):
+    """
+    :param name: `orjson`, `ujson` or `json`, None picks the fastest one
+        installed.
+    :return: callable encoding a value as `bytes`.
+    """
+    if name is None:
+        name = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('JSON serializer %s is not available' % (name))
+
+dumps = get_serializer()
+
+def use(name):
+    """
+    Switch every response encoded from now on to the serializer `name`.
+    """
+    global dumps
+    dumps = get_serializer(name)
+
+def encode_list(key, items, chunk_size=CHUNK_SIZE, dumps=None):
+    """
+    Encode `{key: [items]}` a chunk of items at a time, so a long list is
+    never held as dicts and text at once.
+
+    :param items: iterable of JSON serializable values, eg. a generator.
+    :return: iterator of `bytes` that join into the document.
+    """
+    dumps = dumps or globals()['dumps']
+    yield b'{' + dumps(key) + b':['
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield (b'' if first else b',') + dumps(chunk)[1:-1]
+            chunk, first = [], False
+    if chunk:
+        yield (b'' if first else b',') + dumps(chunk)[1:-1]
+    yield b']}'
@@ -0,0 +1,203 @@
+from twisted.internet import defer, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implementer
+
+from interfaces import ITallyObserver
+import serializers
+
+def event(entries):
+    """
+    Encode tally entries as a single server-sent event.
+    """
+    return b'data: ' + serializers.dumps({'candidates': entries}) + b'\n\n'
+
+@implementer(IPushProducer)
+class Subscriber(object):
+    """
+    A single `text/event-stream` response.
+
+    The subscriber is registered as the request's producer, so the
+    transport pauses it once its write buffer is full. Changes that arrive
+    while it's paused (or before its first snapshot went out) are merged
+    per candidate and written when it resumes; a subscriber that stays
+    paused for too many ticks is disconnected.
+    """
+
+    def __init__(self, broadcaster, request):
+        self.broadcaster = broadcaster
+        self.request = request
+        self.ready = False
+        self.paused = False
+        self.paused_ticks = 0
+        self.pending = {}
+        self.done = defer.Deferred(lambda d: self.broadcaster.unsubscribe(self))
+
+    def start(self, snapshot):
+        self.request.write(snapshot)
+        self.ready = True
+        self.flush()
+
+    def send(self, payload, changes):
+        if self.ready and not self.paused:
+            self.request.write(payload)
+            return
+
+        merge(self.pending, changes)
+        if self.paused:
+            self.paused_ticks += 1
+            if self.paused_ticks > self.broadcaster.max_paused_ticks:
+                self.drop()
+
+    def flush(self):
+        if self.pending and self.ready and not self.paused:
+            pending, self.pending = self.pending, {}
+            self.request.write(event(list(pending.values())))
+
+    def drop(self):
+        """
+        Disconnect a consumer that can't keep up.
+        """
+        self.broadcaster.unsubscribe(self)
+        transport = getattr(self.request, 'transport', None)
+        if transport is not None and hasattr(transport, 'abortConnection'):
+            transport.abortConnection()
+        elif not self.done.called:
+            self.done.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.paused_ticks = 0
+        self.flush()
+
+    def stopProducing(self):
+        self.broadcaster.unsubscribe(self)
+
+def merge(pending, changes):
+    for entry in changes:
+        current = pending.get(entry['id'])
+        if current is None:
+            pending[entry['id']] = dict(entry)
+        else:
+            votes = max(current['votes'], entry['votes'])     # totals only grow
+            current.update(entry)
+            current['votes'] = votes
+
+@implementer(ITallyObserver)
+class Broadcaster(object):
+    """
+    Fan tally changes out to every live results stream.
+
+    Changes are collected per candidate and written once per `tick`, so a
+    burst of votes costs one encoded event that is shared by all
+    subscribers. A comment line is sent every `keepalive` seconds to keep
+    idle connections open through proxies.
+    """
+
+    def __init__(self, tick=0.5, keepalive=15, max_paused_ticks=20, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.tick = tick
+        self.max_paused_ticks = max_paused_ticks
+        self.clock = clock
+        self.subscribers = set()
+        self.changes = {}
+        self._call = None
+        self.keepalive = task.LoopingCall(self.ping)
+        self.keepalive.clock = clock
+        self.keepalive_interval = keepalive
+
+    def subscribe(self, request):
+        subscriber = Subscriber(self, request)
+        request.registerProducer(subscriber, True)
+        self.subscribers.add(subscriber)
+        if not self.keepalive.running and self.keepalive_interval:
+            self.keepalive.start(self.keepalive_interval, now=False)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.discard(subscriber)
+        if subscriber.request.channel is not None:    # still connected
+            subscriber.request.unregisterProducer()
+        if not self.subscribers and self.keepalive.running:
+            self.keepalive.stop()
+
+    def nominated(self, candidate_id, name):
+        self._changed({'id': candidate_id, 'name': name, 'votes': 0})
+
+    def voted(self, candidate_id, count, total):
+        self._changed({'id': candidate_id, 'votes': total})
+
+    def _changed(self, entry):
+        if not self.subscribers:
+            return      # nobody is listening, nothing to keep
+        merge(self.changes, [entry])
+        if self._call is None:
+            self._call = self.clock.callLater(self.tick, self.broadcast)
+
+    def broadcast(self):
+        self._call = None
+        changes = list(self.changes.values())
+        self.changes = {}
+        if not changes:
+            return
+
+        payload = event(changes)
+        for subscriber in list(self.subscribers):
+            subscriber.send(payload, changes)
+
+    def ping(self):
+        for subscriber in list(self.subscribers):
+            if subscriber.ready and not subscriber.paused:
+                subscriber.request.write(b':\n\n')
+
+class TallyPoller(object):
+    """
+    Feed observers from the database instead of the local write path, for
+    when other processes write votes too. Every `interval` seconds, while
+    `active()` is true, the tally is loaded and candidates whose totals
+    changed since the last poll are passed on as `nominated`/`voted`.
+    """
+
+    def __init__(self, load, observers, interval=1, active=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.load = load
+        self.observers = observers
+        self.active = active
+        self.seen = {}
+        self.loop = task.LoopingCall(self.poll)
+        self.loop.clock = clock
+        self.interval = interval
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def poll(self):
+        if self.active is not None and not self.active():
+            self.seen = {}      # changes aren't tracked while nobody listens
+            return
+        d = self.load()
+        d.addCallback(self.compare)
+        d.addErrback(log.err)   # try again on the next poll
+        return d
+
+    def compare(self, rows):
+        for candidate_id, name, votes in rows:
+            votes = votes or 0
+            seen = self.seen.get(candidate_id)
+            self.seen[candidate_id] = votes
+            for observer in self.observers:
+                if seen is None:
+                    observer.nominated(candidate_id, name)
+                if votes and votes != seen:
+                    observer.voted(candidate_id, votes - (seen or 0), votes)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from batching import VoteBuffer
+from interfaces import IVotes
+
+class TestVoteBuffer(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.votes = MagicMock()
+        self.votes.add_votes.return_value = defer.succeed([])
+        self.buffer = VoteBuffer(self.votes, interval=1, threshold=10, clock=self.clock)
+
+    def test_contract(self):
+        assert verifyClass(IVotes, VoteBuffer), 'IVotes contract not fulfilled'
+
+    def test_votes_coalesced_per_candidate(self):
+        """ Votes are held until the interval elapses, then written at once """
+        self.buffer.start()
+        results = []
+        for candidate_id in [1, 1, 2, 1]:
+            self.buffer.vote_for(candidate_id).addCallback(results.append)
+
+        self.votes.add_votes.assert_not_called()
+        self.clock.advance(1)
+        self.votes.add_votes.assert_called_once_with({1: 3, 2: 1})
+        self.assertEqual(results, [None] * 4)
+        self.assertEqual(self.buffer.pending_votes, 0)
+
+    def test_threshold_forces_flush(self):
+        for i in range(10):
+            self.buffer.vote_for(5)
+        self.votes.add_votes.assert_called_once_with({5: 10})
+
+    def test_missing_candidate(self):
+        """ Only the votes for unknown candidates fail """
+        self.votes.add_votes.return_value = defer.succeed([404])
+        good = self.buffer.vote_for(1)
+        bad = self.buffer.vote_for(404)
+        self.buffer.flush()
+
+        self.assertIsNone(self.successResultOf(good))
+        self.assertEqual(str(self.failureResultOf(bad, IndexError).value), 'Candidate id is not present')
+
+    def test_database_failure(self):
+        self.votes.add_votes.return_value = defer.fail(Failure(RuntimeError('locked')))
+        d = self.buffer.vote_for(1)
+        self.buffer.flush()
+        self.failureResultOf(d, RuntimeError)
+
+    def test_stop_flushes_pending(self):
+        self.buffer.start()
+        d = self.buffer.vote_for(3)
+        self.buffer.stop()
+        self.votes.add_votes.assert_called_once_with({3: 1})
+        self.assertFalse(self.buffer.loop.running)
+        self.successResultOf(d)
+
+    def test_invalid_id(self):
+        self.assertRaises(AssertionError, self.buffer.vote_for, -1)
+        self.assertEqual(self.buffer.pending_votes, 0)
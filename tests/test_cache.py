@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+import json
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from cache import TallyCache
+from interfaces import ITallyObserver
+
+class TestTallyCache(TestCase):
+
+    rows = [(1, 'Batman', None), (2, 'Spiderman', 4)]
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = TallyCache(ttl=10, clock=self.clock)
+        self.load = MagicMock(side_effect=lambda: defer.succeed(self.rows))
+
+    def fetch(self):
+        return json.loads(self.successResultOf(self.cache.fetch(self.load)))
+
+    def test_contract(self):
+        assert verifyClass(ITallyObserver, TallyCache), 'ITallyObserver contract not fulfilled'
+
+    def test_hit_after_miss(self):
+        """ Only the first read goes to the database """
+        expected = {'candidates': [
+            {'id': 1, 'name': 'Batman', 'votes': 0},
+            {'id': 2, 'name': 'Spiderman', 'votes': 4}]}
+        self.assertEqual(self.fetch(), expected)
+        self.assertEqual(self.fetch(), expected)
+        self.assertEqual(self.load.call_count, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_bytes_response(self):
+        self.assertIsInstance(self.successResultOf(self.cache.fetch(self.load)), bytes)
+
+    def test_updated_in_place(self):
+        """ Writes update the cached copy without a reload """
+        self.fetch()
+        self.cache.voted(1, 1, 1)
+        self.cache.voted(2, 1, 5)
+        self.cache.voted(2, 1, 3)   # late notification of an older total
+        self.cache.nominated(3, 'Superman')
+        candidates = self.fetch()['candidates']
+        self.assertEqual([c['votes'] for c in candidates], [1, 5, 0])
+        self.assertEqual(candidates[2]['name'], 'Superman')
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_ttl(self):
+        self.fetch()
+        self.clock.advance(10)
+        self.fetch()
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_ttl_zero_disables(self):
+        self.cache.ttl = 0
+        self.fetch()
+        self.fetch()
+        self.assertEqual(self.load.call_count, 2)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_concurrent_misses_share_query(self):
+        """ Reads that miss while a load is in flight wait for that load """
+        pending = defer.Deferred()
+        self.load.side_effect = lambda: pending
+        first = self.cache.fetch(self.load)
+        second = self.cache.fetch(self.load)
+        self.assertEqual(self.load.call_count, 1)
+
+        # committed while the query was running, replayed once it returns
+        self.cache.voted(2, 1, 9)
+        pending.callback(self.rows)
+        body = self.successResultOf(first)
+        self.assertEqual(body, self.successResultOf(second))
+        self.assertEqual(json.loads(body)['candidates'][1]['votes'], 9)
+
+    def test_unknown_candidate_expires(self):
+        self.fetch()
+        self.cache.voted(7, 1, 1)
+        self.assertFalse(self.cache.warm)
+
+    def test_load_failure(self):
+        self.load.side_effect = lambda: defer.fail(RuntimeError("db"))
+        self.failureResultOf(self.cache.fetch(self.load), RuntimeError)
+        self.assertFalse(self.cache.warm)
+
+    def test_version(self):
+        """ Every change moves the ETag, reads alone don't """
+        self.fetch()
+        etag = self.cache.etag
+        self.fetch()
+        self.assertEqual(self.cache.etag, etag)
+        self.cache.voted(1, 1, 1)
+        self.assertNotEqual(self.cache.etag, etag)
+        etag = self.cache.etag
+        self.cache.nominated(3, 'Superman')
+        self.assertNotEqual(self.cache.etag, etag)
+
+    def test_etag_shared_between_processes(self):
+        """ Caches holding the same tally agree on the ETag, whenever they started """
+        self.fetch()
+        self.clock.advance(0.0005)
+        other = TallyCache(ttl=0, clock=self.clock)
+        self.successResultOf(other.fetch(self.load))
+        self.assertEqual(other.etag, self.cache.etag)
+
+        self.cache.voted(2, 1, 5)
+        self.assertNotEqual(other.etag, self.cache.etag)
+
+    def test_external_change_bumps_version(self):
+        """ A reload that finds different data moves the ETag """
+        self.fetch()
+        etag = self.cache.etag
+        self.clock.advance(10)
+        self.fetch()
+        self.assertEqual(self.cache.etag, etag)
+
+        self.rows = [(1, 'Batman', 1)]
+        self.clock.advance(10)
+        self.fetch()
+        self.assertNotEqual(self.cache.etag, etag)
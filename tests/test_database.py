@@ -8,10 +8,12 @@ except ImportError:
     from mock import MagicMock, patch
 from itertools import chain
 from twisted.enterprise.adbapi import ConnectionPool
-from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 from twisted.trial.unittest import TestCase
 from zope.interface.verify import verifyClass
-from database import Database, Candidates, Validations, Votes
+from database import (
+    Database, Candidates, Query, ShardedVotes, Statement, Validations, Votes,
+    pragma_initializer, pragma_settings)
 from interfaces import ICandidates, IVotes
 
 class TestValidations(TestCase):
@@ -73,14 +75,54 @@ class TestDatabase(TestCase):
         db = Database(dbpool)
 
         # query
-        query_stmt = 'select * from sometable where something=1'
-        db.execute(query_stmt)
-        dbpool.runQuery.assert_called_with(query_stmt)
+        query_stmt = Query('select * from sometable where something=?')
+        db.execute(query_stmt, (1,))
+        dbpool.runQuery.assert_called_with(query_stmt.sql, (1,))
 
         # other SQL statements
-        sql_stmt = 'insert into sometable (col0, col1, col2) values (val0, val1, val2)'
-        db.execute(sql_stmt)
-        dbpool.runInteraction.assert_called_with(db._execute, sql_stmt)
+        sql_stmt = Statement('insert into sometable (col0, col1, col2) values (?, ?, ?)')
+        db.execute(sql_stmt, ('val0', 'val1', 'val2'))
+        dbpool.runInteraction.assert_called_with(db._execute, sql_stmt.sql, ('val0', 'val1', 'val2'))
+
+    def test_statement_kind_is_declared(self):
+        """ Reads and writes are declared, never sniffed from the SQL text """
+        dbpool = MagicMock()
+        db = Database(dbpool)
+        db.execute(Statement('select 1'))
+        dbpool.runQuery.assert_not_called()
+        db.execute(Query('with t as (select 1) select * from t'))
+        dbpool.runQuery.assert_called_with('with t as (select 1) select * from t', ())
+
+    def test_split_pools(self):
+        """ Queries go to the reader pool, writes and interactions to the writer """
+        writer, reader = MagicMock(), MagicMock()
+        db = Database(writer, reader)
+        db.execute(Query('select 1'))
+        db.execute(Statement('delete from sometable'))
+        db.interaction(db._execute, 'delete from sometable', ())
+
+        reader.runQuery.assert_called_once_with('select 1', ())
+        self.assertEqual(writer.runInteraction.call_count, 2)
+        writer.runQuery.assert_not_called()
+        reader.runInteraction.assert_not_called()
+
+    def test_pragma_profile(self):
+        """ Profiles are applied to every connection with overrides on top """
+        import sqlite3
+        pragmas = pragma_settings('throughput', busy_timeout=250, synchronous=None)
+        self.assertEqual(pragmas['journal_mode'], 'WAL')
+        self.assertEqual(pragmas['synchronous'], 'NORMAL')
+        self.assertEqual(pragmas['busy_timeout'], 250)
+
+        connection = sqlite3.connect(':memory:')
+        pragma_initializer(pragmas)(connection)
+        self.assertEqual(connection.execute('pragma busy_timeout').fetchone()[0], 250)
+        self.assertEqual(connection.execute('pragma temp_store').fetchone()[0], 2)   # MEMORY
+
+    def test_pragma_validation(self):
+        self.assertRaises(ValueError, pragma_settings, 'fastest')
+        self.assertRaises(ValueError, pragma_settings, 'default', foreign_keys='on')
+        self.assertRaises(ValueError, pragma_settings, 'default', journal_mode='wal; drop table votes')
 
     @inlineCallbacks
     def test_real_database(self):
@@ -97,7 +139,7 @@ class TestDatabase(TestCase):
 
         # check if the db exists, create it if it doesn't
         if not path.exists(db_path):
-            create_table_stmt = 'create table %s (key int primary key, name text)' % (table_name)
+            create_table_stmt = Statement('create table %s (key int primary key, name text)' % (table_name))
             yield db.execute(create_table_stmt)
 
         # remove any unnecessary files after this test case runs
@@ -106,8 +148,8 @@ class TestDatabase(TestCase):
         # insert a record into the table
         key = 1
         name = 'test'
-        insert_stmt = "insert into %s (key, name) values (%d, '%s')" % (table_name, key, name)
-        yield db.execute(insert_stmt)
+        insert_stmt = Statement('insert into %s (key, name) values (?, ?)' % (table_name))
+        yield db.execute(insert_stmt, (key, name))
 
         # use the DBAPI 2.0 module to verify results
         connection = sqlite3.connect(db_name)
@@ -139,15 +181,24 @@ class TestCandidates(TestCase):
     def test_create_table(self):
         """ Validate the create table syntax gets called by the database object """
         self.candidates.create_table()
-        sql_stmt = 'create table %s (id integer primary key, name text unique not null)' % (self.table_name)
+        sql_stmt = Statement('create table %s (id integer primary key, name text unique not null)' % (self.table_name))
         self.db.execute.assert_called_with(sql_stmt)
 
     def test_add_candidate(self):
         """ Validate appropriate insert syntax is called with proper name """
         candidate = 'Kanye West'
         self.candidates.add_candidate(candidate)
-        insert_stmt = "insert into %s (name) values ('%s')" % (self.table_name, candidate)
-        self.db.execute.assert_called_with(insert_stmt)
+        insert_stmt = Statement('insert into %s (name) values (?)' % (self.table_name))
+        self.db.execute.assert_called_with(insert_stmt, (candidate,))
+
+    def test_add_candidate_quotes(self):
+        """ Names are bound parameters, quotes in them can't break the SQL """
+        self.candidates.validate = MagicMock()
+        candidate = "Robert'); drop table candidates;--"
+        self.candidates.add_candidate(candidate)
+        args, kwargs = self.db.execute.call_args
+        self.assertEqual(args[1], (candidate,))
+        self.assertNotIn(candidate, args[0].sql)
 
     def test_get_candidate_by_id(self):
         """
@@ -172,9 +223,8 @@ class TestCandidates(TestCase):
         @d.addCallback
         def verify_function_calls(null):
             """ Verify correct SQL statement was executed """
-            expected_sql_stmt = 'select id, name from %s where id=%d' % (
-                self.table_name, candidate_id)
-            self.db.execute.assert_called_with(expected_sql_stmt)
+            expected_sql_stmt = Query('select id, name from %s where id=?' % (self.table_name))
+            self.db.execute.assert_called_with(expected_sql_stmt, (candidate_id,))
 
         return d    # wait for the Deferreds to finish
 
@@ -255,6 +305,25 @@ class TestCandidates(TestCase):
 
         return gatherResults(deferred_list)
 
+    def test_import_candidates(self):
+        """ Imports run in batches, reporting duplicates and invalid names """
+        import sqlite3
+        connection = sqlite3.connect(':memory:')
+        cursor = connection.cursor()
+        cursor.execute('create table candidates (id integer primary key, name text unique not null)')
+        cursor.execute("insert into candidates (name) values ('Ada')")
+
+        records = enumerate(['Grace', 'Ada', 'Alan', 'k13!n', 'Grace', None, 'Linus'], 1)
+        result = self.candidates._import_candidates(cursor, records, batch_size=3)
+        self.assertEqual(result['inserted'], 3)
+        self.assertEqual(result['duplicates'], [
+            (2, 'Ada', 'Already exists'),
+            (5, 'Grace', 'Already exists')])
+        self.assertEqual([r[0] for r in result['rejected']], [4, 6])
+
+        cursor.execute('select name from candidates order by id')
+        self.assertEqual([r[0] for r in cursor.fetchall()], ['Ada', 'Grace', 'Alan', 'Linus'])
+
     def test_add_name_too_long(self):
         """ Verify names length >= 25 raise exception """
         name = 'abcdefghijklmnopqrstuvwxyz'
@@ -286,48 +355,207 @@ class TestVotes(TestCase):
 
     def test_create_table(self):
         self.votes.create_table()
-        sql_stmt = 'create table %s (candidate int primary key, votes int not null, foreign key(candidate) references %s(id))' % \
-            (self.table_name, self.candidates.table_name)
+        sql_stmt = Statement('create table %s (candidate int primary key, votes int not null, foreign key(candidate) references %s(id))' % \
+            (self.table_name, self.candidates.table_name))
         self.votes.db.execute.assert_called_with(sql_stmt)
 
-    def test_vote_for_candidate_exist_in_table(self):
+    def test_vote_for_upsert(self):
+        """ A vote is a single atomic upsert run in one interaction """
         candidate_id = 1
-        votes = 100
-        record = (candidate_id, 'Candidate Name', votes)
-        # mock a method call, devs MUST keep the expected results up-to-date!
-        self.votes.vote_total = MagicMock(return_value=[record])
+        self.votes.vote_for(candidate_id)
+        self.db.interaction.assert_called_with(self.votes._upsert_vote, candidate_id)
+        self.db.execute.assert_not_called()
+
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (5,)
+        self.assertEqual(self.votes._upsert_vote(cursor, candidate_id), 5)
+        sql_stmt = "insert into %s (candidate, votes) select id, 1 from %s where id=? " \
+            "on conflict(candidate) do update set votes=votes+1 returning votes" % (
+                self.table_name, self.candidates.table_name)
+        cursor.execute.assert_called_with(sql_stmt, (candidate_id,))
 
-        d = self.votes.vote_for(candidate_id)
-        @d.addCallback
-        def verify_update(results):
-            sql_stmt = "update %s set votes=%d where candidate=%d" % (self.table_name, votes+1, candidate_id)
-            self.db.execute.assert_called_with(sql_stmt)
+    def test_vote_for_candidate_not_exist(self):
+        """ The upsert touching no rows means the candidate doesn't exist """
+        cursor = MagicMock()
+        cursor.fetchone.return_value = None
+        try:
+            self.votes._upsert_vote(cursor, 1000000)
+        except IndexError as exception:
+            assert str(exception) == 'Candidate id is not present'
+        else:
+            raise Exception('Unexpected success')
+        cursor.execute.assert_called_with(self.votes.upsert_stmt.sql, (1000000,))
 
-    def test_vote_for_candidate_first_time(self):
-        candidate_id = 1
-        record = (candidate_id, 'Candidate Name')
-        # mock a method call, devs MUST keep the expected results up-to-date!
-        self.candidates.get_candidate_by_id.return_value = [record]
+    def test_add_votes(self):
+        """ Batched votes only count for existing candidates """
+        import sqlite3
+        connection = sqlite3.connect(':memory:')
+        cursor = connection.cursor()
+        cursor.execute('create table candidates (id integer primary key, name text unique not null)')
+        cursor.execute('create table votes (candidate int primary key, votes int not null)')
+        cursor.execute("insert into candidates (name) values ('Ada'), ('Grace')")
+        cursor.execute('insert into votes (candidate, votes) values (1, 5)')
+
+        missing, totals = self.votes._add_votes(cursor, {1: 3, 2: 2, 99: 1})
+        self.assertEqual(missing, [99])
+        self.assertEqual(sorted(totals), [(1, 8), (2, 2)])
+        cursor.execute('select candidate, votes from votes order by candidate')
+        self.assertEqual(cursor.fetchall(), [(1, 8), (2, 2)])
+
+    def test_observers_notified(self):
+        """ Observers receive the committed total after a vote """
+        from twisted.internet.defer import succeed
+        observer = MagicMock()
+        self.votes.observers.append(observer)
+        self.db.interaction.return_value = succeed(42)
+
+        d = self.votes.vote_for(3)
+        self.assertEqual(self.successResultOf(d), 42)
+        observer.voted.assert_called_once_with(3, 1, 42)
+
+    def test_vote_for_invalid_id(self):
+        """ Invalid ids never reach the database """
+        for invalid in ['100', 1.0, -1]:
+            self.assertRaises(AssertionError, self.votes.vote_for, invalid)
+        self.db.interaction.assert_not_called()
+
+class TestShardedVotes(TestCase):
 
-        d = self.votes.vote_for(candidate_id)
-        @d.addCallback
-        def verify_insert(results):
-            sql_stmt = "insert into %s (candidate, votes) values (%d, 1)" % (self.table_name, candidate_id)
-            self.db.execute.assert_called_with(sql_stmt)
+    def setUp(self):
+        import sqlite3
+        self.connection = sqlite3.connect(':memory:')
+        self.cursor = self.connection.cursor()
+        self.cursor.execute('create table candidates (id integer primary key, name text unique not null)')
+        self.cursor.execute("insert into candidates (name) values ('Ada'), ('Grace')")
+        self.candidates = MagicMock()
+        self.candidates.table_name = 'candidates'
+        self.votes = ShardedVotes(MagicMock(), self.candidates, shards=4)
+        self.cursor.execute(self.votes.create_stmt.sql)
 
-    def test_vote_for_candidate_not_exist(self):
-        self.votes.vote_total = MagicMock(return_value=[])
-        self.candidates.get_candidate_by_id.return_value = []
+    def test_contract(self):
+        assert verifyClass(IVotes, ShardedVotes), 'IVotes contract not fulfilled'
+
+    def test_upsert_sums_shards(self):
+        """ Each vote lands on some shard and returns the summed total """
+        totals = [self.votes._upsert_vote(self.cursor, 1) for i in range(20)]
+        self.assertEqual(totals, list(range(1, 21)))
+        self.cursor.execute('select shard from votes where candidate=1')
+        self.assertTrue(set(row[0] for row in self.cursor.fetchall()) <= set(range(4)))
+        self.assertRaises(IndexError, self.votes._upsert_vote, self.cursor, 99)
+
+    def test_add_votes(self):
+        self.votes._upsert_vote(self.cursor, 1)
+        missing, totals = self.votes._add_votes(self.cursor, {1: 3, 2: 2, 99: 1})
+        self.assertEqual(missing, [99])
+        self.assertEqual(sorted(totals), [(1, 4), (2, 2)])
+
+    def test_totals_queries(self):
+        self.votes._add_votes(self.cursor, {1: 3})
+        self.votes._add_votes(self.cursor, {1: 3})
+        self.cursor.execute(self.votes.total_query.sql, (1,))
+        self.assertEqual(self.cursor.fetchall(), [(1, 'Ada', 6)])
+        self.cursor.execute(self.votes.total_query.sql, (2,))
+        self.assertEqual(self.cursor.fetchall(), [])
+        self.cursor.execute(self.votes.all_totals_query.sql)
+        self.assertEqual(sorted(self.cursor.fetchall()), [(1, 'Ada', 6), (2, 'Grace', None)])
+
+    def test_migrate(self):
+        """ Totals survive converting between the plain and sharded layouts """
+        plain = Votes(MagicMock(), self.candidates)
+        for i in range(10):
+            self.votes._upsert_vote(self.cursor, 1)
+        self.votes._upsert_vote(self.cursor, 2)
+
+        plain._migrate_table(self.cursor)
+        self.cursor.execute('select candidate, votes from votes order by candidate')
+        self.assertEqual(self.cursor.fetchall(), [(1, 10), (2, 1)])
+
+        self.votes._migrate_table(self.cursor)
+        resharded = ShardedVotes(MagicMock(), self.candidates, shards=2)
+        resharded._migrate_table(self.cursor)
+        self.cursor.execute(resharded.all_totals_query.sql)
+        self.assertEqual(sorted(self.cursor.fetchall()), [(1, 'Ada', 10), (2, 'Grace', 1)])
+        self.cursor.execute('select max(shard) from votes')
+        self.assertTrue(self.cursor.fetchone()[0] < 2)
+
+class TestVotePages(TestCase):
+    """
+    Walk the paged listings of both votes layouts on a sqlite file.
+    """
+
+    names = ['Ada', 'Grace', 'Alan', 'Edsger', 'Barbara', 'Donald']
+    votes_per_candidate = {1: 5, 2: 9, 3: 5, 5: 1}   # 4 and 6 have no votes
 
-        d = self.votes.vote_for(1000000)
-        @d.addCallback
-        def unexpected_success(result):
-            raise Exception('Unexpected success')
+    def setUp(self):
+        from os import path
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False)
+        self.addCleanup(self.dbpool.close)
+        self.db = Database(self.dbpool)
+        self.candidates = Candidates(self.db)
 
-        @d.addErrback
-        def verify_exception(failure):
-            exception = failure.value
-            assert isinstance(exception, IndexError), 'Incorrect exception raised'
-            assert str(exception) == 'Candidate id is not present'
+    @inlineCallbacks
+    def fill(self, votes):
+        yield self.candidates.create_table()
+        yield votes.create_table()
+        yield votes.create_indexes()
+        for name in self.names:
+            yield self.candidates.add_candidate(name)
+        yield votes.add_votes(self.votes_per_candidate)
 
-        return d
+    @inlineCallbacks
+    def walk(self, votes, order, limit):
+        rows, after = [], None
+        while True:
+            page = yield votes.vote_totals_page(order, limit, after)
+            rows.extend(page)
+            if len(page) < limit:
+                break
+            after = page[-1][1] if order == 'name' else (page[-1][2], page[-1][0])
+        self.assertEqual(len(rows), len(self.names))
+        returnValue(rows)
+
+    @inlineCallbacks
+    def check(self, votes):
+        yield self.fill(votes)
+        by_votes = [
+            (2, 'Grace', 9), (3, 'Alan', 5), (1, 'Ada', 5), (5, 'Barbara', 1),
+            (6, 'Donald', 0), (4, 'Edsger', 0)]
+        for limit in (1, 2, 4, 10):
+            rows = yield self.walk(votes, 'votes', limit)
+            self.assertEqual(rows, by_votes)
+            rows = yield self.walk(votes, 'name', limit)
+            self.assertEqual(rows, sorted(by_votes, key=lambda row: row[1]))
+
+    def test_pages(self):
+        return self.check(Votes(self.db, self.candidates))
+
+    def test_sharded_pages(self):
+        return self.check(ShardedVotes(self.db, self.candidates, shards=3))
+
+    @inlineCallbacks
+    def test_index_used(self):
+        votes = Votes(self.db, self.candidates)
+        yield self.fill(votes)
+        plan = yield self.dbpool.runQuery(
+            'explain query plan ' + votes.votes_page_query.sql, (10, 10, 10))
+        self.assertIn('votes_by_votes', ' '.join(str(row) for row in plan))
+
+    @inlineCallbacks
+    def test_check_layout(self):
+        """ A votes table in the other layout is refused before any vote """
+        votes = Votes(self.db, self.candidates)
+        sharded = ShardedVotes(self.db, self.candidates, shards=3)
+        yield sharded.check_layout()    # no table yet
+        yield self.candidates.create_table()
+        yield votes.create_table()
+        yield votes.check_layout()
+        yield self.assertFailure(sharded.check_layout(), ValueError)
+        yield sharded.migrate_table()
+        yield sharded.check_layout()
+        yield self.assertFailure(votes.check_layout(), ValueError)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from database import Candidates, Query, Statement, Votes
+from dbqueue import QueuedDatabase
+from main import Application
+from metrics import Metrics
+from tests.test_vote_api import KleinResourceTester
+
+class QueuedTestCase(TestCase):
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpath = path.join(tmpdir, 'votes.sqlite')
+        self.db = QueuedDatabase(self.dbpath)
+        self.addCleanup(self.db.close)
+
+class TestQueuedDatabase(QueuedTestCase):
+
+    @defer.inlineCallbacks
+    def test_execute(self):
+        yield self.db.execute(Statement('create table t (id integer primary key, name text)'))
+        row_id = yield self.db.execute(Statement('insert into t (name) values (?)'), ('Ada',))
+        self.assertEqual(row_id, 1)
+        rows = yield self.db.execute(Query('select id, name from t'))
+        self.assertEqual(rows, [(1, 'Ada')])
+
+    @defer.inlineCallbacks
+    def test_isolated_failures(self):
+        """ A failing request is rolled back without its batch """
+        yield self.db.execute(Statement('create table t (id integer primary key)'))
+
+        def insert_then_fail(cursor):
+            cursor.execute('insert into t (id) values (2)')
+            raise ValueError()
+
+        results = yield defer.DeferredList([
+            self.db.execute(Statement('insert into t (id) values (1)')),
+            self.db.interaction(insert_then_fail),
+            self.db.execute(Statement('insert into t (id) values (1)')),
+            self.db.execute(Statement('insert into t (id) values (3)')),
+        ], consumeErrors=True)
+        self.assertEqual([success for success, result in results], [True, False, False, True])
+        results[1][1].trap(ValueError)
+
+        rows = yield self.db.execute(Query('select id from t order by id'))
+        self.assertEqual(rows, [(1,), (3,)])
+
+    @defer.inlineCallbacks
+    def test_models(self):
+        """ Candidates and Votes run unchanged, concurrent votes share transactions """
+        candidates = Candidates(self.db)
+        votes = Votes(self.db, candidates)
+        yield candidates.create_table()
+        yield votes.create_table()
+        yield candidates.add_candidate('Ada')
+        yield candidates.add_candidate('Grace')
+
+        batches = self.db.batches
+        yield defer.gatherResults([votes.vote_for(i % 2 + 1) for i in range(500)])
+        self.assertLess(self.db.batches - batches, 500)
+        totals = yield votes.all_vote_totals()
+        self.assertEqual(sorted(totals), [(1, 'Ada', 250), (2, 'Grace', 250)])
+        yield self.assertFailure(votes.vote_for(3), IndexError)
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        self.db.metrics = Metrics()
+        yield self.db.execute(Statement('create table t (id integer primary key)'))
+        yield self.db.execute(Query('select id from t'))
+        text = self.db.metrics.render().decode('utf-8')
+        self.assertIn('vote_db_statement_duration_seconds_count{statement="select t"} 1', text)
+        self.assertIn('vote_db_pool_wait_seconds_count{pool="writer"} 2', text)
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        d = self.db.execute(Statement('create table t (id integer primary key)'))
+        self.db.close()
+        yield d     # queued work still runs
+        yield self.assertFailure(self.db.execute(Query('select id from t')), RuntimeError)
+        self.assertFalse(self.db.thread.is_alive())
+
+class TestQueuedApplication(QueuedTestCase):
+
+    @defer.inlineCallbacks
+    def test_vote(self):
+        app = Application(None, database=self.db)
+        self.assertIs(self.db.metrics, app.metrics)
+        yield app.vote_api.candidates.create_table()
+        yield app.vote_api.votes.create_table()
+        client = KleinResourceTester(app.router)
+        form = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+        response = yield client.request('POST', '/api/candidate', headers=form, params={'candidate': 'Ada'})
+        self.assertEqual(response.code, 201)
+        response = yield client.request('POST', '/api/vote', headers=form, params={'id': 1})
+        self.assertEqual(response.code, 200)
+        response = yield client.request('GET', '/api/candidates')
+        self.assertEqual(json.loads(response.content)['candidates'], [{'id': 1, 'name': 'Ada', 'votes': 1}])
+        response = yield client.request('GET', '/metrics')
+        self.assertIn('vote_db_queue_backlog 0', response.content)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from database import Candidates, Database, Votes
+from history import DAY, HOUR, VoteHistory
+from interfaces import ITallyObserver
+from main import Application
+from tests.test_vote_api import KleinResourceTester
+
+NOW = 100 * DAY + 10 * HOUR     # 10:00 on a day far enough from the epoch
+
+class HistoryTestCase(TestCase):
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False,
+            cp_min=1, cp_max=1)     # statements run in the order they're submitted
+        self.addCleanup(self.dbpool.close)
+        self.clock = task.Clock()
+        self.clock.advance(NOW)
+
+    def rows(self, table):
+        return self.dbpool.runQuery('select candidate, bucket, votes from %s order by 2, 1' % (table))
+
+class TestVoteHistory(HistoryTestCase):
+
+    def setUp(self):
+        super(TestVoteHistory, self).setUp()
+        self.votes = Votes(Database(self.dbpool), Candidates(Database(self.dbpool)))
+        self.history = VoteHistory(self.votes, flush_interval=5, rollup_interval=60, clock=self.clock)
+        return self.history.start()
+
+    def tearDown(self):
+        return self.history.stop()
+
+    def test_contract(self):
+        assert verifyClass(ITallyObserver, VoteHistory), 'ITallyObserver contract not fulfilled'
+
+    @defer.inlineCallbacks
+    def test_minutes(self):
+        """ Votes are counted per minute and written in one upsert per bucket """
+        for i in range(3):
+            self.history.voted(1, 1, i + 1)
+        self.history.voted(2, 5, 5)
+        self.clock.advance(61)
+        self.history.voted(1, 1, 4)
+        yield self.history.flush()
+        self.history.voted(1, 2, 6)
+        yield self.history.flush()
+
+        rows = yield self.rows('votes_minute')
+        self.assertEqual(rows, [(1, NOW, 3), (2, NOW, 5), (1, NOW + 60, 3)])
+        self.assertEqual(self.history.pending, {})
+
+    @defer.inlineCallbacks
+    def test_flush_failure(self):
+        """ Counts stay pending when the database fails """
+        self.history.voted(1, 2, 2)
+        self.history._add_minutes = lambda cursor, counts: 1 / 0
+        yield self.assertFailure(self.history.flush(), ZeroDivisionError)
+        self.assertEqual(dict(self.history.pending), {(1, NOW): 2})
+
+        del self.history._add_minutes
+        yield self.history.flush()
+        rows = yield self.rows('votes_minute')
+        self.assertEqual(rows, [(1, NOW, 2)])
+
+    @defer.inlineCallbacks
+    def test_rollup(self):
+        self.history.voted(1, 2, 2)
+        self.clock.advance(HOUR)
+        self.history.voted(1, 3, 5)
+        self.history.voted(2, 1, 1)
+        yield self.history.flush()
+        yield self.history.rollup()
+
+        hours = yield self.rows('votes_hour')
+        self.assertEqual(hours, [(1, NOW, 2), (1, NOW + HOUR, 3), (2, NOW + HOUR, 1)])
+        days = yield self.rows('votes_day')
+        self.assertEqual(days, [(1, NOW - 10 * HOUR, 5), (2, NOW - 10 * HOUR, 1)])
+
+        # recomputed rather than added to
+        self.history.voted(1, 1, 6)
+        yield self.history.flush()
+        yield self.history.rollup()
+        days = yield self.rows('votes_day')
+        self.assertEqual(days, [(1, NOW - 10 * HOUR, 6), (2, NOW - 10 * HOUR, 1)])
+
+    @defer.inlineCallbacks
+    def test_retention(self):
+        self.history.voted(1, 2, 2)
+        yield self.history.flush()
+        yield self.history.rollup()
+        self.clock.advance(3 * DAY)
+        yield self.history.rollup()
+
+        minutes = yield self.rows('votes_minute')
+        self.assertEqual(minutes, [])
+        hours = yield self.rows('votes_hour')
+        self.assertEqual(hours, [(1, NOW, 2)])
+
+        self.assertRaises(ValueError, self.history.history, 1, NOW, NOW + HOUR, 60)
+        start, slots = yield self.history.history(1, NOW, NOW + HOUR, HOUR)
+        self.assertEqual((start, slots), (NOW, [2]))
+
+    @defer.inlineCallbacks
+    def test_history(self):
+        """ Reads come from the coarsest table that divides the step """
+        for minute in range(3):
+            self.history.voted(1, minute + 1, 0)
+            self.clock.advance(60)
+        self.history.voted(2, 9, 9)
+        yield self.history.flush()
+        yield self.history.rollup()
+
+        start, slots = yield self.history.history(1, NOW, NOW + 300, 60)
+        self.assertEqual((start, slots), (NOW, [1, 2, 3, 0, 0]))
+        start, slots = yield self.history.history(1, NOW + 30, NOW + 300, 120)
+        self.assertEqual((start, slots), (NOW, [3, 3, 0]))
+        start, slots = yield self.history.history(1, NOW - HOUR, NOW + HOUR, HOUR)
+        self.assertEqual((start, slots), (NOW - HOUR, [0, 6]))
+        start, slots = yield self.history.history(1, NOW - 5 * DAY, NOW, DAY)
+        self.assertEqual(slots, [0, 0, 0, 0, 0, 6])
+
+        plan = yield self.dbpool.runQuery(
+            'explain query plan ' + self.history.history_queries[HOUR].sql, (0, 1, 1, 0, 1))
+        self.assertIn('PRIMARY KEY', ' '.join(str(row) for row in plan))
+
+    @defer.inlineCallbacks
+    def test_loops(self):
+        self.history.voted(1, 1, 1)
+        self.clock.advance(5)
+        rows = yield self.rows('votes_minute')
+        self.assertEqual(rows, [(1, NOW, 1)])
+
+        self.clock.advance(55)
+        rows = yield self.rows('votes_hour')
+        self.assertEqual(rows, [(1, NOW, 1)])
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        """ Votes reported while stopping are written straight away """
+        yield self.history.stop()
+        self.history.voted(1, 4, 4)
+        yield self.history.flush()
+        rows = yield self.rows('votes_minute')
+        self.assertEqual(rows, [(1, NOW, 4)])
+        self.assertFalse(self.history.flush_loop.running)
+
+class TestHistoryAPI(HistoryTestCase):
+
+    def setUp(self):
+        super(TestHistoryAPI, self).setUp()
+        self.app = Application(self.dbpool, history_interval=5)
+        history = self.app.vote_history
+        history.clock = self.clock
+        self.client = KleinResourceTester(self.app.router)
+        self.form = {'Content-Type': 'application/x-www-form-urlencoded'}
+        d = self.app.vote_api.candidates.create_table()
+        d.addCallback(lambda ignored: self.app.vote_api.votes.create_table())
+        d.addCallback(lambda ignored: history.db.interaction(history._create_tables))
+        return d
+
+    @defer.inlineCallbacks
+    def test_history(self):
+        yield self.client.request('POST', '/api/candidate', headers=self.form,
+            params={'candidate': 'Ada'})
+        for i in range(3):
+            response = yield self.client.request('POST', '/api/vote', headers=self.form,
+                params={'id': 1})
+            self.assertEqual(response.code, 200)
+        yield self.app.vote_history.flush()
+
+        response = yield self.client.request('GET', '/api/candidates/1/history?step=600')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.content), {
+            'id': 1, 'from': NOW - HOUR, 'step': 600, 'votes': [0, 0, 0, 0, 0, 0]})
+
+        response = yield self.client.request(
+            'GET', '/api/candidates/1/history?from=%d&to=%d' % (NOW, NOW + 120))
+        self.assertEqual(json.loads(response.content)['votes'], [3, 0])
+
+    @defer.inlineCallbacks
+    def test_invalid(self):
+        for query in ('?step=30', '?step=x', '?from=%d&to=%d' % (NOW, NOW - 60),
+                '?from=0&to=%d' % (NOW), '?from=0&to=%d&step=60' % (3 * DAY),
+                '?from=%d&to=%d' % (NOW - 3 * DAY, NOW - 3 * DAY + 60)):
+            response = yield self.client.request('GET', '/api/candidates/1/history' + query)
+            self.assertEqual(response.code, 412, query)
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        app = Application(self.dbpool)
+        self.assertIsNone(app.vote_history)
+        response = yield KleinResourceTester(app.router).request('GET', '/api/candidates/1/history')
+        self.assertEqual(response.code, 404)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from io import BytesIO
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+from twisted.trial.unittest import TestCase
+
+from ingest import MalformedRecord, read_records
+from manage import read_candidate_names
+
+class TestReadRecords(TestCase):
+
+    def read(self, body, chunk_size=4):
+        """ Decode with a tiny chunk size so records span chunks """
+        records = []
+        for record in read_records(BytesIO(body), chunk_size):
+            if isinstance(record, MalformedRecord):
+                record = record.reason
+            records.append(record)
+        return records
+
+    def test_json_array(self):
+        records = [{'id': i, 'count': i * 10} for i in range(50)]
+        self.assertEqual(self.read(json.dumps(records).encode('utf-8')), records)
+
+    def test_empty_array(self):
+        self.assertEqual(self.read(b'  [ ] '), [])
+
+    def test_ndjson(self):
+        body = b'{"id": 1}\n\n{"id": 22}\r\nnope\n{"id": 333}'
+        self.assertEqual(self.read(body), [{'id': 1}, {'id': 22}, 'Invalid JSON', {'id': 333}])
+
+    def test_multibyte_split(self):
+        """ UTF-8 sequences cut by a chunk boundary decode correctly """
+        body = '[{"name": "他們爲什"}]'.encode('utf-8')
+        self.assertEqual(self.read(body, chunk_size=1), [{'name': '他們爲什'}])
+
+    def test_numbers_across_chunks(self):
+        self.assertEqual(self.read(b'[1234567, 89]', chunk_size=3), [1234567, 89])
+
+    def test_malformed_array(self):
+        self.assertEqual(self.read(b'[1, 2,]'), [1, 2, 'Invalid JSON'])
+        self.assertEqual(self.read(b'[1 2]'), [1, 'Expected a comma between records'])
+        self.assertEqual(self.read(b'[1, 2'), [1, 2, 'Unterminated array'])
+
+    def test_malformed_record_not_buffered(self):
+        """ A malformed record ends the array without reading the rest """
+        body = BytesIO(('[1, {bad}, ' + '2, ' * 100000 + '3]').encode('ascii'))
+        records = list(read_records(body, 64))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1].reason, 'Invalid JSON')
+        self.assertLess(body.tell(), 1024)
+
+    def test_cut_off_values(self):
+        """ Literals, escapes and strings cut by a chunk boundary decode """
+        body = b'[true, false, null, "a\\u00e9b", "' + b'x' * 100 + b'", -1.5e3]'
+        self.assertEqual(self.read(body, chunk_size=3), [True, False, None, 'a\u00e9b', 'x' * 100, -1500.0])
+
+    def test_invalid_utf8(self):
+        self.assertEqual(self.read(b'{"id": 1}\n\xff\xfe\n{"id": 2}'), [{'id': 1}, 'Invalid JSON', {'id': 2}])
+        self.assertEqual(self.read(b'[1, \xff]'), [1, 'Invalid JSON'])
+
+    def test_empty_body(self):
+        self.assertEqual(self.read(b''), [])
+        self.assertEqual(self.read(b'\n \n'), [])
+
+    def test_line_numbers(self):
+        """ Records come with the line they start on, blank lines counted """
+        body = b'\n{"id": 1}\n\n\nnope\r\n{"id": 2}\n'
+        records = list(read_records(BytesIO(body), 4, line_numbers=True))
+        self.assertEqual([line for line, record in records], [2, 5, 6])
+        self.assertEqual(records[2], (6, {'id': 2}))
+
+        body = b'[{"id": 1},\n\n {\n"id": 2}, 3]'
+        records = list(read_records(BytesIO(body), 4, line_numbers=True))
+        self.assertEqual(records, [(1, {'id': 1}), (3, {'id': 2}), (4, 3)])
+
+class TestReadCandidateNames(TestCase):
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.path = path.join(tmpdir, 'candidates.ndjson')
+
+    def test_invalid_utf8(self):
+        """ Lines that aren't UTF-8 are rejected, the rest imported """
+        with open(self.path, 'wb') as ndjson:
+            ndjson.write(b'"Ada"\n\xff\xfe\n{"name": "Grace"}\n')
+        self.assertEqual(list(read_candidate_names(self.path)), [(1, 'Ada'), (2, None), (3, 'Grace')])
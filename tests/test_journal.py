@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from database import Candidates, Database, Votes
+from interfaces import IVotes
+from journal import RECORD, VoteJournal
+
+class TestVoteJournal(TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.path = path.join(tmpdir, 'votes.journal')
+        dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False)
+        self.addCleanup(dbpool.close)
+
+        db = Database(dbpool)
+        self.candidates = Candidates(db)
+        self.votes = Votes(db, self.candidates)
+        yield self.candidates.create_table()
+        yield self.votes.create_table()
+        yield self.candidates.add_candidate('Hulk')
+        yield self.candidates.add_candidate('Thor')
+
+    def journal(self):
+        journal = VoteJournal(self.votes, self.path, clock=task.Clock())
+        self.addCleanup(lambda: journal.segment and journal.segment.close())
+        return journal
+
+    def totals(self):
+        d = self.votes.all_vote_totals()
+        d.addCallback(lambda rows: dict((row[0], row[2]) for row in rows))
+        return d
+
+    def test_contract(self):
+        assert verifyClass(IVotes, VoteJournal), 'IVotes contract not fulfilled'
+
+    @defer.inlineCallbacks
+    def test_group_commit(self):
+        """ Votes are acknowledged once their group has been fsync'd """
+        journal = self.journal()
+        yield journal.start()
+        journal.known.update([1, 2])
+        acked = []
+        for candidate_id in [1, 2, 1]:
+            journal.vote_for(candidate_id).addCallback(acked.append)
+
+        self.assertEqual(acked, [])
+        self.assertEqual(path.getsize(journal.segment_path(journal.seq)), 0)
+        journal.clock.advance(journal.fsync_interval)
+        self.assertEqual(acked, [None] * 3)
+        self.assertEqual(path.getsize(journal.segment_path(journal.seq)), 3 * RECORD.size)
+
+    @defer.inlineCallbacks
+    def test_unknown_candidate(self):
+        """ Votes for candidates that don't exist are never journaled """
+        journal = self.journal()
+        yield journal.start()
+        yield self.assertFailure(journal.vote_for(5), IndexError)
+        self.assertEqual(journal.counts, {})
+        self.assertRaises(AssertionError, journal.vote_for, '1')
+
+    @defer.inlineCallbacks
+    def test_candidate_checked_once(self):
+        journal = self.journal()
+        yield journal.start()
+        self.votes.candidates = MagicMock()
+        self.votes.candidates.get_candidate_by_id.side_effect = lambda i: defer.succeed((i, 'Hulk'))
+        journal.vote_for(1)
+        journal.vote_for(1)
+        self.votes.candidates.get_candidate_by_id.assert_called_once_with(1)
+        self.assertEqual(journal.counts, {1: 2})
+
+    @defer.inlineCallbacks
+    def test_compact(self):
+        """ Compaction folds the segment into the votes table """
+        observer = MagicMock()
+        self.votes.observers.append(observer)
+        journal = self.journal()
+        yield journal.start()
+        journal.known.update([1, 2])
+        first = journal.seq
+        for candidate_id in [1, 2, 1]:
+            journal.vote_for(candidate_id)
+
+        yield journal.compact()
+        totals = yield self.totals()
+        self.assertEqual(totals, {1: 2, 2: 1})
+        self.assertEqual(journal.segments(), [first + 1])
+        observer.voted.assert_any_call(1, 2, 2)
+
+        # nothing new, nothing applied twice
+        yield journal.compact()
+        totals = yield self.totals()
+        self.assertEqual(totals, {1: 2, 2: 1})
+
+    @defer.inlineCallbacks
+    def test_crash_recovery(self):
+        """ Synced votes that were never compacted are replayed on start """
+        journal = self.journal()
+        yield journal.start()
+        journal.known.update([1, 2])
+        for candidate_id in [1, 1, 2]:
+            journal.vote_for(candidate_id)
+        journal.sync()
+        journal.vote_for(2)     # never synced, so never acknowledged
+        journal.segment.close()
+        with open(journal.segment_path(journal.seq), 'ab') as segment:
+            segment.write(RECORD.pack(1, 0)[:5])    # torn write
+
+        restarted = self.journal()
+        yield restarted.start()
+        totals = yield self.totals()
+        self.assertEqual(totals, {1: 2, 2: 1})
+        self.assertEqual(restarted.segments(), [restarted.seq])
+
+    @defer.inlineCallbacks
+    def test_applied_segment_skipped(self):
+        """ A segment folded in right before a crash isn't replayed """
+        journal = self.journal()
+        yield journal.start()
+        journal.known.add(1)
+        journal.vote_for(1)
+        journal.sync()
+        with open(journal.segment_path(journal.seq), 'rb') as segment:
+            data = segment.read()
+        yield journal.compact()
+        with open(journal.segment_path(journal.seq - 1), 'wb') as segment:
+            segment.write(data)     # the delete never happened
+
+        restarted = self.journal()
+        yield restarted.start()
+        totals = yield self.totals()
+        self.assertEqual(totals, {1: 1, 2: None})
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        """ Stopping folds in everything that was journaled """
+        journal = self.journal()
+        yield journal.start()
+        journal.known.add(2)
+        acked = []
+        journal.vote_for(2).addCallback(acked.append)
+        yield journal.stop()
+        self.assertEqual(acked, [None])
+        totals = yield self.totals()
+        self.assertEqual(totals, {1: None, 2: 1})
+        self.assertIsNone(journal.segment)
+
+    @defer.inlineCallbacks
+    def test_start_failure(self):
+        """ Votes fail rather than wait when no segment could be opened """
+        self.path = path.join(self.path, 'missing', 'votes.journal')
+        journal = self.journal()
+        journal.known.add(1)
+        waiting = journal.vote_for(1)
+        yield self.assertFailure(journal.start(), OSError)
+        yield self.assertFailure(waiting, OSError)
+        yield self.assertFailure(journal.vote_for(1), OSError)
+        self.assertFalse(journal.buffer)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from interfaces import ICandidates, IVotes
+from memory import MemoryCandidates, MemoryStore, MemoryVotes
+
+class TestMemoryBackend(TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore(clock=task.Clock())
+        self.candidates = MemoryCandidates(self.store)
+        self.votes = MemoryVotes(self.store, self.candidates)
+
+    def test_contract(self):
+        assert verifyClass(ICandidates, MemoryCandidates), 'ICandidates contract not fulfilled'
+        assert verifyClass(IVotes, MemoryVotes), 'IVotes contract not fulfilled'
+
+    def test_add_candidate(self):
+        """ Candidates get sequential ids and duplicates fail """
+        self.assertEqual(self.successResultOf(self.candidates.add_candidate('Hulk')), 1)
+        self.assertEqual(self.successResultOf(self.candidates.add_candidate('Thor')), 2)
+        self.failureResultOf(self.candidates.add_candidate('Hulk'), ValueError)
+        self.assertEqual(
+            self.successResultOf(self.candidates.get_candidate_by_id(2)), (2, 'Thor'))
+        self.failureResultOf(self.candidates.get_candidate_by_id(3), IndexError)
+
+    def test_vote_totals_page(self):
+        for name in ('Hulk', 'Thor', 'Loki', 'Wasp'):
+            self.candidates.add_candidate(name)
+        self.votes.add_votes({1: 2, 2: 7, 3: 2})
+        self.assertEqual(self.successResultOf(self.votes.vote_totals_page('votes', 3)), [
+            (2, 'Thor', 7), (3, 'Loki', 2), (1, 'Hulk', 2)])
+        self.assertEqual(self.successResultOf(self.votes.vote_totals_page('votes', 3, (2, 1))), [
+            (4, 'Wasp', 0)])
+        self.assertEqual(self.successResultOf(self.votes.vote_totals_page('name', 2, 'Loki')), [
+            (2, 'Thor', 7), (4, 'Wasp', 0)])
+
+    def test_search(self):
+        for name in ('Thor', 'thanos', 'Hulk', 'Thing'):
+            self.candidates.add_candidate(name)
+        self.assertEqual(self.successResultOf(self.candidates.search('th', 2)), [
+            (2, 'thanos'), (4, 'Thing')])
+
+    def test_import_candidates(self):
+        self.candidates.add_candidate('Hulk')
+        records = [(1, 'Thor'), (2, None), (3, 'Hulk'), (4, '')]
+        result = self.successResultOf(self.candidates.import_candidates(records))
+        self.assertEqual(result['inserted'], 1)
+        self.assertEqual(result['duplicates'], [(3, 'Hulk', 'Already exists')])
+        self.assertEqual([line for line, _, _ in result['rejected']], [2, 4])
+
+    def test_vote_for(self):
+        """ Votes return the running total and notify observers """
+        observer = MagicMock()
+        self.votes.observers.append(observer)
+        self.candidates.add_candidate('Hulk')
+        self.successResultOf(self.votes.vote_for(1))
+        self.assertEqual(self.successResultOf(self.votes.vote_for(1)), 2)
+        observer.voted.assert_called_with(1, 1, 2)
+        self.failureResultOf(self.votes.vote_for(5), IndexError)
+        self.assertRaises(AssertionError, self.votes.vote_for, '1')
+
+    def test_add_votes(self):
+        self.candidates.add_candidate('Hulk')
+        self.candidates.add_candidate('Thor')
+        missing = self.successResultOf(self.votes.add_votes({1: 3, 9: 2}))
+        self.assertEqual(missing, [9])
+        self.assertEqual(self.successResultOf(self.votes.vote_total(1)), [(1, 'Hulk', 3)])
+        self.assertEqual(self.successResultOf(self.votes.vote_total(2)), [])
+        self.assertEqual(
+            self.successResultOf(self.votes.all_vote_totals()),
+            [(1, 'Hulk', 3), (2, 'Thor', None)])
+
+    def test_add_votes_overflow(self):
+        """ Nothing is added when any total would overflow """
+        self.candidates.add_candidate('Hulk')
+        self.candidates.add_candidate('Thor')
+        self.votes.add_votes({2: 2 ** 63 - 2})
+        self.failureResultOf(self.votes.add_votes({1: 1, 2: 2}), OverflowError)
+        self.assertEqual(self.successResultOf(self.votes.vote_total(1)), [])
+
+class TestMemoryPersistence(TestCase):
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.path = path.join(tmpdir, 'votes')
+
+    def populate(self, store):
+        store.add('Hulk')
+        store.add('Thor')
+        store.increment(1, 5)
+        store.increment(2, 1)
+
+    def reopen(self):
+        return MemoryStore(self.path, clock=task.Clock())
+
+    def test_log_replay(self):
+        """ Changes are recovered from the log after the process dies """
+        store = self.reopen()
+        self.populate(store)
+        store.sync()    # no snapshot, as if the process was killed
+
+        restored = self.reopen()
+        self.assertEqual(restored.names, ['Hulk', 'Thor'])
+        self.assertEqual(restored.counters.tolist(), [5, 1])
+        self.assertEqual(restored.ids, {'Hulk': 1, 'Thor': 2})
+
+    def test_snapshot(self):
+        """ A snapshot folds the log away and is restored on its own """
+        store = self.reopen()
+        self.populate(store)
+        store.snapshot()
+        store.increment(1, 2)
+        store.stop()
+
+        restored = self.reopen()
+        restored.sync()
+        self.assertEqual(restored.counters.tolist(), [7, 1])
+        with open(self.path + '.log') as log:
+            self.assertEqual(log.read(), 'g\t%d\n' % (restored.generation))
+
+    def test_stale_log_ignored(self):
+        """ A log older than the snapshot isn't replayed twice """
+        store = self.reopen()
+        self.populate(store)
+        store.sync()
+        with open(self.path + '.log') as log:
+            stale = log.read()
+        store.snapshot()
+        store.stop()
+        with open(self.path + '.log', 'w') as log:
+            log.write(stale)    # eg. crashed between snapshot and truncate
+
+        restored = self.reopen()
+        self.assertEqual(restored.counters.tolist(), [5, 1])
+
+    def test_torn_write(self):
+        """ A partial last line is dropped """
+        store = self.reopen()
+        self.populate(store)
+        store.sync()
+        with open(self.path + '.log', 'a') as log:
+            log.write('v\t1\t10')
+
+        restored = self.reopen()
+        self.assertEqual(restored.counters.tolist(), [5, 1])
+
+    def test_reopen_after_torn_write(self):
+        """ Writes after a recovered torn line are readable again """
+        store = self.reopen()
+        self.populate(store)
+        store.sync()
+        with open(self.path + '.log', 'a') as log:
+            log.write('v\t1\t10')
+
+        restored = self.reopen()
+        restored.increment(2, 1)
+        restored.sync()
+        self.assertEqual(self.reopen().counters.tolist(), [5, 2])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from main import Application
+from metrics import Counter, Gauge, Histogram, Metrics, Registry
+from tests.test_vote_api import KleinResourceTester
+
+def sample_lines(text):
+    """ Exposition lines without the HELP/TYPE comments """
+    return [line for line in text.splitlines() if line and not line.startswith('#')]
+
+class TestExposition(TestCase):
+
+    def test_counter(self):
+        counter = Counter('votes_total', 'Votes cast', ['candidate'])
+        counter.inc(candidate='Bruce "Batman" Wayne')
+        counter.inc(2, candidate='Bruce "Batman" Wayne')
+        self.assertEqual(counter.render().splitlines(), [
+            '# HELP votes_total Votes cast',
+            '# TYPE votes_total counter',
+            'votes_total{candidate="Bruce \\"Batman\\" Wayne"} 3'])
+
+    def test_gauge(self):
+        gauge = Gauge('in_flight', 'Requests')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(sample_lines(gauge.render()), ['in_flight 1'])
+        gauge.set(0.25)
+        self.assertEqual(sample_lines(gauge.render()), ['in_flight 0.25'])
+
+    def test_function(self):
+        """
+        Values read at scrape time, None leaves the sample out.
+        """
+        value = [None]
+        gauge = Gauge('ratio', 'A ratio', function=lambda: value[0])
+        self.assertEqual(sample_lines(gauge.render()), [])
+        value[0] = 0.5
+        self.assertEqual(sample_lines(gauge.render()), ['ratio 0.5'])
+
+    def test_histogram(self):
+        histogram = Histogram('latency', 'Latency', ['route'], buckets=[0.1, 1])
+        histogram.observe(0.05, route='/a')
+        histogram.observe(0.1, route='/a')      # le is inclusive
+        histogram.observe(0.5, route='/a')
+        histogram.observe(3, route='/a')
+        self.assertEqual(sample_lines(histogram.render()), [
+            'latency_bucket{route="/a",le="0.1"} 2',
+            'latency_bucket{route="/a",le="1"} 3',
+            'latency_bucket{route="/a",le="+Inf"} 4',
+            'latency_sum{route="/a"} 3.65',
+            'latency_count{route="/a"} 4'])
+
+    def test_registry(self):
+        registry = Registry()
+        registry.add(Counter('a_total', 'A')).inc()
+        registry.add(Gauge('b', 'B')).set(2)
+        rendered = registry.render()
+        self.assertIsInstance(rendered, bytes)
+        self.assertTrue(rendered.endswith(b'\n'))
+        self.assertEqual(sample_lines(rendered.decode('utf-8')), ['a_total 1', 'b 2'])
+
+class TestInstrumentation(TestCase):
+    """
+    Metrics recorded by a running application on a real sqlite database.
+    """
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False)
+        self.addCleanup(self.dbpool.close)
+
+        self.app = Application(self.dbpool)
+        self.client = KleinResourceTester(self.app.router)
+
+    @defer.inlineCallbacks
+    def scrape(self):
+        response = yield self.client.request('GET', '/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'), [Metrics.content_type])
+        defer.returnValue(dict(line.rsplit(' ', 1) for line in sample_lines(response.content)))
+
+    @defer.inlineCallbacks
+    def test_requests(self):
+        yield self.app.vote_api.candidates.create_table()
+        yield self.app.vote_api.votes.create_table()
+        yield self.app.vote_api.candidates.add_candidate('Bruce Wayne')
+
+        form = {'Content-Type': 'application/x-www-form-urlencoded'}
+        yield self.client.request('POST', '/api/vote', headers=form, params={'id': 1})
+        yield self.client.request('POST', '/api/vote', headers=form, params={'id': 1})
+        yield self.client.request('GET', '/api/candidates')
+        yield self.client.request('GET', '/api/candidates')
+
+        samples = yield self.scrape()
+        self.assertEqual(samples[
+            'vote_http_request_duration_seconds_count{route="/vote",method="POST",code="200"}'], '2')
+        self.assertEqual(samples[
+            'vote_http_request_duration_seconds_count{route="/candidates",method="GET",code="200"}'], '2')
+        self.assertEqual(samples['vote_json_encode_seconds_count{route="/vote"}'], '2')
+        self.assertEqual(samples['vote_http_requests_in_flight'], '0')
+        self.assertEqual(samples[
+            'vote_db_statement_duration_seconds_count{statement="upsert_vote"}'], '2')
+        self.assertEqual(samples['vote_db_pool_wait_seconds_count{pool="writer"}'], '6')
+        self.assertEqual(samples['vote_cache_hits_total'], '1')
+        self.assertEqual(samples['vote_cache_misses_total'], '1')
+        self.assertEqual(samples['vote_cache_hit_ratio'], '0.5')
+        self.assertEqual(samples['vote_db_pool_writer_backlog'], '0')
+
+    @defer.inlineCallbacks
+    def test_error_code(self):
+        """
+        Failed requests are recorded under the code they were answered with.
+        """
+        # no tables, every query fails
+        yield self.client.request('GET', '/api/candidates')
+        samples = yield self.scrape()
+        self.assertEqual(samples[
+            'vote_http_request_duration_seconds_count{route="/candidates",method="GET",code="400"}'], '1')
+        self.assertEqual(samples['vote_http_requests_in_flight'], '0')
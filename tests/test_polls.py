@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from database import Database, Polls, ShardedVotes
+from interfaces import IPolls
+from main import Application
+from tests.test_vote_api import KleinResourceTester
+
+class PollsTestCase(TestCase):
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False)
+        self.addCleanup(self.dbpool.close)
+
+    def tables(self):
+        d = self.dbpool.runQuery("select name from sqlite_master where type='table' order by name")
+        d.addCallback(lambda rows: [row[0] for row in rows])
+        return d
+
+class TestPolls(PollsTestCase):
+
+    def setUp(self):
+        super(TestPolls, self).setUp()
+        self.polls = Polls(Database(self.dbpool))
+
+    def test_contract(self):
+        assert verifyClass(IPolls, Polls), 'IPolls contract not fulfilled'
+
+    @defer.inlineCallbacks
+    def test_add_poll(self):
+        """ Every poll gets its own tables, the polls table is made on demand """
+        first = yield self.polls.add_poll('City Council 2024')
+        second = yield self.polls.add_poll('Mayor')
+        self.assertEqual((first, second), (1, 2))
+        tables = yield self.tables()
+        self.assertEqual(tables, ['candidates_1', 'candidates_2', 'polls', 'votes_1', 'votes_2'])
+
+        polls = yield self.polls.all_polls()
+        self.assertEqual(polls, [(1, 'City Council 2024'), (2, 'Mayor')])
+        poll = yield self.polls.get_poll_by_id(2)
+        self.assertEqual(poll, (2, 'Mayor'))
+        yield self.assertFailure(self.polls.get_poll_by_id(3), IndexError)
+
+    @defer.inlineCallbacks
+    def test_invalid_poll(self):
+        yield self.polls.add_poll('Mayor')
+        yield self.assertFailure(self.polls.add_poll('Mayor'), Exception)
+        self.assertRaises(AssertionError, self.polls.add_poll, ' ')
+        self.assertRaises(AssertionError, self.polls.add_poll, 'x' * 51)
+        polls = yield self.polls.all_polls()
+        self.assertEqual(len(polls), 1)
+
+    @defer.inlineCallbacks
+    def test_partitioned(self):
+        """ Votes in one poll don't show up in another """
+        yield self.polls.add_poll('Mayor')
+        yield self.polls.add_poll('Sheriff')
+        mayor_candidates, mayor_votes = self.polls.tables(1)
+        sheriff_candidates, sheriff_votes = self.polls.tables(2)
+        yield mayor_candidates.add_candidate('Ada')
+        yield sheriff_candidates.add_candidate('Grace')
+        yield mayor_votes.vote_for(1)
+        yield mayor_votes.vote_for(1)
+
+        mayor = yield mayor_votes.all_vote_totals()
+        sheriff = yield sheriff_votes.all_vote_totals()
+        self.assertEqual(mayor, [(1, 'Ada', 2)])
+        self.assertEqual(sheriff, [(1, 'Grace', None)])
+
+    @defer.inlineCallbacks
+    def test_sharded(self):
+        polls = Polls(Database(self.dbpool), shards=4)
+        yield polls.add_poll('Mayor')
+        candidates, votes = polls.tables(1)
+        self.assertIsInstance(votes, ShardedVotes)
+        yield candidates.add_candidate('Ada')
+        total = yield votes.vote_for(1)
+        self.assertEqual(total, 1)
+
+    @defer.inlineCallbacks
+    def test_layout_kept(self):
+        """ A poll keeps the vote layout it was created with """
+        yield self.polls.add_poll('Mayor')
+        sharded = Polls(Database(self.dbpool), shards=4)
+        candidates, votes = yield sharded.open_poll(1)
+        self.assertNotIsInstance(votes, ShardedVotes)
+        yield candidates.add_candidate('Ada')
+        yield votes.vote_for(1)
+        yield self.assertFailure(sharded.open_poll(2), IndexError)
+
+        yield sharded.migrate_poll(1, 4)
+        candidates, votes = yield self.polls.open_poll(1)
+        self.assertEqual(votes.shards, 4)
+        total = yield votes.vote_for(1)
+        self.assertEqual(total, 2)
+
+    @defer.inlineCallbacks
+    def test_layout_of_older_polls(self):
+        """ Polls from before layouts were kept get theirs from the table """
+        yield self.dbpool.runOperation('create table polls (id integer primary key, name text unique not null)')
+        yield Polls(Database(self.dbpool), shards=2).add_poll('Mayor')
+        yield self.dbpool.runOperation("insert into polls (name) values ('Sheriff')")
+        yield self.dbpool.runOperation('create table votes_2 (candidate int, votes int)')
+        yield self.dbpool.runOperation('update polls set shards=null')
+
+        candidates, votes = yield self.polls.open_poll(1)
+        self.assertIsInstance(votes, ShardedVotes)
+        yield candidates.add_candidate('Ada')
+        yield votes.vote_for(1)
+        candidates, votes = yield self.polls.open_poll(2)
+        self.assertNotIsInstance(votes, ShardedVotes)
+        rows = yield self.dbpool.runQuery('select id, shards from polls order by id')
+        self.assertEqual(rows, [(1, 1), (2, 0)])
+
+class TestPollApi(PollsTestCase):
+
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def setUp(self):
+        super(TestPollApi, self).setUp()
+        self.app = Application(self.dbpool)
+        self.client = KleinResourceTester(self.app.router)
+
+    def post(self, uri, params):
+        return self.client.request('POST', uri, headers=self.form, params=params)
+
+    @defer.inlineCallbacks
+    def test_polls(self):
+        response = yield self.post('/api/polls', {'name': 'Mayor'})
+        self.assertEqual(response.code, 201)
+        self.assertEqual(json.loads(response.content), {'status': 'Created', 'id': 1})
+        yield self.post('/api/polls', {'name': 'Sheriff'})
+
+        response = yield self.client.request('GET', '/api/polls')
+        self.assertEqual(json.loads(response.content), {'polls': [
+            {'id': 1, 'name': 'Mayor'}, {'id': 2, 'name': 'Sheriff'}]})
+
+        response = yield self.post('/api/polls', {})
+        self.assertEqual(response.code, 412)
+        response = yield self.post('/api/polls', {'name': 'Mayor'})
+        self.assertEqual(response.code, 400)
+
+    @defer.inlineCallbacks
+    def test_poll_routes(self):
+        yield self.post('/api/polls', {'name': 'Mayor'})
+        yield self.post('/api/polls', {'name': 'Sheriff'})
+
+        response = yield self.post('/api/polls/2/candidate', {'candidate': 'Grace'})
+        self.assertEqual(response.code, 201)
+        response = yield self.post('/api/polls/2/vote', {'id': 1})
+        self.assertEqual(response.code, 200)
+
+        response = yield self.client.request('GET', '/api/polls/2/candidates')
+        self.assertEqual(json.loads(response.content)['candidates'], [
+            {'id': 1, 'name': 'Grace', 'votes': 1}])
+        response = yield self.client.request('GET', '/api/polls/1/candidates')
+        self.assertEqual(json.loads(response.content)['candidates'], [])
+
+        # resolved once, then served from the poll's own VoteApi
+        self.assertEqual(sorted(self.app.poll_api.apis), [1, 2])
+        api = self.app.poll_api.apis[2]
+        self.assertIs(api.metrics, self.app.metrics)
+        self.assertEqual(api.candidates.table_name, 'candidates_2')
+
+    @defer.inlineCallbacks
+    def test_unknown_poll(self):
+        yield self.post('/api/polls', {'name': 'Mayor'})
+        for uri in ('/api/polls/7/candidates', '/api/polls/nope/candidates'):
+            response = yield self.client.request('GET', uri)
+            self.assertEqual(response.code, 404, uri)
+            self.assertEqual(json.loads(response.content), {'status': 'Resource Not Available'})
+        self.assertEqual(self.app.poll_api.apis, {})
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+import pstats
+
+from twisted.internet import defer, task
+from twisted.internet.address import IPv4Address, UNIXAddress
+from twisted.trial.unittest import TestCase
+
+from main import Application, is_loopback
+from profiling import Profiler
+from tests.test_vote_api import KleinResourceTester
+
+class ProfilingTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+class TestProfiler(ProfilingTestCase):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.clock = task.Clock()
+        self.profiler = Profiler(self.directory, self.clock)
+        self.addCleanup(self.profiler.stop)
+
+    def finished_request(self):
+        request = MagicMock()
+        request.notifyFinish.return_value = defer.succeed(None)
+        return request
+
+    def test_seconds(self):
+        profile_path = self.profiler.start(seconds=5)
+        self.assertTrue(self.profiler.active)
+        self.assertTrue(profile_path.startswith(self.directory))
+        sum(range(1000))
+        self.clock.advance(5)
+
+        self.assertFalse(self.profiler.active)
+        self.assertGreater(pstats.Stats(profile_path).total_calls, 0)
+        self.assertTrue(path.exists(profile_path.replace('.pstats', '.txt')))
+
+    def test_unique_paths(self):
+        paths = set()
+        for i in range(3):
+            paths.add(self.profiler.start(seconds=5))
+            self.profiler.stop()
+        self.assertEqual(len(paths), 3)
+        self.assertTrue(all(path.exists(profile_path) for profile_path in paths))
+
+    def test_requests(self):
+        self.profiler.request(self.finished_request())     # not profiling, not counted
+        self.profiler.start(requests=2)
+        self.profiler.request(self.finished_request())
+        self.assertTrue(self.profiler.active)
+        self.profiler.request(self.finished_request())
+        self.assertFalse(self.profiler.active)
+
+    def test_first_limit_wins(self):
+        pending = MagicMock()
+        pending.notifyFinish.return_value = d = defer.Deferred()
+        self.profiler.start(seconds=1, requests=1)
+        self.profiler.request(pending)
+        self.clock.advance(1)
+        self.assertFalse(self.profiler.active)
+        d.callback(None)    # finishing later is harmless
+        self.assertIsNone(self.profiler.stop())
+
+    def test_invalid(self):
+        for limits in ({}, {'seconds': 0}, {'seconds': 601}, {'requests': 0}):
+            self.assertRaises(ValueError, self.profiler.start, **limits)
+        self.assertFalse(self.profiler.active)
+        self.profiler.start(seconds=1)
+        self.assertRaises(RuntimeError, self.profiler.start, seconds=1)
+
+class TestProfileAPI(ProfilingTestCase):
+
+    def setUp(self):
+        super(TestProfileAPI, self).setUp()
+        self.app = Application(MagicMock(), profile_dir=self.directory, profile_endpoint=True)
+        self.addCleanup(self.app.profiler.stop)
+        self.app.vote_api.votes = MagicMock()
+        self.app.vote_api.votes.all_vote_totals.return_value = defer.succeed([])
+        self.client = KleinResourceTester(self.app.router)
+
+    def test_loopback(self):
+        request = MagicMock()
+        for address, expected in ((IPv4Address('TCP', '127.0.0.1', 80), True),
+                (IPv4Address('TCP', '10.0.0.1', 80), False), (UNIXAddress(b'/tmp/sock'), False)):
+            request.getClientAddress.return_value = address
+            self.assertEqual(is_loopback(request), expected, address)
+
+    @defer.inlineCallbacks
+    def test_profile_requests(self):
+        self.patch(self.app.profiler, 'clock', task.Clock())
+        response = yield self.client.request('POST', '/admin/profile?requests=2')
+        self.assertEqual(response.code, 202)
+        profile_path = json.loads(response.content)['path']
+        response = yield self.client.request('POST', '/admin/profile?seconds=5')
+        self.assertEqual(response.code, 409)
+
+        for i in range(2):
+            response = yield self.client.request('GET', '/api/candidates')
+            self.assertEqual(response.code, 200)
+        self.assertFalse(self.app.profiler.active)
+        stats = pstats.Stats(profile_path)
+        self.assertIn('get_candidates', [function for filename, line, function in stats.stats])
+
+    @defer.inlineCallbacks
+    def test_stop(self):
+        self.patch(self.app.profiler, 'clock', task.Clock())
+        response = yield self.client.request('POST', '/admin/profile')
+        self.assertEqual(response.code, 202)
+        response = yield self.client.request('DELETE', '/admin/profile')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(path.exists(json.loads(response.content)['path']))
+        response = yield self.client.request('DELETE', '/admin/profile')
+        self.assertEqual(response.code, 404)
+
+    @defer.inlineCallbacks
+    def test_unavailable(self):
+        response = yield self.client.request('POST', '/admin/profile?seconds=x')
+        self.assertEqual(response.code, 412)
+
+        app = Application(MagicMock())
+        self.assertIsNone(app.profiler)
+        response = yield KleinResourceTester(app.router).request('POST', '/admin/profile')
+        self.assertEqual(response.code, 404)
+
+        # signals only, unless the endpoint is asked for
+        app = Application(MagicMock(), profile_dir=self.directory)
+        response = yield KleinResourceTester(app.router).request('POST', '/admin/profile')
+        self.assertEqual(response.code, 404)
+        self.assertFalse(app.profiler.active)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+import controllers
+from main import Application
+from ratelimit import BloomFilter, RateLimiter, VoterFilter
+from tests.test_vote_api import KleinResourceTester
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = RateLimiter(2, burst=3, max_clients=2, clock=self.clock)
+
+    def test_burst(self):
+        """
+        A full bucket allows `burst` requests, then one per 1/rate seconds.
+        """
+        self.assertEqual([self.limiter.delay(b'a') for i in range(3)], [0, 0, 0])
+        self.assertEqual(self.limiter.delay(b'a'), 0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(self.limiter.delay(b'a'), 0)
+        self.assertEqual(self.limiter.delay(b'a'), 0.5)
+
+    def test_refill_is_capped(self):
+        for i in range(3):
+            self.limiter.delay(b'a')
+        self.clock.advance(60)
+        self.assertEqual([self.limiter.delay(b'a') for i in range(4)], [0, 0, 0, 0.5])
+
+    def test_charge(self):
+        """
+        Charging more than is left puts the bucket in debt.
+        """
+        self.assertEqual(self.limiter.delay(b'a'), 0)
+        self.limiter.charge(b'a', 4)
+        self.assertEqual(self.limiter.delay(b'a'), 1.5)
+        self.clock.advance(1.5)
+        self.assertEqual(self.limiter.delay(b'a'), 0)
+
+    def test_clients_are_independent(self):
+        for i in range(3):
+            self.limiter.delay(b'a')
+        self.assertTrue(self.limiter.delay(b'a'))
+        self.assertEqual(self.limiter.delay(b'b'), 0)
+
+    def test_least_recently_seen_evicted(self):
+        for key in (b'a', b'b', b'a', b'c'):
+            self.limiter.delay(key)
+        self.assertEqual(list(self.limiter.buckets), [b'a', b'c'])
+
+class TestBloomFilter(TestCase):
+
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = [('voter %d' % (i)).encode('ascii') for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+
+        strangers = [('stranger %d' % (i)).encode('ascii') for i in range(10000)]
+        false_positives = sum(1 for key in strangers if key in bloom)
+        self.assertLess(false_positives, 300)   # about 1% expected
+
+    def test_size(self):
+        bloom = BloomFilter(1000000, 0.001)
+        self.assertLess(len(bloom.bits), 2 * 1024 * 1024)
+        self.assertEqual(bloom.hashes, 10)
+
+class TestVoterFilter(TestCase):
+
+    def test_once(self):
+        voters = VoterFilter(100)
+        self.assertTrue(voters.begin(b'a'))
+        self.assertFalse(voters.begin(b'a'))    # still voting
+        voters.end(b'a', True)
+        self.assertFalse(voters.begin(b'a'))
+        self.assertTrue(voters.begin(b'b'))
+
+    def test_uncounted_vote(self):
+        voters = VoterFilter(100)
+        voters.begin(b'a')
+        voters.end(b'a', False)
+        self.assertTrue(voters.begin(b'a'))
+
+class TestLimitedVoteAPI(TestCase):
+
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def setUp(self):
+        self.app = Application(MagicMock(), rate_limit=1, rate_burst=2, voter_capacity=100)
+        self.app.vote_api.limiter.clock = self.clock = task.Clock()
+        self.votes = self.app.vote_api.votes = MagicMock()
+        self.votes.vote_for.return_value = defer.succeed(None)
+        self.client = KleinResourceTester(self.app.router)
+
+    def vote(self, voter=None):
+        headers = dict(self.form)
+        if voter is not None:
+            headers['Cookie'] = 'voter=%s' % (voter)
+        return self.client.request('POST', '/api/vote', headers=headers, params={'id': 1})
+
+    @defer.inlineCallbacks
+    def test_rate_limited(self):
+        self.app.vote_api.voters = None
+        codes = []
+        for i in range(3):
+            response = yield self.vote()
+            codes.append(response.code)
+        self.assertEqual(codes, [200, 200, 429])
+        self.assertEqual(response.headers.getRawHeaders('Retry-After'), ['1'])
+        self.assertEqual(self.votes.vote_for.call_count, 2)
+
+        self.clock.advance(1)
+        response = yield self.vote()
+        self.assertEqual(response.code, 200)
+
+    @defer.inlineCallbacks
+    def test_one_vote(self):
+        self.app.vote_api.client_cookie = b'voter'
+        response = yield self.vote('alice')
+        self.assertEqual(response.code, 200)
+        response = yield self.vote('alice')
+        self.assertEqual(response.code, 409)
+        self.assertEqual(self.votes.vote_for.call_count, 1)
+        response = yield self.vote('bob')
+        self.assertEqual(response.code, 200)
+
+    @defer.inlineCallbacks
+    def test_bulk_vote(self):
+        """
+        Bulk votes are refused with one vote per client, and cost a token
+        per record otherwise.
+        """
+        self.votes.add_votes.return_value = defer.succeed([])
+        body = b'{"id": 1}\n{"id": 1}\n{"id": 2}\n'
+        response = yield self.client.request('POST', '/api/votes/bulk', body=body)
+        self.assertEqual(response.code, 403)
+        self.votes.add_votes.assert_not_called()
+
+        self.app.vote_api.voters = None
+        response = yield self.client.request('POST', '/api/votes/bulk', body=body)
+        self.assertEqual(response.code, 200)
+        response = yield self.vote()
+        self.assertEqual(response.code, 429)
+        self.assertEqual(response.headers.getRawHeaders('Retry-After'), ['2'])
+
+        # over the rate, the body isn't even read
+        self.patch(controllers, 'read_records', lambda *args: self.fail('body read'))
+        response = yield self.client.request('POST', '/api/votes/bulk', body=body)
+        self.assertEqual(response.code, 429)
+        self.assertEqual(self.votes.add_votes.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_rejected_vote_not_counted(self):
+        self.votes.vote_for.return_value = defer.fail(IndexError())
+        response = yield self.vote()
+        self.assertEqual(response.code, 412)
+
+        self.votes.vote_for.return_value = defer.succeed(None)
+        response = yield self.vote()
+        self.assertEqual(response.code, 200)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+import json
+
+from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from database import Candidates, Database
+from interfaces import ITallyObserver
+from main import Application
+from search import NameIndex
+from tests.test_vote_api import KleinResourceTester
+
+ROWS = [(1, 'Bruce Wayne', 3), (2, 'bruce Banner', None), (3, 'Brian', 1), (4, 'Clark Kent', 2)]
+
+class TestNameIndex(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.index = NameIndex(ttl=30, clock=self.clock)
+
+    def test_contract(self):
+        assert verifyClass(ITallyObserver, NameIndex), 'ITallyObserver contract not fulfilled'
+
+    def test_search(self):
+        self.index.refresh(lambda: defer.succeed(ROWS))
+        self.assertTrue(self.index.warm)
+        self.assertEqual(self.index.search('bru'), [(2, 'bruce Banner'), (1, 'Bruce Wayne')])
+        self.assertEqual(self.index.search('BR', limit=2), [(3, 'Brian'), (2, 'bruce Banner')])
+        self.assertEqual(self.index.search('Clark K'), [(4, 'Clark Kent')])
+        self.assertEqual(self.index.search('Z'), [])
+
+    def test_nominated(self):
+        self.index.nominated(5, 'Brenda')     # not loaded yet, nothing to update
+        self.assertEqual(self.index.search('Bre'), [])
+        self.index.refresh(lambda: defer.succeed(ROWS))
+        self.index.nominated(6, 'Bruno')
+        self.index.nominated(6, 'Bruno')
+        self.assertEqual(self.index.search('brun'), [(6, 'Bruno')])
+
+    def test_nominated_while_loading(self):
+        d = defer.Deferred()
+        self.index.refresh(lambda: d)
+        self.index.refresh(lambda: self.fail('loaded twice'))
+        self.index.nominated(5, 'Brenda')
+        d.callback(ROWS)
+        self.assertEqual(self.index.search('bre'), [(5, 'Brenda')])
+
+    def test_ttl(self):
+        self.index.refresh(lambda: defer.succeed(ROWS))
+        self.clock.advance(30)
+        self.assertFalse(self.index.warm)
+
+        never = NameIndex(ttl=0, clock=self.clock)
+        never.refresh(lambda: self.fail('no index without a ttl'))
+        self.assertFalse(never.warm)
+
+    def test_load_failure(self):
+        self.index.refresh(lambda: defer.fail(ValueError()))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertFalse(self.index.warm)
+        self.index.refresh(lambda: defer.succeed(ROWS))
+        self.assertTrue(self.index.warm)
+
+class TestCandidateSearch(TestCase):
+    """
+    The database fallback, on a sqlite file.
+    """
+
+    def setUp(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False)
+        self.addCleanup(self.dbpool.close)
+        self.candidates = Candidates(Database(self.dbpool))
+
+    @defer.inlineCallbacks
+    def test_search(self):
+        yield self.candidates.create_table()
+        yield self.candidates.create_indexes()
+        for candidate_id, name, votes in ROWS:
+            yield self.candidates.add_candidate(name)
+
+        found = yield self.candidates.search('BRU')
+        self.assertEqual(found, [(2, 'bruce Banner'), (1, 'Bruce Wayne')])
+        found = yield self.candidates.search('b', 1)
+        self.assertEqual(found, [(3, 'Brian')])
+
+        plan = yield self.dbpool.runQuery(
+            'explain query plan ' + self.candidates.search_query.sql, ('b', 'c', 10))
+        self.assertIn('candidates_by_name', ' '.join(str(row) for row in plan))
+
+    @defer.inlineCallbacks
+    def test_index_agrees(self):
+        """ The index and the database fold and order names alike """
+        yield self.candidates.create_table()
+        for name in ('Élodie', 'émile', 'Émile Zola', 'eve', 'Ewan', 'zed'):
+            yield self.candidates.add_candidate(name)
+        rows = yield self.candidates.all_candidates()
+        index = NameIndex(ttl=30, clock=task.Clock())
+        index.refresh(lambda: defer.succeed(rows))
+        for prefix in ('é', 'É', 'E', 'e', 'Z', ''):
+            found = yield self.candidates.search(prefix, 10)
+            self.assertEqual(index.search(prefix, 10), found, prefix)
+
+class TestSearchAPI(TestCase):
+
+    def setUp(self):
+        self.app = Application(MagicMock())
+        self.candidates = self.app.vote_api.candidates = MagicMock()
+        self.votes = self.app.vote_api.votes = MagicMock()
+        self.client = KleinResourceTester(self.app.router)
+
+    @defer.inlineCallbacks
+    def test_search(self):
+        """
+        The first search falls back to the database and loads the index
+        """
+        self.candidates.search.return_value = defer.succeed([(1, 'Bruce Wayne')])
+        self.candidates.all_candidates.return_value = defer.succeed(ROWS)
+
+        response = yield self.client.request('GET', '/api/candidates/search?q=Bruce%20W')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.content), {'candidates': [{'id': 1, 'name': 'Bruce Wayne'}]})
+        self.candidates.search.assert_called_once_with('Bruce W', 10)
+
+        response = yield self.client.request('GET', '/api/candidates/search?q=br&limit=2')
+        self.assertEqual(json.loads(response.content)['candidates'], [
+            {'id': 3, 'name': 'Brian'}, {'id': 2, 'name': 'bruce Banner'}])
+        self.assertEqual(self.candidates.search.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_invalid(self):
+        for query in ('', '?q=', '?q=b&limit=0', '?q=b&limit=101', '?q=b&limit=x'):
+            response = yield self.client.request('GET', '/api/candidates/search' + query)
+            self.assertEqual(response.code, 412, query)
+        self.candidates.search.assert_not_called()
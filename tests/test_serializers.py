@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+import json
+from twisted.trial.unittest import TestCase
+
+from cache import TallyCache
+from middleware import Jsonify
+import serializers
+
+class TestSerializers(TestCase):
+
+    value = {'candidates': [{'id': 1, 'name': 'Bruce Wayne ü', 'votes': 2 ** 40}]}
+
+    def test_available(self):
+        self.assertIn('json', serializers.SERIALIZERS)
+        self.assertRaises(ValueError, serializers.get_serializer, 'pickle')
+
+    def test_bytes(self):
+        for name, dumps in serializers.SERIALIZERS.items():
+            encoded = dumps(self.value)
+            self.assertIsInstance(encoded, bytes, name)
+            self.assertEqual(json.loads(encoded.decode('utf-8')), self.value, name)
+
+    def test_use(self):
+        self.addCleanup(setattr, serializers, 'dumps', serializers.dumps)
+        serializers.use('json')
+        self.assertIs(serializers.dumps, serializers.json_dumps)
+
+class TestEncodeList(TestCase):
+
+    def decode(self, chunks):
+        return json.loads(b''.join(chunks).decode('utf-8'))
+
+    def test_chunks(self):
+        items = [{'id': i, 'name': 'Nominee %d' % (i)} for i in range(10)]
+        for name, dumps in serializers.SERIALIZERS.items():
+            for chunk_size in (1, 3, 10, 100):
+                chunks = list(serializers.encode_list('candidates', iter(items), chunk_size, dumps))
+                self.assertEqual(self.decode(chunks), {'candidates': items}, name)
+        self.assertEqual(len(list(serializers.encode_list('candidates', items, 3))), 6)
+
+    def test_empty(self):
+        self.assertEqual(self.decode(serializers.encode_list('candidates', [])), {'candidates': []})
+
+    def test_cache_body(self):
+        cache = TallyCache(clock=MagicMock())
+        cache._loading = []
+        cache._loaded([(1, 'Bruce Wayne', 3), (2, 'Clark Kent', None)])
+        self.assertEqual(json.loads(cache.body.decode('utf-8')), {'candidates': [
+            {'id': 1, 'name': 'Bruce Wayne', 'votes': 3},
+            {'id': 2, 'name': 'Clark Kent', 'votes': 0}]})
+
+class TestJsonify(TestCase):
+
+    def test_stringify(self):
+        request = MagicMock()
+        jsonify = Jsonify(MagicMock())
+        self.assertEqual(json.loads(jsonify.stringify({'status': 'Success'}, request)),
+            {'status': 'Success'})
+        self.assertEqual(jsonify.stringify(b'{"status":"Success"}', request), b'{"status":"Success"}')
+        self.assertIsNone(jsonify.stringify(None, request))
+        request.setHeader.assert_called_with('Content-Type', 'application/json')
+
+    def test_pluggable(self):
+        dumps = MagicMock(return_value=b'{}')
+        jsonify = Jsonify(MagicMock(), dumps)
+        self.assertEqual(jsonify.stringify({'status': 'Success'}, MagicMock()), b'{}')
+        dumps.assert_called_once_with({'status': 'Success'})
+
+    def test_synchronous(self):
+        """ Handlers returning a value are answered without a Deferred """
+        request = MagicMock()
+        jsonify = Jsonify(MagicMock())
+        handler = jsonify.jsonify(lambda api, request: {'status': 'Success'})
+        self.assertEqual(json.loads(handler(None, request)), {'status': 'Success'})
+
+        handler = jsonify.jsonify(lambda api, request: 1 / 0)
+        self.assertEqual(json.loads(handler(None, request)), {'status': 'Internal Issues'})
+        request.setResponseCode.assert_called_once_with(500)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+import json
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from zope.interface.verify import verifyClass
+
+from controllers import DATABASE_ISSUES
+from interfaces import ITallyObserver
+from main import Application
+from stream import Broadcaster, TallyPoller
+
+def events(request):
+    """ Decode every event written to a mocked request """
+    decoded = []
+    for args, kwargs in request.write.call_args_list:
+        data = args[0]
+        if data.startswith(b'data: '):
+            decoded.append(json.loads(data[len(b'data: '):].decode('utf-8'))['candidates'])
+    return decoded
+
+class TestBroadcaster(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.broadcaster = Broadcaster(tick=1, keepalive=15, max_paused_ticks=2, clock=self.clock)
+
+    def subscribe(self):
+        request = MagicMock()
+        subscriber = self.broadcaster.subscribe(request)
+        subscriber.start(b'data: {"candidates": []}\n\n')
+        return request, subscriber
+
+    def test_contract(self):
+        assert verifyClass(ITallyObserver, Broadcaster), 'ITallyObserver contract not fulfilled'
+
+    def test_coalesced_per_tick(self):
+        """ A burst of votes is one event holding the latest totals """
+        requests = [self.subscribe()[0] for i in range(3)]
+        self.broadcaster.nominated(3, 'Superman')
+        for total in range(1, 101):
+            self.broadcaster.voted(1, 1, total)
+        self.broadcaster.voted(3, 1, 1)
+        self.clock.advance(1)
+
+        for request in requests:
+            self.assertEqual(events(request)[1:], [[
+                {'id': 3, 'name': 'Superman', 'votes': 1},
+                {'id': 1, 'votes': 100}]])
+        # the payload is encoded once and shared
+        payloads = set(id(r.write.call_args[0][0]) for r in requests)
+        self.assertEqual(len(payloads), 1)
+
+    def test_registered_as_producer(self):
+        request, subscriber = self.subscribe()
+        request.registerProducer.assert_called_once_with(subscriber, True)
+
+    def test_paused_subscriber_catches_up(self):
+        """ Changes queued while paused are written on resume """
+        request, subscriber = self.subscribe()
+        subscriber.pauseProducing()
+        self.broadcaster.voted(1, 1, 5)
+        self.clock.advance(1)
+        self.assertEqual(len(events(request)), 1)
+
+        subscriber.resumeProducing()
+        self.assertEqual(events(request)[-1], [{'id': 1, 'votes': 5}])
+
+    def test_slow_consumer_dropped(self):
+        request, subscriber = self.subscribe()
+        subscriber.pauseProducing()
+        for total in range(1, 5):
+            self.broadcaster.voted(1, 1, total)
+            self.clock.advance(1)
+        request.transport.abortConnection.assert_called_once_with()
+        self.assertNotIn(subscriber, self.broadcaster.subscribers)
+
+    def test_changes_before_snapshot(self):
+        """ Changes aren't written before the first full snapshot """
+        request = MagicMock()
+        subscriber = self.broadcaster.subscribe(request)
+        self.broadcaster.voted(1, 1, 2)
+        self.clock.advance(1)
+        request.write.assert_not_called()
+
+        subscriber.start(b'data: {"candidates": [{"id": 1, "votes": 1}]}\n\n')
+        self.assertEqual(events(request), [[{'id': 1, 'votes': 1}], [{'id': 1, 'votes': 2}]])
+
+    def test_keepalive(self):
+        request, subscriber = self.subscribe()
+        self.clock.advance(15)
+        request.write.assert_called_with(b':\n\n')
+        subscriber.stopProducing()
+        self.assertFalse(self.broadcaster.keepalive.running)
+
+    def test_no_subscribers(self):
+        self.broadcaster.voted(1, 1, 1)
+        self.assertEqual(self.broadcaster.changes, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class TestStreamRoute(TestCase):
+
+    def test_stream_candidates(self):
+        """ Subscribing sends the snapshot and closing unsubscribes """
+        app = Application(MagicMock())
+        vote_api = app.vote_api
+        vote_api.votes = MagicMock()
+        vote_api.votes.all_vote_totals.return_value = defer.succeed([(1, 'Batman', 2)])
+        vote_api.broadcaster.keepalive_interval = 0
+
+        request = MagicMock()
+        d = vote_api.stream_candidates(request)
+        request.setHeader.assert_any_call('Content-Type', 'text/event-stream')
+        self.assertEqual(events(request), [[{'id': 1, 'name': 'Batman', 'votes': 2}]])
+        self.assertEqual(len(vote_api.broadcaster.subscribers), 1)
+
+        d.cancel()      # the client went away
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(len(vote_api.broadcaster.subscribers), 0)
+
+    def test_stream_database_failure(self):
+        """ A failed snapshot is logged and answered with 503 """
+        app = Application(MagicMock())
+        vote_api = app.vote_api
+        vote_api.votes = MagicMock()
+        vote_api.votes.all_vote_totals.return_value = defer.fail(RuntimeError('disk I/O error'))
+
+        request = MagicMock()
+        d = vote_api.stream_candidates(request)
+        self.assertIsNone(self.successResultOf(d))
+        request.setResponseCode.assert_called_once_with(503)
+        request.write.assert_called_once_with(DATABASE_ISSUES)
+        self.assertEqual(len(vote_api.broadcaster.subscribers), 0)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+class TestTallyPoller(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.rows = [(1, 'Hulk', 2), (2, 'Thor', None)]
+        self.observer = MagicMock()
+        self.listening = True
+        self.poller = TallyPoller(
+            lambda: defer.succeed(list(self.rows)), [self.observer], interval=1,
+            active=lambda: self.listening, clock=self.clock)
+        self.poller.start()
+        self.addCleanup(self.poller.stop)
+
+    def test_first_poll(self):
+        """ Everything is announced on the first poll """
+        self.clock.advance(1)
+        self.observer.nominated.assert_any_call(1, 'Hulk')
+        self.observer.nominated.assert_any_call(2, 'Thor')
+        self.observer.voted.assert_called_once_with(1, 2, 2)
+
+    def test_only_changes(self):
+        """ Later polls only pass on candidates whose totals changed """
+        self.clock.advance(1)
+        self.observer.reset_mock()
+        self.rows = [(1, 'Hulk', 2), (2, 'Thor', 3), (3, 'Loki', None)]
+        self.clock.advance(1)
+        self.observer.voted.assert_called_once_with(2, 3, 3)
+        self.observer.nominated.assert_called_once_with(3, 'Loki')
+
+    def test_inactive(self):
+        """ Nothing is loaded while nobody listens """
+        self.listening = False
+        self.clock.advance(1)
+        self.observer.nominated.assert_not_called()
+        self.observer.voted.assert_not_called()
+
+    def test_application_polls_with_workers(self):
+        """ The poller feeds the broadcaster from the shared database """
+        app = Application(MagicMock(), cache_ttl=0, poll_interval=1)
+        self.assertEqual(app.poller.observers, [app.vote_api.broadcaster])
+        self.assertFalse(app.poller.active())
+        self.assertIsNone(Application(MagicMock()).poller)
@@ -20,22 +20,48 @@ from sys import getdefaultencoding
 
 from klein.resource import ensure_utf8_bytes
 from treq.testing import RequestTraversalAgent, _SynchronousProducer
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial.unittest import TestCase
 from twisted.web.client import CookieAgent, readBody
 from twisted.web.http_headers import Headers
 
+from controllers import MAX_BULK_COUNT, MAX_BULK_VOTES
 from main import Application
 
 class KleinResourceTester(object):
 
     encoding = getdefaultencoding()
     cookiejar = CookieJar()
+    pump_interval = 0.001   # flush responses that finish outside the request, eg. in a db thread
 
     def __init__(self, router, base_url='https://example.com'):
         self.base_url = base_url
         self.mem_agent = RequestTraversalAgent(router.resource())
         self.mem_agent._realAgent = CookieAgent(self.mem_agent._realAgent, self.cookiejar)
+        self.pump = task.LoopingCall(self._flush)
+        self.pending = 0
+        self.flushing = False
+
+    def _flush(self):
+        # responses finishing here may start new requests, the pump only
+        # stops once the flush is over so it isn't restarted mid-call
+        self.flushing = True
+        try:
+            self.mem_agent.flush()
+        finally:
+            self.flushing = False
+        if self.pending == 0 and self.pump.running:
+            self.pump.stop()
+
+    def _start_pump(self):
+        self.pending += 1
+        if not self.pump.running:
+            self.pump.start(self.pump_interval, now=False)
+
+    def _stop_pump(self):
+        self.pending -= 1
+        if self.pending == 0 and not self.flushing:
+            self.pump.stop()
 
     def _create_headers(self, headers_dict):
         headers = Headers()
@@ -61,8 +87,12 @@ class KleinResourceTester(object):
 
         method = ensure_utf8_bytes(method)
         uri = ensure_utf8_bytes('/'.join([self.base_url, uri.strip('/')]))
-        response = yield self.mem_agent.request(method, uri, headers, body_producer)
-        content = yield readBody(response)
+        self._start_pump()
+        try:
+            response = yield self.mem_agent.request(method, uri, headers, body_producer)
+            content = yield readBody(response)
+        finally:
+            self._stop_pump()
         response.content = content.decode(self.encoding)
         response.getHeaders = response.headers.getRawHeaders
         defer.returnValue(response)
@@ -78,6 +108,7 @@ class TestVoteAPI(TestCase):
             base_url = 'https://example.com')
         self.candidates = self.app.vote_api.candidates = MagicMock()
         self.votes = self.app.vote_api.votes = MagicMock()
+        self.app.vote_api.cache.invalidate()
 
     def test_get_candidates(self):
         """
@@ -123,6 +154,154 @@ class TestVoteAPI(TestCase):
 
         return request
 
+    def test_get_candidates_page(self):
+        """
+        Paged listings come from `vote_totals_page` with a cursor to the next page
+        """
+        self.votes.vote_totals_page.return_value = defer.succeed([
+            (3, 'Superman', 100), (2, 'Spiderman', None)])
+
+        request = self.client.request('GET', '/api/candidates?limit=2')
+        @request.addCallback
+        def first(response):
+            self.assertEquals(response.code, 200)
+            content = json.loads(response.content)
+            self.assertEquals([c['votes'] for c in content['candidates']], [100, 0])
+            self.votes.vote_totals_page.assert_called_with('votes', 2, None)
+            self.votes.all_vote_totals.assert_not_called()
+
+            self.votes.vote_totals_page.return_value = defer.succeed([(1, 'Batman', None)])
+            return self.client.request('GET', '/api/candidates?limit=2&after=%s' % (content['next']))
+
+        @request.addCallback
+        def last(response):
+            self.votes.vote_totals_page.assert_called_with('votes', 2, (0, 2))
+            self.assertIsNone(json.loads(response.content)['next'])
+
+        return request
+
+    def test_get_candidates_top(self):
+        self.votes.vote_totals_page.return_value = defer.succeed([(3, 'Superman', 100)])
+
+        request = self.client.request('GET', '/api/candidates?top=1')
+        @request.addCallback
+        def verify(response):
+            self.votes.vote_totals_page.assert_called_with('votes', 1, None)
+            self.assertEquals(json.loads(response.content), {
+                'candidates': [{'id': 3, 'name': 'Superman', 'votes': 100}]})
+
+        return request
+
+    def test_get_candidates_page_invalid(self):
+        from controllers import encode_cursor
+        queries = [
+            'order=age', 'limit=0', 'limit=1001', 'limit=ten', 'after=nonsense',
+            'order=name&after=%s' % (encode_cursor('votes', [1, 2])),
+            'top=5&order=name', 'top=5&limit=2']
+        requests = [self.client.request('GET', '/api/candidates?' + query) for query in queries]
+        d = defer.gatherResults(requests)
+
+        @d.addCallback
+        def verify(responses):
+            self.assertEquals([response.code for response in responses], [412] * len(queries))
+            self.votes.vote_totals_page.assert_not_called()
+
+        return d
+
+    def test_get_candidates_cached(self):
+        """
+        Repeated polls are answered from the tally cache
+        """
+        self.votes.all_vote_totals.return_value = defer.succeed([(1, 'Batman', 3)])
+
+        d = self.client.request('GET', '/api/candidates')
+        d.addCallback(lambda first: self.client.request('GET', '/api/candidates'))
+        @d.addCallback
+        def verify(response):
+            candidates = json.loads(response.content)['candidates']
+            self.assertEqual(candidates, [{'id': 1, 'name': 'Batman', 'votes': 3}])
+            self.assertEqual(self.votes.all_vote_totals.call_count, 1)
+
+        return d
+
+    def test_get_candidates_not_modified(self):
+        """
+        A matching If-None-Match gets an empty 304 without querying the database
+        """
+        self.votes.all_vote_totals.return_value = defer.succeed([(1, 'Batman', 3)])
+
+        d = self.client.request('GET', '/api/candidates')
+        @d.addCallback
+        def revalidate(response):
+            etag = response.getHeaders('ETag')[0]
+            self.assertTrue(response.getHeaders('Last-Modified'))
+            self.votes.all_vote_totals.reset_mock()
+            return self.client.request('GET', '/api/candidates', headers={'If-None-Match': etag})
+
+        @d.addCallback
+        def verify(response):
+            self.assertEqual(response.code, 304)
+            self.assertEqual(response.content, '')
+            self.votes.all_vote_totals.assert_not_called()
+
+        return d
+
+    @defer.inlineCallbacks
+    def test_get_candidates_if_modified_since(self):
+        """
+        Last-Modified only names a second once it's over, so a vote later in
+        the same second isn't mistaken for the client's copy
+        """
+        self.votes.all_vote_totals.return_value = defer.succeed([(1, 'Batman', 3)])
+        cache = self.app.vote_api.cache
+        cache.clock = clock = task.Clock()
+        clock.advance(1000.25)
+        cache.modified = clock.seconds()
+
+        def get(last_modified):
+            return self.client.request(
+                'GET', '/api/candidates', headers={'If-Modified-Since': last_modified})
+
+        response = yield self.client.request('GET', '/api/candidates')
+        last_modified = response.getHeaders('Last-Modified')[0]
+        self.assertEqual(last_modified, 'Thu, 01 Jan 1970 00:16:40 GMT')
+        response = yield get(last_modified)
+        self.assertEqual(response.code, 200)    # still the second of the change
+
+        clock.advance(1)
+        response = yield get(last_modified)
+        last_modified = response.getHeaders('Last-Modified')[0]
+        self.assertEqual(last_modified, 'Thu, 01 Jan 1970 00:16:41 GMT')
+        response = yield get(last_modified)
+        self.assertEqual(response.code, 304)
+
+        clock.advance(0.25)
+        cache.voted(1, 1, 4)
+        response = yield get(last_modified)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.content)['candidates'][0]['votes'], 4)
+
+    def test_get_candidates_etag_changes_on_vote(self):
+        """
+        Votes change the tally and its ETag, so stale ETags get a full response
+        """
+        self.votes.all_vote_totals.return_value = defer.succeed([(1, 'Batman', 3)])
+
+        d = self.client.request('GET', '/api/candidates')
+        @d.addCallback
+        def vote(response):
+            self.etag = response.getHeaders('ETag')[0]
+            self.app.vote_api.cache.voted(1, 1, 4)
+            return self.client.request('GET', '/api/candidates', headers={'If-None-Match': self.etag})
+
+        @d.addCallback
+        def verify(response):
+            self.assertEqual(response.code, 200)
+            self.assertNotEqual(response.getHeaders('ETag')[0], self.etag)
+            self.assertEqual(json.loads(response.content)['candidates'][0]['votes'], 4)
+
+        return d
+
     def test_add_candidate(self):
         """
         Add a candidate
@@ -238,3 +417,171 @@ class TestVoteAPI(TestCase):
             deferred_list.append(d)
 
         return defer.gatherResults(deferred_list)
+
+    def test_bulk_vote(self):
+        """
+        Bulk votes are applied in a single call with per-record status
+        """
+        self.votes.add_votes.return_value = defer.succeed([404])
+        records = [
+            {'id': 1, 'count': 5},
+            {'id': 404},
+            {'id': 'one'},
+            {'id': 1},
+            {'id': 2, 'count': 0}]
+        request = self.client.request(
+            method = 'POST',
+            uri = '/api/votes/bulk',
+            headers = {'Content-Type': 'application/json'},
+            body = json.dumps(records).encode('utf-8'))
+
+        @request.addCallback
+        def verify(response):
+            self.assertEqual(response.code, 200)
+            content = json.loads(response.content)
+            self.assertEqual(content['accepted'], 2)
+            self.assertEqual(content['votes'], 6)
+            self.assertEqual(content['rejected'], [
+                {'record': 1, 'status': 'Candidate Not Found'},
+                {'record': 2, 'status': 'Invalid Record'},
+                {'record': 4, 'status': 'Invalid Record'}])
+            self.votes.add_votes.assert_called_once_with({1: 6, 404: 1})
+
+        return request
+
+    def test_bulk_vote_ndjson(self):
+        """
+        Newline-delimited records are accepted as well
+        """
+        self.votes.add_votes.return_value = defer.succeed([])
+        request = self.client.request(
+            method = 'POST',
+            uri = '/api/votes/bulk',
+            headers = {'Content-Type': 'application/x-ndjson'},
+            body = b'{"id": 3}\n{"id": 3, "count": 2}\nnot json\n')
+
+        @request.addCallback
+        def verify(response):
+            content = json.loads(response.content)
+            self.assertEqual((content['accepted'], content['votes']), (2, 3))
+            self.assertEqual(content['rejected'], [{'record': 2, 'status': 'Invalid JSON'}])
+            self.votes.add_votes.assert_called_once_with({3: 3})
+
+        return request
+
+    def test_bulk_vote_limits(self):
+        """
+        Records over the per-record or per-candidate limit are rejected
+        before the database sees them
+        """
+        self.votes.add_votes.return_value = defer.succeed([])
+        records = [{'id': 1, 'count': MAX_BULK_COUNT + 1}, {'id': 2, 'count': 2 ** 63}]
+        records += [{'id': 3, 'count': MAX_BULK_COUNT}] * (MAX_BULK_VOTES // MAX_BULK_COUNT + 1)
+        request = self.client.request(
+            method = 'POST',
+            uri = '/api/votes/bulk',
+            headers = {'Content-Type': 'application/json'},
+            body = json.dumps(records).encode('utf-8'))
+
+        @request.addCallback
+        def verify(response):
+            content = json.loads(response.content)
+            self.assertEqual(content['votes'], MAX_BULK_VOTES)
+            self.assertEqual(content['rejected'], [
+                {'record': 0, 'status': 'Invalid Record'},
+                {'record': 1, 'status': 'Invalid Record'},
+                {'record': len(records) - 1, 'status': 'Too Many Votes'}])
+            self.votes.add_votes.assert_called_once_with({3: MAX_BULK_VOTES})
+
+        return request
+
+    def test_bulk_vote_invalid_utf8(self):
+        """
+        A record that isn't UTF-8 is rejected on its own
+        """
+        self.votes.add_votes.return_value = defer.succeed([])
+        request = self.client.request(
+            method = 'POST',
+            uri = '/api/votes/bulk',
+            headers = {'Content-Type': 'application/x-ndjson'},
+            body = b'{"id": 1}\n\xff\xfe\n')
+
+        @request.addCallback
+        def verify(response):
+            self.assertEqual(response.code, 200)
+            content = json.loads(response.content)
+            self.assertEqual(content['rejected'], [{'record': 1, 'status': 'Invalid JSON'}])
+            self.votes.add_votes.assert_called_once_with({1: 1})
+
+        return request
+
+    def test_bulk_vote_empty(self):
+        request = self.client.request('POST', '/api/votes/bulk', body=b'')
+
+        @request.addCallback
+        def verify(response):
+            self.assertEqual(response.code, 412)
+            self.votes.add_votes.assert_not_called()
+
+        return request
+
+class TestConcurrentVotes(TestCase):
+    """
+    Fire a large number of simultaneous votes at a real SQLite database and
+    verify that none of the increments are lost.
+    """
+
+    concurrent_votes = 2000
+
+    def setUp(self):
+        from os import path
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from twisted.enterprise.adbapi import ConnectionPool
+
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        self.dbpool = ConnectionPool(
+            'sqlite3', path.join(tmpdir, 'votes.sqlite'), check_same_thread=False)
+        self.addCleanup(self.dbpool.close)
+
+        self.app = Application(self.dbpool)
+        self.client = KleinResourceTester(
+            router = self.app.router,
+            base_url = 'https://example.com')
+
+        self.candidates = self.app.vote_api.candidates
+        self.votes = self.app.vote_api.votes
+
+    @defer.inlineCallbacks
+    def test_parallel_votes(self):
+        yield self.candidates.create_table()
+        yield self.votes.create_table()
+        yield self.candidates.add_candidate('Bruce Wayne')
+
+        requests = []
+        for i in range(self.concurrent_votes):
+            requests.append(self.client.request(
+                method = 'POST',
+                uri = '/api/vote',
+                headers = {'Content-Type': 'application/x-www-form-urlencoded'},
+                params = {'id': 1}))
+        responses = yield defer.gatherResults(requests)
+        self.assertEqual(set(r.code for r in responses), {200})
+
+        total = yield self.votes.vote_total(1)
+        self.assertEqual(total, [(1, 'Bruce Wayne', self.concurrent_votes)])
+
+    @defer.inlineCallbacks
+    def test_vote_for_missing_candidate(self):
+        yield self.candidates.create_table()
+        yield self.votes.create_table()
+
+        response = yield self.client.request(
+            method = 'POST',
+            uri = '/api/vote',
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'},
+            params = {'id': 7})
+        self.assertEqual(response.code, 412)
+        total = yield self.votes.vote_total(7)
+        self.assertEqual(total, [])
@@ -0,0 +1,117 @@
+from __future__ import print_function
+import errno
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+def listening_socket(host, port, backlog=128):
+    """
+    Bind and listen before forking so every worker accepts connections
+    from the same socket and the kernel spreads them over the workers.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def install_reactor():
+    """
+    Give a freshly forked worker its own reactor. The one imported before
+    the fork shares its epoll/kqueue descriptor and waker with the parent
+    and every other worker.
+    """
+    import twisted.internet
+    from twisted.internet.default import install
+    sys.modules.pop('twisted.internet.reactor', None)
+    if hasattr(twisted.internet, 'reactor'):
+        del twisted.internet.reactor
+    install()
+
+class Supervisor(object):
+    """
+    Fork `count` worker processes running `worker(index)` and restart any
+    that exit until the supervisor is told to stop with SIGTERM or SIGINT,
+    which is passed on to the workers.
+
+    A worker that dies within `restart_delay` seconds of starting is
+    restarted after that delay so a crash on startup doesn't spin. Any of
+    `forward_signals` the supervisor gets is sent on to every worker.
+    """
+
+    def __init__(self, worker, count, restart_delay=1, forward_signals=()):
+        self.worker = worker
+        self.count = count
+        self.restart_delay = restart_delay
+        self.forward_signals = forward_signals
+        self.children = {}      # pid -> (index, start time)
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            for signum in self.forward_signals:
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                self.worker(index)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        self.children[pid] = (index, time.time())
+        return pid
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for signum in self.forward_signals:
+            signal.signal(signum, self.forward)
+        for index in range(self.count):
+            self.spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                reason = 'was killed by signal %d' % (os.WTERMSIG(status))
+            else:
+                reason = 'exited with code %d' % (os.WEXITSTATUS(status))
+            print('[!] Worker %d (pid %d) %s, restarting' % (index, pid, reason))
+            if time.time() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            if not self.stopping:
+                self.spawn(index)
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass    # already gone
+
+    def forward(self, signum, frame=None):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass    # already gone